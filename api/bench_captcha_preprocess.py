@@ -0,0 +1,77 @@
+# bench_captcha_preprocess.py
+# 比較驗證碼前處理：舊版 PIL 逐像素流程 vs cv2 向量化流程（吞吐量與輸出一致度）
+# 用法：python bench_captcha_preprocess.py [圖片檔 ...] [--rounds 200]
+import argparse
+import base64
+import time
+
+import cv2
+import numpy as np
+
+from captcha_preprocess import (
+    DENOISE_MODES, THRESHOLD_MODES, encode_png_base64, legacy_preprocess_pil, preprocess_captcha
+)
+
+
+def synthetic_captcha(seed=0, size=(140, 50)):
+    """沒有樣本圖時產生近似的驗證碼：漸層底色 + 四個字 + 雜點與干擾線"""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    img = np.tile(np.linspace(150, 230, w, dtype=np.uint8), (h, 1))
+    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    text = "".join(rng.choice(list("ABCDEFGHJKLMNPQRSTUVWXYZ23456789"), 4))
+    cv2.putText(img, text, (12, 37), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (40, 40, 40), 2)
+    for _ in range(4):
+        p1 = tuple(int(v) for v in rng.integers(0, (w, h)))
+        p2 = tuple(int(v) for v in rng.integers(0, (w, h)))
+        cv2.line(img, p1, p2, (90, 90, 90), 1)
+    noise = rng.integers(0, 2, (h, w)) * rng.integers(-60, 60, (h, w))
+    img = np.clip(img.astype(int) + noise[..., None], 0, 255).astype(np.uint8)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+def decode_b64_png(b64):
+    return cv2.imdecode(np.frombuffer(base64.b64decode(b64), np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+def timed(fn, samples, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        fn(samples[i % len(samples)])
+    return rounds / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("images", nargs="*", help="驗證碼樣本（PNG/JPEG）；未提供時使用合成圖")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.images:
+        samples = [open(path, "rb").read() for path in args.images]
+    else:
+        samples = [synthetic_captcha(seed) for seed in range(20)]
+
+    legacy_rate = timed(legacy_preprocess_pil, samples, args.rounds)
+    print(f"{'pipeline':<28}{'img/s':>10}{'speedup':>10}{'pixel match':>14}")
+    print(f"{'legacy PIL':<28}{legacy_rate:>10.1f}{1:>10.2f}{'-':>14}")
+
+    for threshold in THRESHOLD_MODES:
+        for denoise in DENOISE_MODES:
+            def pipeline(img_bytes):
+                return encode_png_base64(preprocess_captcha(img_bytes, threshold=threshold, denoise=denoise))
+
+            rate = timed(pipeline, samples, args.rounds)
+            # 一致度：與舊版輸出逐像素比對（同尺寸時）
+            matches = []
+            for img_bytes in samples:
+                old = decode_b64_png(legacy_preprocess_pil(img_bytes))
+                new = decode_b64_png(pipeline(img_bytes))
+                if old.shape == new.shape:
+                    matches.append(np.mean((old > 127) == (new > 127)))
+            match = f"{np.mean(matches) * 100:.2f}%" if matches else "size differs"
+            print(f"{'cv2 ' + threshold + '/' + denoise:<28}{rate:>10.1f}{rate / legacy_rate:>10.2f}{match:>14}")
+
+
+if __name__ == "__main__":
+    main()
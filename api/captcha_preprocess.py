@@ -0,0 +1,76 @@
+# captcha_preprocess.py
+import base64
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+THRESHOLD_MODES = ("fixed", "otsu", "adaptive")
+DENOISE_MODES = ("none", "median", "open")
+INTERPOLATIONS = {
+    "nearest": getattr(cv2, "INTER_NEAREST_EXACT", cv2.INTER_NEAREST),  # 與 PIL 相同的像素中心對齊
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "lanczos": cv2.INTER_LANCZOS4
+}
+_OPEN_KERNEL = np.ones((2, 2), np.uint8)
+
+
+def decode_gray(img_bytes):
+    """PNG/JPEG bytes → 灰階 ndarray；無法解碼時拋出 ValueError"""
+    img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError("無法解碼驗證碼圖片 / Cannot decode captcha image")
+    return img
+
+
+def preprocess_captcha(img_bytes, scale=2.5, threshold="fixed", level=140, denoise="none", interpolation="nearest"):
+    """灰階 → 放大 → 去雜訊 → 二值化，全程向量化；回傳 0/255 的 uint8 ndarray
+
+    threshold：fixed（低於 level 為黑）、otsu（自動門檻）、adaptive（區域門檻，適合明暗不均）
+    denoise：none、median（3x3 中值濾波）、open（形態學開運算，去除細小雜點）
+    """
+    if threshold not in THRESHOLD_MODES:
+        raise ValueError(f"未知的二值化模式：{threshold} / Unknown threshold mode")
+    if denoise not in DENOISE_MODES:
+        raise ValueError(f"未知的去雜訊模式：{denoise} / Unknown denoise mode")
+
+    img = decode_gray(img_bytes)
+    if scale != 1:
+        size = (int(img.shape[1] * scale), int(img.shape[0] * scale))
+        img = cv2.resize(img, size, interpolation=INTERPOLATIONS[interpolation])
+    if denoise == "median":
+        img = cv2.medianBlur(img, 3)
+
+    if threshold == "fixed":
+        # 與舊版 PIL 相同：x < level → 0，其餘 → 255
+        _, img = cv2.threshold(img, level - 1, 255, cv2.THRESH_BINARY)
+    elif threshold == "otsu":
+        _, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    else:
+        img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+
+    if denoise == "open":
+        # 白底黑字：對黑色筆畫做開運算 = 對反相影像開運算
+        img = cv2.bitwise_not(cv2.morphologyEx(cv2.bitwise_not(img), cv2.MORPH_OPEN, _OPEN_KERNEL))
+    return img
+
+
+def encode_png_base64(img):
+    """ndarray → PNG → base64 字串（低壓縮等級，編碼速度優先）"""
+    ok, buffer = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise ValueError("PNG 編碼失敗 / PNG encoding failed")
+    return base64.b64encode(buffer.tobytes()).decode("utf-8")
+
+
+def legacy_preprocess_pil(img_bytes, scale=2.5):
+    """舊版 PIL 流程（逐像素 lambda 二值化），保留作為基準比較與回退"""
+    img = Image.open(BytesIO(img_bytes)).convert("L")  # 灰階
+    img = img.point(lambda x: 0 if x < 140 else 255, '1')  # 二值化
+    new_size = (int(img.width * scale), int(img.height * scale))
+    img = img.resize(new_size, Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
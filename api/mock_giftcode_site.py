@@ -0,0 +1,114 @@
+# mock_giftcode_site.py
+# 本地假禮包碼 API：模擬 /api/player、/api/captcha、/api/gift_code，供 HTTP 兌換引擎離線測試
+# 用法：python mock_giftcode_site.py --port 8099，再以 GIFTCODE_API_URL=http://127.0.0.1:8099/api 啟動 redeem_web
+import argparse
+import base64
+import hashlib
+import random
+import string
+
+import cv2
+import numpy as np
+from aiohttp import web
+
+DEFAULT_SALT = "tB87#kPtkxqOS2"
+CAPTCHA_CHARS = string.ascii_uppercase + string.digits
+
+
+def _reply(code=0, msg="success", err_code="", data=None):
+    return web.json_response({"code": code, "msg": msg, "err_code": err_code, "data": data if data is not None else []})
+
+
+def render_captcha(text):
+    """產生與正式站相似的 4 字驗證碼 PNG"""
+    img = np.full((50, 140, 3), 235, np.uint8)
+    cv2.putText(img, text, (14, 37), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (40, 40, 40), 2)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+class MockGiftcodeSite:
+    """記憶體內的禮包碼網站：驗簽、登入、發驗證碼、兌換與重複領取判斷"""
+
+    def __init__(self, codes=None, players=None, salt=DEFAULT_SALT):
+        self.codes = codes if codes is not None else {"VIP888": "active", "EXPIRED1": "expired"}
+        self.players = players  # None：任何數字 ID 都視為存在
+        self.salt = salt
+        self.claimed = set()    # {(fid, code)}
+        self.captchas = {}      # fid -> 目前有效的答案
+        self.logged_in = set()
+        self.calls = {"player": 0, "captcha": 0, "gift_code": 0}
+
+    def _signed(self, params):
+        sign = params.pop("sign", "")
+        query = "&".join(f"{key}={params[key]}" for key in sorted(params))
+        return sign == hashlib.md5((query + self.salt).encode("utf-8")).hexdigest()
+
+    async def _params(self, request):
+        params = dict(await request.post())
+        return params if self._signed(dict(params)) else None
+
+    async def player(self, request):
+        self.calls["player"] += 1
+        params = await self._params(request)
+        if params is None:
+            return _reply(1, "Sign Error", 0)
+        fid = params.get("fid", "")
+        if not fid.isdigit() or (self.players is not None and fid not in self.players):
+            return _reply(1, "role not exist.")
+        self.logged_in.add(fid)
+        return _reply(data={"fid": int(fid), "nickname": f"Player{fid}", "kid": 1, "stove_lv": 30})
+
+    async def captcha(self, request):
+        self.calls["captcha"] += 1
+        params = await self._params(request)
+        if params is None:
+            return _reply(1, "Sign Error", 0)
+        fid = params.get("fid", "")
+        if fid not in self.logged_in:
+            return _reply(1, "NOT LOGIN.", 40009)
+        text = "".join(random.choices(CAPTCHA_CHARS, k=4))
+        self.captchas[fid] = text
+        img = base64.b64encode(render_captcha(text)).decode("utf-8")
+        return _reply(data={"img": f"data:image/png;base64,{img}"})
+
+    async def gift_code(self, request):
+        self.calls["gift_code"] += 1
+        params = await self._params(request)
+        if params is None:
+            return _reply(1, "Sign Error", 0)
+        fid, code = params.get("fid", ""), params.get("cdk", "")
+        if fid not in self.logged_in:
+            return _reply(1, "NOT LOGIN.", 40009)
+        expected = self.captchas.pop(fid, None)
+        if not expected:
+            return _reply(1, "CAPTCHA EXPIRED.", 40102)
+        if params.get("captcha_code", "").upper() != expected:
+            return _reply(1, "CAPTCHA CHECK ERROR.", 40103)
+        if code not in self.codes:
+            return _reply(1, "CDK NOT FOUND.", 40014)
+        if self.codes[code] == "expired":
+            return _reply(1, "TIME ERROR.", 40007)
+        if (fid, code) in self.claimed:
+            return _reply(1, "RECEIVED.", 40008)
+        self.claimed.add((fid, code))
+        return _reply(msg="SUCCESS", err_code=20000)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/api/player", self.player)
+        app.router.add_post("/api/captcha", self.captcha)
+        app.router.add_post("/api/gift_code", self.gift_code)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--code", action="append", help="有效禮包碼，可重複指定；預設 VIP888")
+    args = parser.parse_args()
+    codes = {code: "active" for code in args.code} if args.code else None
+    web.run_app(MockGiftcodeSite(codes=codes).app(), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,9 +13,15 @@ import sys
 import logging
 import aiohttp
 import threading
-
-from io import BytesIO
-from flask import Flask, request, jsonify
+import atexit
+import abc
+import weakref
+import uuid
+import functools
+
+from email.utils import format_datetime
+from collections import OrderedDict
+from aiohttp import web
 from playwright.async_api import async_playwright, TimeoutError
 from dotenv import load_dotenv
 import firebase_admin
@@ -27,9 +33,9 @@ import subprocess
 import cv2
 import numpy as np
 import pytesseract
-import nest_asyncio
-from datetime import datetime
+from datetime import datetime, timezone
 import easyocr
+from captcha_preprocess import preprocess_captcha, encode_png_base64, THRESHOLD_MODES, DENOISE_MODES
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
@@ -45,8 +51,7 @@ def suppress_stdout():
             sys.stdout = old_stdout
 
 # === 初始化 ===
-app = Flask(__name__)
-nest_asyncio.apply()
+routes = web.RouteTableDef()
 
 # === 設定 ===
 OCR_MAX_RETRIES = 3
@@ -70,57 +75,1498 @@ db = firestore.client()
 FAILURE_KEYWORDS = ["請先輸入", "不存在", "錯誤", "無效", "超出", "無法", "類型", "已使用"]
 RETRY_KEYWORDS = ["驗證碼錯誤", "驗證碼已過期", "伺服器繁忙", "請稍後再試", "系統異常", "請重試", "處理中"]
 REDEEM_RETRIES = 3
+
+# === 阻塞呼叫（Firestore、webhook）交給執行緒池，不卡住共用的 event loop ===
+async def run_blocking(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+# === 兌換工作日誌（實例重啟後續跑未完成的工作）===
+RUN_JOURNAL = os.getenv("RUN_JOURNAL", "firestore").lower()           # firestore / file / off
+RUN_JOURNAL_PATH = os.getenv("RUN_JOURNAL_PATH", "run_journal.jsonl")   # file 模式的 append-only 檔案
+RUN_JOURNAL_COLLECTION = "redeem_runs"
+RUN_RESUME_MAX_ATTEMPTS = int(os.getenv("RUN_RESUME_MAX_ATTEMPTS", "3"))  # 同一玩家開始幾次仍未完成就放棄（避免卡死重啟）
+RUN_LEASE_SECONDS = float(os.getenv("RUN_LEASE_SECONDS", "120"))  # 工作租約長度；執行中每 1/3 租約續約，過期才可被其他實例續跑
+
+def run_lease_open(run, owner=None, now=None):
+    """工作的租約可否由 owner 取得：尚無擁有者、租約已過期，或本來就是 owner 的"""
+    if owner and run.get("owner") == owner:
+        return True
+    return (run.get("lease_expires") or 0) <= (now or time.time())
+
+class RunJournal:
+    """工作日誌介面：記錄工作的輸入、擁有者與租約、每位玩家的狀態（started / finished / abandoned）與開始次數
+
+    基底類別不寫任何東西（RUN_JOURNAL=off）
+    """
+
+    def start(self, job, lease_seconds=RUN_LEASE_SECONDS):
+        pass
+
+    def claim(self, job_id, owner, lease_seconds=RUN_LEASE_SECONDS):
+        """原子地取得未完成工作的租約；工作已結束或租約仍由他人持有時回傳 False"""
+        return True
+
+    def renew(self, job, lease_seconds=RUN_LEASE_SECONDS):
+        """延長 job.owner 的租約；租約已被他人取走時回傳 False"""
+        return True
+
+    def release(self, job):
+        """關機時放掉租約，讓其他實例不必等租約過期就能續跑"""
+        pass
+
+    def player(self, job, player_id, state):
+        pass
+
+    def finish(self, job):
+        pass
+
+    def get(self, job_id):
+        """讀取單一工作的持久化狀態：{job_id, kind, code, status, total, counts, owner}；查無資料回傳 None"""
+        return None
+
+    def load(self):
+        """回傳未完成且租約已過期的工作：[{job_id, kind, code, total, payload, counts, owner, players: {pid: {state, attempts}}}]"""
+        return []
+
+    def stats(self):
+        return {"backend": "off"}
+
+class FileRunJournal(RunJournal):
+    """本機 append-only JSONL：每個事件立即寫入一行；載入時重放並壓縮掉已結束的工作
+
+    租約的領取與續約在鎖內重放後再寫入，同一程序內共用此日誌的多個 JobRegistry 不會重複續跑
+    """
+
+    def __init__(self, path=RUN_JOURNAL_PATH):
+        self.path = path
+        self._file = None
+        self._lock = threading.RLock()
+        self.appends = 0
+
+    def _write(self, event):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._file.flush()
+            self.appends += 1
+
+    def start(self, job, lease_seconds=RUN_LEASE_SECONDS):
+        self._write({
+            "event": "start", "job_id": job.id, "kind": job.kind, "code": job.code,
+            "total": job.total, "payload": job.payload, "counts": job.counts,
+            "owner": job.owner, "lease_expires": time.time() + lease_seconds if job.owner else 0
+        })
+
+    def _lease(self, job_id, owner, lease_expires):
+        """在鎖內確認 owner 可取得租約後寫入 lease 事件"""
+        with self._lock:
+            run = self._replay().get(job_id)
+            if run is None or not run_lease_open(run, owner):
+                return False
+            self._write({"event": "lease", "job_id": job_id, "owner": owner, "lease_expires": lease_expires})
+            return True
+
+    def claim(self, job_id, owner, lease_seconds=RUN_LEASE_SECONDS):
+        return self._lease(job_id, owner, time.time() + lease_seconds)
+
+    def renew(self, job, lease_seconds=RUN_LEASE_SECONDS):
+        return self._lease(job.id, job.owner, time.time() + lease_seconds)
+
+    def release(self, job):
+        self._lease(job.id, job.owner, 0)
+
+    def player(self, job, player_id, state):
+        self._write({
+            "event": "player", "job_id": job.id, "player_id": player_id, "state": state,
+            "attempts": job.attempts.get(player_id, 0), "counts": job.counts
+        })
+
+    def finish(self, job):
+        self._write({"event": "finish", "job_id": job.id, "status": job.status})
+
+    def _replay(self):
+        runs = {}
+        with contextlib.suppress(FileNotFoundError), open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # 當機時寫到一半的最後一行
+                run = runs.get(event["job_id"])
+                if event["event"] == "start":
+                    runs[event["job_id"]] = {**event, "players": {}}
+                elif event["event"] == "finish":
+                    runs.pop(event["job_id"], None)
+                elif run is None:
+                    continue
+                elif event["event"] == "lease":
+                    run["owner"], run["lease_expires"] = event["owner"], event["lease_expires"]
+                else:
+                    run["players"][event["player_id"]] = {"state": event["state"], "attempts": event["attempts"]}
+                    run["counts"] = event["counts"]
+        return runs
+
+    def get(self, job_id):
+        # 已結束的工作在重放時即被移除，只查得到未完成的
+        with self._lock:
+            run = self._replay().get(job_id)
+        if run is None:
+            return None
+        return {
+            "job_id": job_id, "kind": run["kind"], "code": run["code"], "status": "running",
+            "total": run["total"], "counts": run["counts"], "owner": run.get("owner")
+        }
+
+    def load(self):
+        with self._lock:
+            runs = self._replay()
+            self._compact(runs.values())
+        now = time.time()
+        return [{k: v for k, v in run.items() if k != "event"} for run in runs.values() if run_lease_open(run, now=now)]
+
+    def _compact(self, runs):
+        # 只保留未完成工作的最新狀態，避免檔案無限增長；先關閉寫入中的檔案，之後的事件寫到新檔
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for run in runs:
+                f.write(json.dumps({k: v for k, v in run.items() if k != "players"}, ensure_ascii=False) + "\n")
+                for pid, info in run["players"].items():
+                    f.write(json.dumps({
+                        "event": "player", "job_id": run["job_id"], "player_id": pid,
+                        "state": info["state"], "attempts": info["attempts"], "counts": run["counts"]
+                    }, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        return {"backend": "file", "path": self.path, "appends": self.appends}
+
+class FirestoreRunJournal(RunJournal):
+    """redeem_runs/{job_id}（工作輸入與狀態）＋ players 子集合；寫入與兌換結果同批送出"""
+
+    def _ref(self, job_id):
+        return db.collection(RUN_JOURNAL_COLLECTION).document(job_id)
+
+    def start(self, job, lease_seconds=RUN_LEASE_SECONDS):
+        result_sink.merge(self._ref(job.id), {
+            "kind": job.kind,
+            "code": job.code,
+            "total": job.total,
+            "payload": job.payload,
+            "counts": dict(job.counts),
+            "status": "running",
+            "owner": job.owner,
+            "lease_expires": time.time() + lease_seconds if job.owner else 0,
+            "created_at": datetime.utcnow()
+        })
+
+    def _lease(self, job_id, owner, lease_expires, missing_ok=False):
+        """在 transaction 內確認 owner 可取得租約後更新，與 FirestoreLeaseStore 領取分片的方式相同"""
+        ref = self._ref(job_id)
+
+        @firestore.transactional
+        def run(transaction):
+            snap = ref.get(transaction=transaction)
+            if not snap.exists:
+                return missing_ok  # 工作剛建立，start 還在結果緩衝中
+            run = snap.to_dict()
+            if run.get("status") != "running" or not run_lease_open(run, owner):
+                return False
+            transaction.update(ref, {"owner": owner, "lease_expires": lease_expires})
+            return True
+
+        return run(db.transaction())
+
+    def claim(self, job_id, owner, lease_seconds=RUN_LEASE_SECONDS):
+        return self._lease(job_id, owner, time.time() + lease_seconds)
+
+    def renew(self, job, lease_seconds=RUN_LEASE_SECONDS):
+        return self._lease(job.id, job.owner, time.time() + lease_seconds, missing_ok=True)
+
+    def release(self, job):
+        self._lease(job.id, job.owner, 0)
+
+    def player(self, job, player_id, state):
+        ref = self._ref(job.id)
+        result_sink.merge(ref.collection("players").document(player_id), {
+            "state": state,
+            "attempts": job.attempts.get(player_id, 0),
+            "updated_at": datetime.utcnow()
+        })
+        result_sink.merge(ref, {"counts": dict(job.counts)})
+
+    def finish(self, job):
+        result_sink.merge(self._ref(job.id), {"status": job.status, "finished_at": datetime.utcnow()})
+
+    def get(self, job_id):
+        doc = self._ref(job_id).get()
+        if not doc.exists:
+            return None
+        run = doc.to_dict()
+        return {
+            "job_id": job_id, "kind": run.get("kind"), "code": run.get("code"), "status": run.get("status"),
+            "total": run.get("total", 0), "counts": run.get("counts") or {}, "owner": run.get("owner")
+        }
+
+    def load(self):
+        runs = []
+        now = time.time()
+        for doc in db.collection(RUN_JOURNAL_COLLECTION).where("status", "==", "running").stream():
+            run = doc.to_dict()
+            if not run_lease_open(run, now=now):
+                continue  # 仍有實例在執行並續約
+            players = {p.id: p.to_dict() for p in doc.reference.collection("players").stream()}
+            runs.append({
+                "job_id": doc.id,
+                "kind": run.get("kind"),
+                "code": run.get("code"),
+                "total": run.get("total", 0),
+                "payload": run.get("payload") or {},
+                "counts": run.get("counts") or {},
+                "owner": run.get("owner"),
+                "players": players
+            })
+        return runs
+
+    def stats(self):
+        return {"backend": "firestore", "collection": RUN_JOURNAL_COLLECTION}
+
+def build_run_journal(backend):
+    if backend == "file":
+        return FileRunJournal()
+    if backend == "firestore":
+        return FirestoreRunJournal()
+    if backend not in ("off", "none", ""):
+        logger.warning(f"未知的 RUN_JOURNAL：{backend}，停用工作日誌 / Unknown journal backend, journaling disabled")
+    return RunJournal()
+
+run_journal = build_run_journal(RUN_JOURNAL)
+
+# === 背景兌換工作（API 立即回傳 job_id，進度由 /jobs/<id> 查詢）===
+JOB_HISTORY_LIMIT = int(os.getenv("JOB_HISTORY_LIMIT", "200"))  # 保留最近幾筆已結束的工作
+
+class RedeemJob:
+    """一次兌換請求的進度：各結果計數隨玩家完成即時更新，並寫入工作日誌供重啟後續跑"""
+
+    def __init__(self, kind, code, total, payload=None, journal=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.code = code
+        self.total = total
+        self.payload = payload or {}
+        self.journal = journal or RunJournal()
+        self.attempts = {}  # player_id -> 開始次數（跨重啟累計）
+        self.owner = None  # 持有工作租約的 JobRegistry
+        self.lease_lost = False
+        self.resumed = False
+        self.status = "queued"  # queued → running → done / failed
+        self.counts = {"success": 0, "failed": 0, "skipped": 0, "cancelled": 0}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.result = None
+
+    def count(self, key, n=1):
+        self.counts[key] += n
+
+    async def track(self, player_id, coro):
+        """執行一位玩家的兌換，開始前先記錄開始次數"""
+        self.attempts[player_id] = self.attempts.get(player_id, 0) + 1
+        self.journal.player(self, player_id, "started")
+        return await coro
+
+    def on_result(self, handler):
+        """包裝排程的 on_result：結果處理完才在日誌標記該玩家已完成"""
+        def wrapped(r):
+            handler(r)
+            self.journal.player(self, r["player_id"], "finished")
+        return wrapped
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def to_dict(self):
+        processed = sum(self.counts.values())
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "code": self.code,
+            "status": self.status,
+            "total": self.total,
+            "processed": processed,
+            "remaining": max(0, self.total - processed),
+            "counts": dict(self.counts),
+            "created_at": self.created_at,
+            "elapsed": round(end - (self.started_at or end), 1),
+            "error": self.error,
+            "resumed": self.resumed,
+            "result": self.result
+        }
+
+class JobRegistry:
+    """在 API 的 event loop 上背景執行兌換工作；HTTP 請求只負責建立工作並回傳 job_id
+
+    每個工作在日誌中帶有擁有者與租約，執行期間定期續約；只有租約過期的工作會被其他實例續跑
+    """
+
+    def __init__(self, history=JOB_HISTORY_LIMIT, journal=None, owner=None, lease_seconds=RUN_LEASE_SECONDS):
+        self.history = history
+        self.journal = journal or RunJournal()
+        self.owner = owner or f"{os.getenv('K_REVISION', 'local')}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self._jobs = OrderedDict()
+        self._tasks = set()  # 保留背景 task 的參照，避免被 GC 回收
+        self._watcher = None
+        self.resumed = 0
+        self.lost_leases = 0
+
+    def submit(self, kind, code, total, payload):
+        """建立工作、寫入日誌並在背景執行 / Create, journal and schedule a job"""
+        job = RedeemJob(kind, code, total, payload=payload, journal=self.journal)
+        job.owner = self.owner
+        self._jobs[job.id] = job
+        self._prune()
+        self.journal.start(job, self.lease_seconds)
+        self.start(job, JOB_RUNNERS[kind](payload, job))
+        return job
+
+    def start(self, job, coro):
+        """在背景執行，不等待完成 / Schedule without waiting"""
+        task = asyncio.create_task(self._run(job, coro))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, job, coro):
+        job.status = "running"
+        job.started_at = time.time()
+        work = asyncio.ensure_future(coro)
+        heartbeat = asyncio.create_task(self._heartbeat(job, work))
+        try:
+            job.result = await work
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.finished_at = time.time()
+            if job.lease_lost:
+                # 租約已被其他實例接手：由對方跑完並結案，這裡不寫 finish
+                job.error = "工作租約遺失，已由其他實例接手 / Lease lost to another instance"
+                return
+            # 關機中斷：日誌維持未完成，重啟後續跑
+            job.error = "服務關閉，工作中斷 / Interrupted by shutdown"
+            raise
+        except Exception as e:
+            logger.exception(f"[job {job.id}] 兌換工作失敗 / Job failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            heartbeat.cancel()
+        job.finished_at = time.time()
+        self.journal.finish(job)
+
+    async def _heartbeat(self, job, work):
+        """每 1/3 租約續約一次；租約被他人取走時停止工作，避免同一批玩家被兩個實例重複兌換"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                renewed = await run_blocking(self.journal.renew, job, self.lease_seconds)
+            except Exception as e:
+                logger.warning(f"[job {job.id}] 工作租約續約失敗，稍後再試 / Lease renewal failed: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"[job {job.id}] 工作租約遺失，停止執行 / Lease lost, stopping")
+                self.lost_leases += 1
+                job.lease_lost = True
+                work.cancel()
+                return
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    async def resume(self):
+        """續跑日誌中租約已過期的工作：先取得租約，已完成的玩家不重跑，一再中斷的玩家直接放棄"""
+        try:
+            runs = await run_blocking(self.journal.load)
+        except Exception as e:
+            logger.exception(f"讀取工作日誌失敗，略過續跑 / Failed to load run journal: {e}")
+            return
+        for run in runs:
+            if run["kind"] not in JOB_RUNNERS:
+                continue
+            current = self._jobs.get(run["job_id"])
+            if current and not current.finished:
+                continue
+            try:
+                claimed = await run_blocking(self.journal.claim, run["job_id"], self.owner, self.lease_seconds)
+            except Exception as e:
+                logger.warning(f"[job {run['job_id']}] 取得工作租約失敗，略過 / Failed to claim run: {e}")
+                continue
+            if not claimed:
+                continue  # 其他實例已先接手
+            job = RedeemJob(run["kind"], run["code"], run["total"], payload=run["payload"], journal=self.journal, job_id=run["job_id"])
+            job.owner = self.owner
+            job.resumed = True
+            job.counts.update(run["counts"])
+            job.attempts = {pid: info.get("attempts", 0) for pid, info in run["players"].items()}
+            units = len(run["payload"].get("codes") or [None])  # 多碼工作以「玩家 × 禮包碼」計數
+
+            remaining = []
+            for pid in dict.fromkeys(run["payload"].get("player_ids") or []):
+                info = run["players"].get(pid, {})
+                if info.get("state") in ("finished", "abandoned"):
+                    continue
+                if info.get("attempts", 0) >= RUN_RESUME_MAX_ATTEMPTS:
+                    logger.warning(f"[job {job.id}] {pid} 已開始 {info['attempts']} 次仍未完成，放棄 / Abandoned after repeated interruptions")
+                    job.count("failed", units)
+                    self.journal.player(job, pid, "abandoned")
+                    continue
+                remaining.append(pid)
+
+            self._jobs[job.id] = job
+            self.resumed += 1
+            logger.info(f"[job {job.id}] 續跑未完成的 {job.kind}：剩 {len(remaining)} 位玩家 / Resuming with {len(remaining)} players left")
+            if remaining:
+                self.start(job, JOB_RUNNERS[job.kind]({**run["payload"], "player_ids": remaining}, job))
+            else:
+                job.status = "done"
+                job.finished_at = time.time()
+                self.journal.finish(job)
+
+    def watch(self, interval=None):
+        """定期續跑租約過期的工作（持有者當機或失聯時由存活的實例接手）"""
+        async def loop():
+            while True:
+                await asyncio.sleep(interval or self.lease_seconds)
+                await self.resume()
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(loop())
+        return self._watcher
+
+    async def close(self):
+        if self._watcher:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        interrupted = [job for job in self._jobs.values() if not job.finished and not job.lease_lost]
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for job in interrupted:
+            # 放掉租約，讓下一個實例啟動時立即續跑
+            with contextlib.suppress(Exception):
+                await run_blocking(self.journal.release, job)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        statuses = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "owner": self.owner,
+            "statuses": statuses,
+            "resumed": self.resumed,
+            "lost_leases": self.lost_leases,
+            "journal": self.journal.stats()
+        }
+
+jobs = JobRegistry(journal=run_journal)
+
+# 202 之後工作仍在背景執行：Cloud Run 須設定 CPU 一律分配（--no-cpu-throttling），否則回應後 CPU 會被節流
+def job_accepted_response(job, message, **extra):
+    return web.json_response({
+        "success": True,
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}",
+        "message": message,
+        **extra
+    }, status=202)
+
+# === 資源過濾（所有 context 共用）===
+RESOURCE_FILTER_ENABLED = os.getenv("RESOURCE_FILTER", "on").lower() not in ("0", "off", "false")
+RESOURCE_ALLOW_TYPES = set(t.strip() for t in os.getenv(
+    "RESOURCE_ALLOW_TYPES", "document,script,stylesheet,xhr,fetch"
+).split(",") if t.strip())
+RESOURCE_ALLOW_PATTERNS = [p.strip() for p in os.getenv("RESOURCE_ALLOW_PATTERNS", "/api/").split(",") if p.strip()]
+RESOURCE_BLOCK_PATTERNS = [p.strip() for p in os.getenv(
+    "RESOURCE_BLOCK_PATTERNS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,facebook.net,facebook.com/tr,hotjar.com,sentry.io"
+).split(",") if p.strip()]
+
+class ResourceFilter:
+    """只放行 DOM 與 API 需要的請求：圖片、字型、媒體與追蹤腳本一律擋下，並統計擋下與載入的量"""
+
+    def __init__(self, allow_types=RESOURCE_ALLOW_TYPES, allow_patterns=RESOURCE_ALLOW_PATTERNS,
+                 block_patterns=RESOURCE_BLOCK_PATTERNS):
+        self.allow_types = set(allow_types)
+        self.allow_patterns = list(allow_patterns)
+        self.block_patterns = list(block_patterns)
+        self.allowed = 0
+        self.blocked = {}  # resource_type -> 次數
+        self.loaded_bytes = 0
+
+    def allows(self, url, resource_type):
+        if any(p in url for p in self.block_patterns):
+            return False
+        return resource_type in self.allow_types or any(p in url for p in self.allow_patterns)
+
+    async def _route(self, route):
+        request = route.request
+        if self.allows(request.url, request.resource_type):
+            self.allowed += 1
+            await route.continue_()
+        else:
+            self.blocked[request.resource_type] = self.blocked.get(request.resource_type, 0) + 1
+            await route.abort("blockedbyclient")
+
+    def _on_response(self, response):
+        # 只讀 header，不額外下載內容；沒有 content-length 的回應不計
+        with contextlib.suppress(Exception):
+            self.loaded_bytes += int(response.headers.get("content-length") or 0)
+
+    async def attach(self, context):
+        await context.route("**/*", self._route)
+        context.on("response", self._on_response)
+
+    def stats(self):
+        return {
+            "enabled": RESOURCE_FILTER_ENABLED,
+            "allowed": self.allowed,
+            "blocked": sum(self.blocked.values()),
+            "blocked_by_type": dict(self.blocked),
+            "loaded_bytes": self.loaded_bytes
+        }
+
+resource_filter = ResourceFilter()
+
+# === 共用瀏覽器池 ===
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+BROWSER_MAX_USES = int(os.getenv("BROWSER_MAX_USES", "100"))  # 每個 Chromium 發出幾個 context 後回收重啟
+BROWSER_LAUNCH_ARGS = ["--disable-gpu", "--disable-dev-shm-usage"]
+
+class BrowserPool:
+    """常駐 Chromium 池：每個 worker 程序只啟動一次，每位玩家發一個全新的 BrowserContext"""
+
+    def __init__(self, size=BROWSER_POOL_SIZE, max_uses=BROWSER_MAX_USES):
+        self.size = max(1, size)
+        self.max_uses = max(1, max_uses)
+        self._playwright = None
+        self._browsers = []  # [{"browser", "uses", "active", "retired"}]
+        self._lock = None
+        self.launches = 0
+        self.crashes = 0
+
+    async def _launch(self):
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        browser = await self._playwright.chromium.launch(headless=True, args=BROWSER_LAUNCH_ARGS)
+        slot = {"browser": browser, "uses": 0, "active": 0, "retired": False}
+        browser.on("disconnected", lambda _: self._on_disconnected(slot))
+        self.launches += 1
+        logger.info(f"🚀 已啟動 Chromium（第 {self.launches} 次） / Chromium launched (#{self.launches})")
+        return slot
+
+    def _on_disconnected(self, slot):
+        if slot in self._browsers:
+            self._browsers.remove(slot)
+        if not slot["retired"]:
+            self.crashes += 1
+            logger.warning("⚠️ Chromium 意外斷線，下次取用時自動重啟 / Chromium disconnected, will relaunch on next use")
+
+    async def _checkout(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # 健康檢查：剔除已斷線的瀏覽器，不足則補啟動
+            self._browsers = [s for s in self._browsers if s["browser"].is_connected()]
+            live = [s for s in self._browsers if not s["retired"]]
+            if len(live) < self.size:
+                slot = await self._launch()
+                self._browsers.append(slot)
+                live.append(slot)
+            slot = min(live, key=lambda s: s["active"])
+            slot["uses"] += 1
+            slot["active"] += 1
+            if slot["uses"] >= self.max_uses:
+                slot["retired"] = True  # 用滿次數：不再發出新 context，用完即關閉
+            return slot
+
+    async def _checkin(self, slot):
+        slot["active"] -= 1
+        if slot["retired"] and slot["active"] <= 0:
+            await self._close_browser(slot)
+
+    async def _close_browser(self, slot):
+        slot["retired"] = True
+        if slot in self._browsers:
+            self._browsers.remove(slot)
+        with contextlib.suppress(Exception):
+            await slot["browser"].close()
+
+    async def new_context(self, **kwargs):
+        """取得全新 BrowserContext；瀏覽器崩潰時自動重啟並重試一次"""
+        for attempt in range(2):
+            slot = await self._checkout()
+            try:
+                context = await slot["browser"].new_context(locale="zh-TW", **kwargs)
+                if RESOURCE_FILTER_ENABLED:
+                    try:
+                        await resource_filter.attach(context)
+                    except Exception:
+                        with contextlib.suppress(Exception):
+                            await context.close()
+                        raise
+                return context, slot
+            except Exception as e:
+                await self._checkin(slot)
+                if attempt or slot["browser"].is_connected():
+                    raise
+                logger.warning(f"Chromium 無回應，重啟後重試 / Browser unresponsive, relaunching: {e}")
+
+    async def release(self, context, slot):
+        with contextlib.suppress(Exception):
+            await context.close()
+        await self._checkin(slot)
+
+    @contextlib.asynccontextmanager
+    async def context(self, **kwargs):
+        context, slot = await self.new_context(**kwargs)
+        try:
+            yield context
+        finally:
+            await self.release(context, slot)
+
+    async def close(self):
+        for slot in list(self._browsers):
+            await self._close_browser(slot)
+        if self._playwright:
+            with contextlib.suppress(Exception):
+                await self._playwright.stop()
+            self._playwright = None
+
+    def stats(self):
+        return {
+            "launches": self.launches,
+            "crashes": self.crashes,
+            "browsers": [
+                {"uses": s["uses"], "active": s["active"], "retired": s["retired"]}
+                for s in self._browsers
+            ]
+        }
+
+browser_pool = BrowserPool()
+
+# === 併發設定（頁面池依此決定預熱數量）===
+REDEEM_CONCURRENCY = int(os.getenv("REDEEM_CONCURRENCY", "5"))  # 每個部署可各自調整同時兌換人數
+NAME_LOOKUP_CONCURRENCY = int(os.getenv("NAME_LOOKUP_CONCURRENCY", "3"))
+
+# === 預熱頁面池 ===
+GIFT_CODE_URL = "https://wos-giftcode.centurygame.com/"
+PAGE_POOL_SIZE = int(os.getenv("PAGE_POOL_SIZE", str(REDEEM_CONCURRENCY + NAME_LOOKUP_CONCURRENCY)))
+PAGE_POOL_MAX_IDLE = int(os.getenv("PAGE_POOL_MAX_IDLE", "300"))  # 秒；閒置過久的頁面丟棄重開
+
+class PagePool:
+    """預先載入並停在登入表單的頁面，每頁各自一個全新 context；取用後於背景補滿"""
+
+    def __init__(self, size=PAGE_POOL_SIZE, max_idle=PAGE_POOL_MAX_IDLE):
+        self.size = max(0, size)
+        self.max_idle = max_idle
+        self._ready = None  # asyncio.Queue[{"page", "context", "slot", "ready_at"}]
+        self._warming = 0
+        self._tasks = set()  # 保留背景預熱 task 的參照，避免被 GC 回收
+        self.hits = 0
+        self.misses = 0
+
+    def _queue(self):
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+        return self._ready
+
+    async def _open(self):
+        context, slot = await browser_pool.new_context()
+        try:
+            page = await context.new_page()
+            await page.goto(GIFT_CODE_URL, timeout=PAGE_LOAD_TIMEOUT)
+            await page.wait_for_selector('input[type="text"]', timeout=PAGE_LOAD_TIMEOUT)
+            return {"page": page, "context": context, "slot": slot, "ready_at": time.time()}
+        except Exception:
+            await browser_pool.release(context, slot)
+            raise
+
+    async def _warm_one(self):
+        try:
+            self._queue().put_nowait(await self._open())
+        except Exception as e:
+            logger.warning(f"預熱頁面失敗 / Failed to warm page: {e}")
+        finally:
+            self._warming -= 1
+
+    def refill(self):
+        """在背景補滿預熱頁面 / Top up warm pages in the background"""
+        missing = self.size - self._queue().qsize() - self._warming
+        for _ in range(max(0, missing)):
+            self._warming += 1
+            task = asyncio.create_task(self._warm_one())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _is_fresh(self, entry):
+        return (
+            time.time() - entry["ready_at"] < self.max_idle
+            and entry["slot"]["browser"].is_connected()
+            and not entry["page"].is_closed()
+        )
+
+    async def _take(self):
+        queue = self._queue()
+        while not queue.empty():
+            entry = queue.get_nowait()
+            if self._is_fresh(entry):
+                self.hits += 1
+                return entry
+            await browser_pool.release(entry["context"], entry["slot"])
+        self.misses += 1
+        return await self._open()
+
+    @contextlib.asynccontextmanager
+    async def page(self):
+        """取得一個已在登入表單上的頁面，用完即關閉其 context / Yield a page idle on the login form"""
+        entry = await self._take()
+        self.refill()
+        try:
+            yield entry["page"]
+        finally:
+            await browser_pool.release(entry["context"], entry["slot"])
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        queue = self._queue()
+        while not queue.empty():
+            entry = queue.get_nowait()
+            await browser_pool.release(entry["context"], entry["slot"])
+
+    def stats(self):
+        return {
+            "ready": self._queue().qsize(),
+            "warming": self._warming,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+page_pool = PagePool()
+
+# === 兌換排程（滑動視窗）===
+scheduler_reports = {}  # 最近一次各流程的 slot 使用率，供 /stats 查詢
+
+class SlidingWindowScheduler:
+    """N 個常駐 worker slot 共用一個佇列，任一 slot 空出就立刻開始下一位玩家"""
+
+    def __init__(self, concurrency=REDEEM_CONCURRENCY, name="redeem"):
+        self.concurrency = max(1, concurrency)
+        self.name = name
+        self.slots = [{"slot": i, "jobs": 0, "busy_seconds": 0.0} for i in range(self.concurrency)]
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = []
+        self._queue = None
+
+    async def run(self, items, worker, on_result=None):
+        queue = self._queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+        self.started_at = time.time()
+
+        async def slot_loop(slot):
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                t0 = time.time()
+                try:
+                    result = await worker(item)
+                except Exception as e:
+                    logger.exception(f"[{item}] 排程工作發生例外 / Scheduled task raised: {e}")
+                    result = {"player_id": item, "success": False, "reason": "例外錯誤"}
+                finally:
+                    slot["jobs"] += 1
+                    slot["busy_seconds"] += time.time() - t0
+                if on_result:
+                    ret = on_result(result)
+                    if asyncio.iscoroutine(ret):
+                        await ret
+
+        await asyncio.gather(*(slot_loop(slot) for slot in self.slots))
+        self.finished_at = time.time()
+        self.report()
+
+    def cancel(self):
+        """丟棄尚未開始的項目（進行中的照常完成），回傳被取消的項目"""
+        dropped = []
+        while self._queue is not None and not self._queue.empty():
+            dropped.append(self._queue.get_nowait())
+        self.cancelled.extend(dropped)
+        if dropped:
+            logger.info(f"⛔ [{self.name}] 取消 {len(dropped)} 筆排隊中的工作 / Cancelled queued items")
+        return dropped
+
+    def utilization(self):
+        wall = max((self.finished_at or time.time()) - (self.started_at or time.time()), 1e-6)
+        return [
+            {**slot, "busy_seconds": round(slot["busy_seconds"], 1), "utilization": round(slot["busy_seconds"] / wall, 3)}
+            for slot in self.slots
+        ]
+
+    def report(self):
+        slots = self.utilization()
+        avg = sum(s["utilization"] for s in slots) / len(slots)
+        scheduler_reports[self.name] = {
+            "concurrency": self.concurrency,
+            "avg_utilization": round(avg, 3),
+            "cancelled": len(self.cancelled),
+            "slots": slots
+        }
+        logger.info(f"🧵 [{self.name}] slot 使用率 / Slot utilization：平均 {avg:.0%}，" +
+                    "，".join(f"#{s['slot']} {s['jobs']} 筆 {s['utilization']:.0%}" for s in slots))
+
+# === 自適應速率控制（AIMD）===
+THROTTLE_KEYWORDS = ["伺服器繁忙", "過於頻繁", "請稍後再試"]
+RATE_MIN_CONCURRENCY = int(os.getenv("RATE_MIN_CONCURRENCY", "1"))
+RATE_MIN_INTERVAL = float(os.getenv("RATE_MIN_INTERVAL", "0.2"))  # 兩次兌換開始之間的最短間隔（秒）
+RATE_MAX_INTERVAL = float(os.getenv("RATE_MAX_INTERVAL", "10"))
+RATE_INTERVAL_STEP = 0.1      # 每筆乾淨回應縮短的間隔（秒）
+RATE_DECREASE_FACTOR = 0.5    # 遇節流時併發乘上的倍率
+RATE_DECREASE_COOLDOWN = 5    # 秒；同一波節流訊號只降一次
+
+class AdaptiveRateController:
+    """全程序共用：以網站的節流訊息為背壓，遇到就乘法降低併發與速率，乾淨回應時加法回升"""
+
+    def __init__(self, max_concurrency=REDEEM_CONCURRENCY, min_concurrency=RATE_MIN_CONCURRENCY):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = float(self.max_concurrency)
+        self.interval = RATE_MIN_INTERVAL
+        self.active = 0
+        self.throttle_events = 0
+        self.decreases = 0
+        self._next_start = 0.0
+        self._last_decrease = 0.0
+        self._cond = None
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self):
+        """等到併發名額與速率間隔都允許才開始 / Wait for a concurrency slot and the pacing interval"""
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        try:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+            if start > now:
+                await asyncio.sleep(start - now)
+        except BaseException:
+            # 排隊等間隔時被取消：歸還名額，避免 active 永久少一格
+            await self.release()
+            raise
+
+    async def release(self):
+        cond = self._condition()
+        async with cond:
+            self.active -= 1
+            cond.notify_all()
+
+    def on_throttle(self, player_id=None):
+        self.throttle_events += 1
+        now = time.monotonic()
+        if now - self._last_decrease < RATE_DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self.limit = max(self.min_concurrency, self.limit * RATE_DECREASE_FACTOR)
+        self.interval = min(RATE_MAX_INTERVAL, max(self.interval * 2, 1.0))
+        logger.warning(f"[{player_id}] 🐢 偵測到節流，降速 / Throttled, backing off：併發 {int(self.limit)}，間隔 {self.interval:.1f}s")
+
+    def on_success(self):
+        # 加法回升：約每 limit 筆乾淨回應，併發 +1
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        self.interval = max(RATE_MIN_INTERVAL, self.interval - RATE_INTERVAL_STEP)
+
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "interval": round(self.interval, 2),
+            "active": self.active,
+            "throttle_events": self.throttle_events,
+            "decreases": self.decreases
+        }
+
+rate_controller = AdaptiveRateController()
+
+# === 兌換結果批次寫入 ===
+RESULT_FLUSH_SIZE = int(os.getenv("RESULT_FLUSH_SIZE", "50"))            # 累積幾筆就送出
+RESULT_FLUSH_INTERVAL = float(os.getenv("RESULT_FLUSH_INTERVAL", "3"))   # 最久幾秒送出一次
+RESULT_RETRY_MAX_DELAY = float(os.getenv("RESULT_RETRY_MAX_DELAY", "60"))  # 寫入失敗後重試間隔上限（秒）
+FIRESTORE_BATCH_LIMIT = 500  # Firestore WriteBatch 單次上限
+
+class RedeemResultSink:
+    """緩衝 success_redeems / failed_redeems 的寫入，達筆數或時間門檻時以 WriteBatch 在背景執行緒送出"""
+
+    def __init__(self, flush_size=RESULT_FLUSH_SIZE, flush_interval=RESULT_FLUSH_INTERVAL):
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        self._pending = []  # [(op, ref, data)]
+        self._lock = threading.Lock()
+        self._timer = None
+        self._tasks = set()  # 保留背景送出 task 的參照，避免被 GC 回收
+        self._failures = 0  # 連續寫入失敗次數，決定重試退避
+        self.flushes = 0
+        self.writes = 0
+        self.failed_flushes = 0
+
+    def record_success(self, code, player_id, message):
+        self._add("set", db.collection("success_redeems").document(code).collection("players").document(player_id), {
+            "message": message,
+            "timestamp": datetime.utcnow()
+        })
+
+    def record_failed(self, code, player_id, name, reason):
+        self._add("set", db.collection("failed_redeems").document(code).collection("players").document(player_id), {
+            "name": name,
+            "reason": reason,
+            "updated_at": datetime.utcnow()
+        })
+
+    def clear_failed(self, code, player_id):
+        self._add("delete", db.collection("failed_redeems").document(code).collection("players").document(player_id))
+
+    def merge(self, ref, data):
+        """以 merge 方式寫入任意文件（工作日誌等），與兌換結果同批送出"""
+        self._add("merge", ref, data)
+
+    def record_code_status(self, code, status, reason):
+        self._add("set", db.collection(GIFTCODE_STATUS_COLLECTION).document(code), {
+            "status": status,
+            "reason": reason,
+            "updated_at": datetime.utcnow()
+        })
+
+    def _add(self, op, ref, data=None):
+        with self._lock:
+            self._pending.append((op, ref, data))
+            size = len(self._pending)
+        if size >= self.flush_size:
+            self._spawn_flush()
+        else:
+            self._arm(self.flush_interval)
+
+    def _arm(self, delay):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(delay, self._spawn_flush)
+
+    def _spawn_flush(self):
+        task = asyncio.get_running_loop().create_task(self._background_flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _background_flush(self):
+        with contextlib.suppress(Exception):  # 失敗已記錄並排定重試
+            await self.flush()
+
+    def _take(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        with self._lock:
+            ops, self._pending = self._pending, []
+        return ops
+
+    def _commit(self, ops):
+        for i in range(0, len(ops), FIRESTORE_BATCH_LIMIT):
+            chunk = ops[i:i + FIRESTORE_BATCH_LIMIT]
+            batch = db.batch()
+            for op, ref, data in chunk:
+                if op == "set":
+                    batch.set(ref, data)
+                elif op == "merge":
+                    batch.set(ref, data, merge=True)
+                else:
+                    batch.delete(ref)
+            try:
+                batch.commit()
+                self.flushes += 1
+                self.writes += len(chunk)
+            except Exception as e:
+                logger.exception(f"批次寫入失敗，保留至下次送出 / Batch write failed, re-queued: {e}")
+                self.failed_flushes += 1
+                with self._lock:
+                    self._pending[:0] = ops[i:]
+                raise
+
+    async def flush(self):
+        """送出目前緩衝的所有結果；寫入失敗時排定退避重試並拋出例外 / Commit everything buffered so far"""
+        ops = self._take()
+        if not ops:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._commit, ops)
+        except Exception:
+            self._failures += 1
+            delay = min(RESULT_RETRY_MAX_DELAY, self.flush_interval * 2 ** self._failures)
+            logger.warning(f"{len(self._pending)} 筆結果尚未寫入，{delay:.1f} 秒後重試 / Retrying unsaved results in {delay:.1f}s")
+            self._arm(delay)
+            raise
+        self._failures = 0
+
+    def flush_sync(self, attempts=3):
+        """關機時同步送出，避免結果遺失 / Synchronous flush used on shutdown"""
+        for attempt in range(attempts):
+            with self._lock:
+                ops, self._pending = self._pending, []
+            if not ops:
+                return
+            logger.info(f"關機前寫入 {len(ops)} 筆兌換結果 / Flushing {len(ops)} results before shutdown")
+            try:
+                self._commit(ops)
+                return
+            except Exception:
+                time.sleep(min(RESULT_RETRY_MAX_DELAY, self.flush_interval * 2 ** attempt))
+        logger.error(f"❌ 關機前仍有 {len(self._pending)} 筆結果無法寫入 / {len(self._pending)} results lost on shutdown")
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "writes": self.writes,
+            "failed_flushes": self.failed_flushes
+        }
+
+result_sink = RedeemResultSink()
+atexit.register(result_sink.flush_sync)
+
+async def flush_results():
+    """送出緩衝結果；回傳仍未寫入的筆數（0 表示全部已存檔）/ Returns how many results are still unsaved"""
+    try:
+        await result_sink.flush()
+        return 0
+    except Exception:
+        return len(result_sink._pending)
+
+def unsaved_results_note(unsaved):
+    return (
+        f"⚠️ 有 {unsaved} 筆結果尚未寫入資料庫，背景自動重試中\n"
+        f"{unsaved} results are not saved yet, retrying in background\n\n"
+    )
+
+# === 玩家名稱快取 ===
+NAME_CACHE_TTL = int(os.getenv("NAME_CACHE_TTL", "3600"))          # 秒
+NAME_CACHE_MAX_SIZE = int(os.getenv("NAME_CACHE_MAX_SIZE", "5000"))
+
+class PlayerNameDirectory:
+    """程序內的玩家名稱快取（TTL + LRU）：每場兌換開始時批次暖機一次，之後查名稱不再讀 Firestore"""
+
+    def __init__(self, ttl=NAME_CACHE_TTL, max_size=NAME_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self._entries = OrderedDict()  # pid -> (name, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, pid, name):
+        if not name:
+            return
+        with self._lock:
+            self._entries[pid] = (name, time.time() + self.ttl)
+            self._entries.move_to_end(pid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def put_many(self, names):
+        for pid, name in names.items():
+            self.put(pid, name)
+
+    def peek(self, pid):
+        with self._lock:
+            entry = self._entries.get(pid)
+            if entry is None:
+                self.misses += 1
+                return None
+            name, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[pid]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(pid)
+            self.hits += 1
+            return name
+
+    def get(self, pid, default="未知名稱"):
+        return self.peek(pid) or default
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+name_directory = PlayerNameDirectory()
+
+# === 玩家名稱查詢服務 ===
+class PlayerLookupService:
+    """統一的角色名稱查詢：整批 ID 透過共用頁面池併發登入查名，合併重複的進行中查詢，查到一筆就先交出一筆"""
+
+    def __init__(self, concurrency=NAME_LOOKUP_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self._inflight = {}  # pid -> Task
+        self._semaphore = None
+        self.lookups = 0
+        self.coalesced = 0
+        self.page_errors = 0
+
+    async def _scrape(self, pid):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            self.lookups += 1
+            name = "未知名稱"
+            try:
+                async with page_pool.page() as page:
+                    for attempt in range(3):
+                        try:
+                            if attempt:
+                                await page.goto(GIFT_CODE_URL)
+                            await page.fill('input[type="text"]', pid)
+                            await page.click(".login_btn")
+                            await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
+                            await page.wait_for_selector(".name", timeout=5000)
+                            name_el = await page.query_selector(".name")
+                            name = await name_el.inner_text() if name_el else "未知名稱"
+                            break
+                        except:
+                            await page.wait_for_timeout(1000 + attempt * 500)
+            except Exception as e:
+                # 開頁失敗（瀏覽器崩潰、載入逾時）只影響這一筆，不中斷整批查詢
+                self.page_errors += 1
+                logger.warning(f"[{pid}] 無法取得查詢頁面 / Could not open a page for name lookup: {e}")
+        if name != "未知名稱":
+            name_directory.put(pid, name)
+        return name
+
+    def _task(self, pid):
+        task = self._inflight.get(pid)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        task = asyncio.ensure_future(self._scrape(pid))
+        self._inflight[pid] = task
+        task.add_done_callback(lambda _: self._inflight.pop(pid, None))
+        return task
+
+    async def lookup(self, pid):
+        """查詢單一玩家名稱，失敗回傳「未知名稱」 / Look up one player name"""
+        # shield：呼叫端取消時不影響其他等待同一筆的呼叫端
+        return await asyncio.shield(self._task(pid))
+
+    async def iter_names(self, player_ids):
+        """依完成順序逐筆產出 (pid, name) / Yield (pid, name) as each lookup finishes"""
+        async def named(pid):
+            return pid, await self.lookup(pid)
+
+        for next_done in asyncio.as_completed([named(pid) for pid in dict.fromkeys(player_ids)]):
+            yield await next_done
+
+    async def lookup_many(self, player_ids):
+        return {pid: name async for pid, name in self.iter_names(player_ids)}
+
+    def stats(self):
+        return {
+            "inflight": len(self._inflight),
+            "lookups": self.lookups,
+            "coalesced": self.coalesced,
+            "page_errors": self.page_errors
+        }
+
+player_lookup = PlayerLookupService()
+
+# === 玩家資料預查 ===
+FIRESTORE_GET_ALL_CHUNK = 100
+
+def _get_all_docs(refs):
+    snapshots = []
+    for i in range(0, len(refs), FIRESTORE_GET_ALL_CHUNK):
+        snapshots.extend(db.get_all(refs[i:i + FIRESTORE_GET_ALL_CHUNK]))
+    return snapshots
+
+async def ensure_players_registered(player_ids):
+    """批次讀取 ids/global/players，只對缺少的 ID 併發查名稱並寫回；回傳 {pid: 文件內容}"""
+    loop = asyncio.get_running_loop()
+    unique_ids = list(dict.fromkeys(player_ids))
+    players_ref = db.collection("ids").document("global").collection("players")
+    snapshots = await loop.run_in_executor(None, _get_all_docs, [players_ref.document(pid) for pid in unique_ids])
+    existing = {snap.id: snap.to_dict() for snap in snapshots if snap.exists}
+    name_directory.put_many({pid: doc.get("name") for pid, doc in existing.items()})
+
+    missing = [pid for pid in unique_ids if pid not in existing]
+    if not missing:
+        return existing
+
+    found = list((await player_lookup.lookup_many(missing)).items())
+
+    def write_missing():
+        for i in range(0, len(found), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+            for pid, name in found[i:i + FIRESTORE_BATCH_LIMIT]:
+                batch.set(players_ref.document(pid), {"name": name, "updated_at": datetime.utcnow()}, merge=True)
+            batch.commit()
+
+    await loop.run_in_executor(None, write_missing)
+    for pid, name in found:
+        existing[pid] = {"name": name}
+        logger.info(f"[{pid}] 📌 已自動新增至資料庫：{name} / Auto-added to database: {name}")
+    return existing
+
+# === 禮包碼熔斷（碼本身無效時提早中止）===
+GIFTCODE_STATUS_COLLECTION = "giftcode_status"
+CODE_LEVEL_FAILURES = {"超出兌換時間": "expired", "兌換碼不存在": "invalid"}  # modal / API 原因片段 → 碼狀態
+CODE_BREAKER_THRESHOLD = int(os.getenv("CODE_BREAKER_THRESHOLD", "3"))  # 連續幾位玩家回報碼無效就熔斷
+
+def code_level_failure(reason):
+    """原因屬於「碼本身無效」時回傳碼狀態（expired / invalid），否則 None"""
+    return next((status for key, status in CODE_LEVEL_FAILURES.items() if key in (reason or "")), None)
+
+def redeemed_player_ids(code):
+    """success_redeems/{code} 下已成功或已領取的玩家 ID"""
+    return {doc.id for doc in db.collection("success_redeems").document(code).collection("players").stream()}
+
+def get_rejected_code_status(code):
+    """讀取 giftcode_status/{code}；已判定失效時回傳文件內容，否則 None"""
+    doc = db.collection(GIFTCODE_STATUS_COLLECTION).document(code).get()
+    info = doc.to_dict() if doc.exists else None
+    return info if info and info.get("status") in CODE_LEVEL_FAILURES.values() else None
+
+def rejected_code_response(code, info):
+    return web.json_response({
+        "success": False,
+        "code_status": info.get("status"),
+        "reason": f"禮包碼 {code} 已判定失效（{info.get('reason')}），不再兌換；如需強制執行請帶 force / Code rejected as {info.get('status')}"
+    }, status=409)
+
+class GiftcodeCircuitBreaker:
+    """同一禮包碼連續幾位玩家都回報碼無效時熔斷：記錄碼狀態並取消排隊中的玩家
+
+    「超出兌換時間」不論之前是否有人成功都會熔斷（碼可能在兌換途中過期）；
+    「兌換碼不存在」只在尚無任何成功或已領取時熔斷，避免個別誤判擋掉有效的碼
+    """
+
+    def __init__(self, code, total, threshold=CODE_BREAKER_THRESHOLD, on_trip=None):
+        self.code = code
+        self.threshold = max(1, min(threshold, total))  # 人數少於門檻時，全員無效即熔斷
+        self.on_trip = on_trip
+        self.streak = 0
+        self.valid_seen = False
+        self.status = None
+        self.reason = None
+
+    @property
+    def tripped(self):
+        return self.status is not None
+
+    def observe(self, result):
+        """回報一位玩家的結果；已熔斷且屬於碼層級失敗時回傳 True（碼狀態已記錄，呼叫端不必逐人寫入）"""
+        reason = result.get("reason") or ""
+        status = code_level_failure(reason)
+        if result.get("success") or "您已領取過該禮物" in reason:
+            self.valid_seen = True  # 有人成功或已領取，代表碼本身有效
+            self.streak = 0
+        elif status:
+            self.streak += 1
+            if (
+                not self.tripped
+                and self.streak >= self.threshold
+                and (status == "expired" or not self.valid_seen)
+            ):
+                self.trip(status, reason)
+        return self.tripped and status is not None
+
+    def trip(self, status, reason):
+        self.status, self.reason = status, reason
+        logger.warning(f"⛔ 禮包碼 {self.code} 判定失效（{reason}），停止其餘兌換 / Code {self.code} rejected as {status}")
+        result_sink.record_code_status(self.code, status, reason)
+        if self.on_trip:
+            self.on_trip()
+
+    def webhook_note(self, cancelled):
+        return code_rejected_note(self.status, self.reason, cancelled) if self.tripped else ""
+
+def code_rejected_note(status, reason, cancelled):
+    return (
+        f"⛔ 禮包碼失效：{reason}，已取消其餘 {cancelled} 位\n"
+        f"Code rejected ({status}), cancelled {cancelled} remaining players\n\n"
+    )
+
 # === 主流程 ===
-async def process_redeem(payload):
+async def post_redeem_webhook(content):
+    if not os.getenv("DISCORD_WEBHOOK_URL"):
+        logger.warning("DISCORD_WEBHOOK_URL 未設定，跳過 webhook 發送")
+        return
+    try:
+        resp = await run_blocking(requests.post, os.getenv("DISCORD_WEBHOOK_URL"), json={"content": content})
+        logger.info(f"Webhook 發送結果：{resp.status_code} {resp.text}")
+    except Exception as e:
+        logger.warning(f"Webhook 發送失敗：{e}")
+
+def empty_redeem_summary():
+    return {
+        "pending": 0, "success": 0, "failed": [], "final_failed": [], "skipped": 0, "cancelled": 0,
+        "code_status": None, "code_reason": None, "unsaved": 0
+    }
+
+async def redeem_code_for_players(code, player_ids, debug=False, engine=None, job=None, scheduler_name="redeem_submit"):
+    """一個禮包碼兌換給一批玩家（不發 webhook），回傳可 JSON 序列化的摘要；單機兌換與分片共用"""
+    job = job or RedeemJob("redeem_submit", code, len(player_ids))
+    summary = empty_redeem_summary()
+
+    # 先查 Firestore 並補全缺失 ID
+    await ensure_players_registered(player_ids)
+
+    # ✅ 濾除已兌換成功或已領取過的 ID（避免浪費 2Captcha）
+    already_redeemed_ids = await run_blocking(redeemed_player_ids, code)
+
+    filtered_player_ids = [pid for pid in player_ids if pid not in already_redeemed_ids]
+    logger.info(f"⏩ 已跳過 {len(already_redeemed_ids)} 筆已成功或已領取的 ID（共輸入 {len(player_ids)} 筆）")
+    summary["skipped"] = len(player_ids) - len(filtered_player_ids)
+    summary["pending"] = len(filtered_player_ids)
+    job.count("skipped", summary["skipped"])
+
+    # 防呆檢查，確保過濾邏輯正確
+    if debug:
+        for pid in filtered_player_ids:
+            assert pid not in already_redeemed_ids, f"過濾失敗，{pid} 應已在 success_redeems 中"
+
+    if not filtered_player_ids:
+        logger.info("🎉 所有 ID 皆已兌換成功或已領取過，無需再處理")
+        return summary
+
+    scheduler = SlidingWindowScheduler(name=scheduler_name)
+    breaker = GiftcodeCircuitBreaker(code, len(filtered_player_ids), on_trip=scheduler.cancel)
+
+    # 開始兌換處理：滑動視窗排程，任一 slot 完成即接手下一位
+    def handle_result(r):
+        if breaker.observe(r):
+            # 已熔斷：碼本身無效，不逐人寫入，碼狀態由熔斷器記錄
+            job.count("failed")
+            summary["failed"].append({"player_id": r.get("player_id"), "reason": r.get("reason")})
+            return
+        if r.get("success"):
+            job.count("success")
+            summary["success"] += 1
+            logger.info(f"[{r['player_id']}] ✅ 成功：{r.get('message')}")
+            # ✅ 寫入成功記錄（避免下次重複送出）
+            result_sink.record_success(code, r["player_id"], r.get("message"))
+        else:
+            if any(msg in (r.get("reason") or "") for msg in ["您已領取過該禮物", "超出兌換時間"]):
+                job.count("success")
+                result_sink.record_success(code, r["player_id"], r.get("reason"))
+                result_sink.clear_failed(code, r["player_id"])
+                logger.info(f"[{r['player_id']}] {r.get('reason')} → 記錄 success 並移除 failed_redeems / Marked as success and removed from failed_redeems")
+                return
+
+            job.count("failed")
+            summary["failed"].append({"player_id": r.get("player_id"), "reason": r.get("reason")})
+            logger.warning(f"[{r['player_id']}] ❌ 失敗：{r.get('reason')}")
+
+            if "驗證碼三次辨識皆失敗" in (r.get("reason") or ""):
+                name = name_directory.get(r["player_id"], "未知")
+                summary["final_failed"].append(f"{r['player_id']} ({name})")
+
+        if r.get("reason") in ["驗證碼三次辨識皆失敗", "Timeout：單人兌換超過 90 秒"]:
+            name = name_directory.get(r["player_id"], "未知")
+            result_sink.record_failed(code, r["player_id"], name, r.get("reason"))
+
+    await scheduler.run(
+        filtered_player_ids,
+        lambda pid: job.track(pid, run_redeem_with_retry(pid, code, debug=debug, engine=engine)),
+        on_result=job.on_result(handle_result)
+    )
+    job.count("cancelled", len(scheduler.cancelled))
+    summary["cancelled"] = len(scheduler.cancelled)
+    summary["code_status"], summary["code_reason"] = breaker.status, breaker.reason
+    summary["unsaved"] = await flush_results()
+    return summary
+
+def submit_webhook_message(code, summary, duration, shards=None):
+    if not summary["pending"]:
+        return f"🎉 所有 ID 皆已兌換成功或已領取過，無需再處理\n禮包碼：{code}"
+
+    webhook_message = (
+        f"🎁 兌換完成 / Redemption Completed\n"
+        f"🎟️ 禮包碼 / Giftcode：{code}\n"
+    )
+    if shards:
+        webhook_message += f"🧩 分片 / Shards：{shards}\n"
+    webhook_message += (
+        f"📊 統計 Summary：\n"
+        f"✅ 成功筆數 / Success：{summary['success']}\n"
+        f"❌ 失敗筆數 / Failed：{len(summary['failed'])}\n"
+        f"⏩ 跳過人數 / Skipped：{summary['skipped']}\n\n"
+    )
+    if summary["unsaved"]:
+        webhook_message += unsaved_results_note(summary["unsaved"])
+    if summary["code_status"]:
+        webhook_message += code_rejected_note(summary["code_status"], summary["code_reason"], summary["cancelled"])
+    if summary["final_failed"]:
+        webhook_message += "⚠️ 三次辨識失敗的 ID（請改用/retry_failed）：\n" + "\n".join(summary["final_failed"])
+    else:
+        webhook_message += "✅ 無任何 ID 出現三次辨識失敗 / No ID failed 3 times"
+
+    webhook_message += f"\n⌛ 執行時間：約 {duration:.1f} 秒\n"
+    webhook_message += f"Duration: approx. {duration:.1f} seconds"
+    return webhook_message
+
+async def process_submit(payload, job=None):
+    start_time = time.time()
+    code = payload.get("code")
+    player_ids = payload.get("player_ids")
+    job = job or RedeemJob("redeem_submit", code, len(player_ids))
+
+    summary = await redeem_code_for_players(
+        code, player_ids, debug=payload.get("debug", False), engine=payload.get("engine"), job=job
+    )
+    await post_redeem_webhook(submit_webhook_message(code, summary, time.time() - start_time))
+    return {"code_status": summary["code_status"], "unsaved": summary["unsaved"]}
+
+async def process_redeem(payload, job=None):
     start_time = time.time()
     code = payload.get("code")
     player_ids = payload.get("player_ids")
     debug = payload.get("debug", False)
+    engine = payload.get("engine")
+    job = job or RedeemJob("retry_failed", code, len(player_ids))
 
-    MAX_BATCH_SIZE = 5
     all_success = []
     all_fail = []
 
-    async def fetch_and_store_name(pid):
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context(locale="zh-TW")
-            page = await context.new_page()
-            name = "未知名稱"
-            for attempt in range(3):
-                try:
-                    await page.goto("https://wos-giftcode.centurygame.com/")
-                    await page.fill('input[type="text"]', pid)
-                    await page.click(".login_btn")
-                    await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
-                    await page.wait_for_selector(".name", timeout=5000)
-                    name_el = await page.query_selector(".name")
-                    name = await name_el.inner_text() if name_el else "未知名稱"
-                    break
-                except:
-                    await page.wait_for_timeout(1000 + attempt * 500)
-            await browser.close()
-            return name
-
     # 查缺 ID 並補上
-    doc_ref_base = db.collection("ids")
-    loop = asyncio.get_event_loop()
-    for pid in player_ids:
-        doc_ref = doc_ref_base.document("global").collection("players").document(pid)
-        if not doc_ref.get().exists:
-            name = loop.run_until_complete(fetch_and_store_name(pid))
-            doc_ref.set({
-                "name": name,
-                "updated_at": datetime.utcnow()
-            }, merge=True)
-            logger.info(f"[{pid}] 📌 已自動新增至資料庫：{name} / Auto-added to database: {name}")
+    await ensure_players_registered(player_ids)
 
     # 排除已成功或已領取的
-    success_docs = db.collection("success_redeems").document(code).collection("players").stream()
-    already_redeemed_ids = {doc.id for doc in success_docs}
+    already_redeemed_ids = await run_blocking(redeemed_player_ids, code)
     filtered_player_ids = [pid for pid in player_ids if pid not in already_redeemed_ids]
 
     logger.info(f"⏩ 已跳過 {len(already_redeemed_ids)} 筆已成功或已領取的 ID（共輸入 {len(player_ids)} 筆）")
+    job.count("skipped", len(player_ids) - len(filtered_player_ids))
 
     if debug:
         for pid in filtered_player_ids:
@@ -130,7 +1576,7 @@ async def process_redeem(payload):
         logger.info("🎉 所有 ID 皆已兌換成功或已領取過，無需再處理")
         if os.getenv("DISCORD_WEBHOOK_URL"):
             try:
-                resp = requests.post(os.getenv("DISCORD_WEBHOOK_URL"), json={
+                resp = await run_blocking(requests.post, os.getenv("DISCORD_WEBHOOK_URL"), json={
                     "content": f"🎉 所有 ID 皆已兌換成功或已領取過，無需再處理\n禮包碼：{code}"
                 })
                 logger.info(f"Webhook 發送結果：{resp.status_code} {resp.text}")
@@ -138,41 +1584,42 @@ async def process_redeem(payload):
                 logger.warning(f"Webhook 發送失敗：{e}")
         return
 
-    # 執行兌換流程
-    for i in range(0, len(filtered_player_ids), MAX_BATCH_SIZE):
-        batch = filtered_player_ids[i:i + MAX_BATCH_SIZE]
-        tasks = [run_redeem_with_retry(pid, code, debug=debug) for pid in batch]
-        results = await asyncio.gather(*tasks)
-        await asyncio.sleep(1)
-
-        for r in results:
-            if r.get("success"):
-                all_success.append(r)
-                db.collection("success_redeems").document(code).collection("players").document(r["player_id"]).set({
-                    "message": r.get("message"),
-                    "timestamp": datetime.utcnow()
-                })
-            else:
-                if any(msg in (r.get("reason") or "") for msg in ["您已領取過該禮物", "超出兌換時間"]):
-                    db.collection("success_redeems").document(code).collection("players").document(r["player_id"]).set({
-                        "message": r.get("reason"),
-                        "timestamp": datetime.utcnow()
-                    })
-                    db.collection("failed_redeems").document(code).collection("players").document(r["player_id"]).delete()
-                    logger.info(f"[{r['player_id']}] {r.get('reason')} → 記錄 success 並移除 failed_redeems / Marked as success and removed from failed_redeems")
-                    continue
-
-                all_fail.append(r)
-                logger.warning(f"[{r['player_id']}] ❌ 失敗：{r.get('reason')}")
+    scheduler = SlidingWindowScheduler(name="retry_failed")
+    breaker = GiftcodeCircuitBreaker(code, len(filtered_player_ids), on_trip=scheduler.cancel)
 
-                if r.get("reason") in ["驗證碼三次辨識皆失敗", "Timeout：單人兌換超過 90 秒"]:
-                    doc = doc_ref_base.document("global").collection("players").document(r["player_id"]).get()
-                    name = doc.to_dict().get("name", "未知") if doc.exists else "未知"
-                    db.collection("failed_redeems").document(code).collection("players").document(r["player_id"]).set({
-                        "name": name,
-                        "reason": r.get("reason"),
-                        "updated_at": datetime.utcnow()
-                    })
+    # 執行兌換流程：結果一到就處理，不等同批其他玩家
+    def handle_result(r):
+        if breaker.observe(r):
+            job.count("failed")
+            all_fail.append(r)  # 已熔斷：碼本身無效，不逐人寫入，碼狀態由熔斷器記錄
+            return
+        if r.get("success"):
+            job.count("success")
+            all_success.append(r)
+            result_sink.record_success(code, r["player_id"], r.get("message"))
+        else:
+            if any(msg in (r.get("reason") or "") for msg in ["您已領取過該禮物", "超出兌換時間"]):
+                job.count("success")
+                result_sink.record_success(code, r["player_id"], r.get("reason"))
+                result_sink.clear_failed(code, r["player_id"])
+                logger.info(f"[{r['player_id']}] {r.get('reason')} → 記錄 success 並移除 failed_redeems / Marked as success and removed from failed_redeems")
+                return
+
+            job.count("failed")
+            all_fail.append(r)
+            logger.warning(f"[{r['player_id']}] ❌ 失敗：{r.get('reason')}")
+
+            if r.get("reason") in ["驗證碼三次辨識皆失敗", "Timeout：單人兌換超過 90 秒"]:
+                name = name_directory.get(r["player_id"], "未知")
+                result_sink.record_failed(code, r["player_id"], name, r.get("reason"))
+
+    await scheduler.run(
+        filtered_player_ids,
+        lambda pid: job.track(pid, run_redeem_with_retry(pid, code, debug=debug, engine=engine)),
+        on_result=job.on_result(handle_result)
+    )
+    job.count("cancelled", len(scheduler.cancelled))
+    unsaved = await flush_results()
 
     # webhook 結果整理（只列出失敗者）
     duration = time.time() - start_time
@@ -185,200 +1632,933 @@ async def process_redeem(payload):
         f"❌ 失敗筆數 / Failed：{len(all_fail)}\n"
         f"⏩ 跳過人數 / Skipped：{skipped_count}\n\n"
     )
+    if unsaved:
+        webhook_message += unsaved_results_note(unsaved)
+    webhook_message += breaker.webhook_note(len(scheduler.cancelled))
+
+    if all_fail and not breaker.tripped:
+        webhook_message += "⚠️ 重試仍失敗的 ID：\n"
+        webhook_message += "Failed IDs:\n"
+        for r in all_fail:
+            pid = r["player_id"]
+            name = name_directory.get(pid)
+            webhook_message += f"- {pid} ({name})\n"
+
+    webhook_message += f"\n⌛ 執行時間：約 {duration:.1f} 秒\n"
+    webhook_message += f"Duration: approx. {duration:.1f} seconds"
+
+    if os.getenv("DISCORD_WEBHOOK_URL"):
+        try:
+            resp = await run_blocking(requests.post, os.getenv("DISCORD_WEBHOOK_URL"), json={"content": webhook_message})
+            logger.info(f"Webhook 發送結果：{resp.status_code} {resp.text}")
+        except Exception as e:
+            logger.warning(f"Webhook 發送失敗：{e}")
+
+    return {"code_status": breaker.status, "unsaved": unsaved}
+
+async def process_multi_redeem(codes, player_ids, debug=False, engine=None, job=None):
+    """多個禮包碼：每位玩家登入一次兌換所有尚未成功的碼，結果依碼分別寫入 success_redeems / failed_redeems
+
+    job 的進度以「玩家 × 禮包碼」為單位計數
+    """
+    start_time = time.time()
+    job = job or RedeemJob("redeem_multi", ",".join(codes), len(codes) * len(set(player_ids)))
+    await ensure_players_registered(player_ids)
+
+    redeemed = {code: await run_blocking(redeemed_player_ids, code) for code in codes}
+    pending = {}
+    for pid in dict.fromkeys(player_ids):
+        todo = [code for code in codes if pid not in redeemed[code]]
+        if todo:
+            pending[pid] = todo
+    summary = {
+        code: {"success": 0, "failed": [], "skipped": len(redeemed[code] & set(player_ids))}
+        for code in codes
+    }
+    logger.info(f"[redeem_multi] {len(codes)} 個禮包碼、{len(pending)} 位玩家需登入（共輸入 {len(player_ids)} 位）")
+    job.count("skipped", sum(entry["skipped"] for entry in summary.values()))
+    breakers = {
+        code: GiftcodeCircuitBreaker(code, sum(code in todo for todo in pending.values()))
+        for code in codes
+    }
+
+    def handle_result(r):
+        pid = r["player_id"]
+        # 排程例外時只有單一失敗結果，套用到該玩家所有待兌換的碼
+        results = r["results"] if "results" in r else dict.fromkeys(pending[pid], r)
+        for code, result in results.items():
+            reason = result.get("reason") or ""
+            if breakers[code].observe(result):
+                job.count("failed")
+                summary[code]["failed"].append({"player_id": pid, "reason": reason})
+            elif result.get("success"):
+                job.count("success")
+                result_sink.record_success(code, pid, result.get("message"))
+                summary[code]["success"] += 1
+            elif any(msg in reason for msg in ["您已領取過該禮物", "超出兌換時間"]):
+                job.count("success")
+                result_sink.record_success(code, pid, reason)
+                result_sink.clear_failed(code, pid)
+                summary[code]["success"] += 1
+            else:
+                job.count("failed")
+                summary[code]["failed"].append({"player_id": pid, "reason": reason})
+                if reason.startswith(("驗證碼三次辨識皆失敗", "Timeout：", "例外錯誤")):
+                    result_sink.record_failed(code, pid, name_directory.get(pid, "未知"), reason)
+
+    async def redeem_player(pid):
+        # 已熔斷的碼直接略過，不再登入兌換
+        todo = [code for code in pending[pid] if not breakers[code].tripped]
+        for code in set(pending[pid]) - set(todo):
+            job.count("cancelled")
+            summary[code]["cancelled"] = summary[code].get("cancelled", 0) + 1
+        if not todo:
+            return {"player_id": pid, "results": {}}
+        return {"player_id": pid, "results": await run_codes_with_retry(pid, todo, debug=debug, engine=engine)}
+
+    if pending:
+        scheduler = SlidingWindowScheduler(name="redeem_multi")
+        await scheduler.run(
+            list(pending),
+            lambda pid: job.track(pid, redeem_player(pid)),
+            on_result=job.on_result(handle_result)
+        )
+    unsaved = await flush_results()
+
+    duration = time.time() - start_time
+    webhook_message = (
+        f"🎁 多碼兌換完成 / Multi-code Redemption Completed\n"
+        f"👥 登入人數 / Logins：{len(pending)}\n\n"
+    )
+    for code, entry in summary.items():
+        webhook_message += (
+            f"🎟️ {code}：✅ {entry['success']}　❌ {len(entry['failed'])}　⏩ {entry['skipped']}\n"
+        )
+        if breakers[code].tripped:
+            entry["code_status"] = breakers[code].status
+            webhook_message += (
+                f"　⛔ 已判定失效 / Rejected：{breakers[code].reason}，取消 {entry.get('cancelled', 0)} 位\n"
+            )
+    if unsaved:
+        webhook_message += "\n" + unsaved_results_note(unsaved)
+    webhook_message += f"\n⌛ 執行時間：約 {duration:.1f} 秒\nDuration: approx. {duration:.1f} seconds"
+
+    if os.getenv("DISCORD_WEBHOOK_URL"):
+        try:
+            resp = await run_blocking(requests.post, os.getenv("DISCORD_WEBHOOK_URL"), json={"content": webhook_message})
+            logger.info(f"Webhook 發送結果：{resp.status_code} {resp.text}")
+        except Exception as e:
+            logger.warning(f"Webhook 發送失敗：{e}")
+
+    return summary
+
+# === 分片兌換（一個工作分給多個實例）===
+SHARD_FANOUT = os.getenv("SHARD_FANOUT", "off").lower() in ("1", "on", "true")  # 名單超過一個分片時自動分片
+SHARD_STORE = os.getenv("SHARD_STORE", "firestore").lower()         # firestore / local（單一程序內的替身）
+SHARD_COLLECTION = "redeem_shards"
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", "50"))                      # 每個分片幾位玩家
+SHARD_LEASE_SECONDS = float(os.getenv("SHARD_LEASE_SECONDS", "120"))  # 租約長度；worker 每 1/3 租約續約一次
+SHARD_POLL_INTERVAL = float(os.getenv("SHARD_POLL_INTERVAL", "5"))   # 協調者檢查分片進度的間隔
+SHARD_MAX_CLAIMS = int(os.getenv("SHARD_MAX_CLAIMS", "3"))           # 同一分片被領取幾次仍未完成就放棄
+SHARD_WAKE_URL = os.getenv("SHARD_WAKE_URL", "")                     # 服務自己的網址；建立分片後以請求喚醒其他實例
+SHARD_MAX_WAKE = int(os.getenv("SHARD_MAX_WAKE", "10"))
+SHARD_CLAIM_PAGE = 50                                                # 每次領取查詢最多讀幾個候選分片
+
+def _abandoned_shard_result(shard):
+    summary = empty_redeem_summary()
+    summary["pending"] = len(shard["player_ids"])
+    summary["failed"] = [{"player_id": pid, "reason": "分片多次中斷，放棄兌換"} for pid in shard["player_ids"]]
+    return summary
+
+class LeaseStore(abc.ABC):
+    """分片與租約的儲存：領取（pending 或租約過期）、續約、完成都必須是原子操作"""
+
+    @abc.abstractmethod
+    def create(self, job_id, shards):
+        """建立工作的所有分片；已存在時不重建並回傳 False（協調者重啟後接手）"""
+
+    @abc.abstractmethod
+    def claim(self, worker_id, lease_seconds):
+        """領取一個可執行的分片並取得租約；沒有可領取的回傳 None"""
+
+    @abc.abstractmethod
+    def renew(self, shard_id, worker_id, lease_seconds, counts):
+        """續約並回報進度；租約已被他人取走時回傳 False"""
+
+    @abc.abstractmethod
+    def complete(self, shard_id, worker_id, result, counts):
+        """回報分片結果；租約已被他人取走時回傳 False（結果作廢）"""
+
+    @abc.abstractmethod
+    def shards(self, job_id):
+        """工作的所有分片狀態"""
+
+    @staticmethod
+    def _claim_update(shard, worker_id, lease_seconds, now):
+        """判斷分片可否領取，可以時回傳要寫入的欄位；重複中斷太多次的分片直接結案"""
+        if shard["status"] == "done" or (shard["status"] == "leased" and shard["lease_expires"] > now):
+            return None
+        if shard.get("claims", 0) >= SHARD_MAX_CLAIMS:
+            logger.warning(f"分片 {shard['job_id']}#{shard['index']} 已被領取 {shard['claims']} 次仍未完成，放棄 / Shard abandoned")
+            result = _abandoned_shard_result(shard)
+            return {"status": "done", "owner": None, "result": result, "counts": {"failed": len(result["failed"])}}
+        return {"status": "leased", "owner": worker_id, "lease_expires": now + lease_seconds, "claims": shard.get("claims", 0) + 1}
+
+class LocalLeaseStore(LeaseStore):
+    """記憶體內的替身：同一程序內的多個 worker 共用，供單機開發與測試"""
+
+    def __init__(self):
+        self._shards = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, job_id, shards):
+        with self._lock:
+            if any(shard["job_id"] == job_id for shard in self._shards.values()):
+                return False
+            for index, shard in enumerate(shards):
+                shard_id = f"{job_id}-{index:04d}"
+                self._shards[shard_id] = {**shard, "shard_id": shard_id, "job_id": job_id, "index": index,
+                                          "status": "pending", "claims": 0, "counts": {}}
+            return True
+
+    def claim(self, worker_id, lease_seconds):
+        with self._lock:
+            for shard in self._shards.values():
+                update = self._claim_update(shard, worker_id, lease_seconds, time.time())
+                if update:
+                    shard.update(update)
+                    if update["status"] == "leased":
+                        return dict(shard)
+            return None
+
+    def _owned(self, shard_id, worker_id):
+        shard = self._shards.get(shard_id)
+        return shard if shard and shard["status"] == "leased" and shard["owner"] == worker_id else None
+
+    def renew(self, shard_id, worker_id, lease_seconds, counts):
+        with self._lock:
+            shard = self._owned(shard_id, worker_id)
+            if shard:
+                shard.update(lease_expires=time.time() + lease_seconds, counts=counts)
+            return shard is not None
+
+    def complete(self, shard_id, worker_id, result, counts):
+        with self._lock:
+            shard = self._owned(shard_id, worker_id)
+            if shard:
+                shard.update(status="done", result=result, counts=counts)
+            return shard is not None
+
+    def shards(self, job_id):
+        with self._lock:
+            return [dict(shard) for shard in self._shards.values() if shard["job_id"] == job_id]
+
+class FirestoreLeaseStore(LeaseStore):
+    """redeem_shards/{job_id}-{index}：以 transaction 領取與續約，多個實例共用"""
+
+    def __init__(self, collection=SHARD_COLLECTION):
+        self.collection = collection
+
+    def _col(self):
+        return db.collection(self.collection)
+
+    def create(self, job_id, shards):
+        if list(self._col().where("job_id", "==", job_id).limit(1).stream()):
+            return False
+        for i in range(0, len(shards), FIRESTORE_BATCH_LIMIT):
+            batch = db.batch()
+            for index, shard in enumerate(shards[i:i + FIRESTORE_BATCH_LIMIT], start=i):
+                batch.set(self._col().document(f"{job_id}-{index:04d}"), {
+                    **shard, "job_id": job_id, "index": index, "status": "pending", "claims": 0,
+                    "counts": {}, "created_at": datetime.utcnow()
+                })
+            batch.commit()
+        return True
+
+    def _transact(self, shard_id, apply):
+        """在 transaction 內讀取分片並套用 apply(shard) 回傳的欄位；apply 回傳 None 表示不更新"""
+        ref = self._col().document(shard_id)
+
+        @firestore.transactional
+        def run(transaction):
+            snap = ref.get(transaction=transaction)
+            if not snap.exists:
+                return None
+            shard = snap.to_dict()
+            update = apply(shard)
+            if update:
+                transaction.update(ref, update)
+                return {**shard, **update, "shard_id": shard_id}
+            return None
+
+        return run(db.transaction())
+
+    def _claimable(self, now):
+        """可領取的分片都由查詢篩出：pending，或租約已過期的 leased；仍在租約內的分片不會佔掉查詢名額
+
+        第二個查詢需要 (status, lease_expires) 複合索引
+        """
+        yield from self._col().where("status", "==", "pending").limit(SHARD_CLAIM_PAGE).stream()
+        yield from self._col().where("status", "==", "leased").where("lease_expires", "<", now).limit(SHARD_CLAIM_PAGE).stream()
+
+    def claim(self, worker_id, lease_seconds):
+        for snap in self._claimable(time.time()):
+            # transaction 內重新檢查，查詢後才被他人領走的分片不會重複領取
+            claimed = self._transact(snap.id, lambda s: self._claim_update(s, worker_id, lease_seconds, time.time()))
+            if claimed and claimed["status"] == "leased":
+                return claimed
+        return None
+
+    def _owner_update(self, worker_id, fields):
+        return lambda s: fields() if s["status"] == "leased" and s.get("owner") == worker_id else None
+
+    def renew(self, shard_id, worker_id, lease_seconds, counts):
+        return self._transact(shard_id, self._owner_update(
+            worker_id, lambda: {"lease_expires": time.time() + lease_seconds, "counts": counts}
+        )) is not None
+
+    def complete(self, shard_id, worker_id, result, counts):
+        return self._transact(shard_id, self._owner_update(
+            worker_id, lambda: {"status": "done", "result": result, "counts": counts, "finished_at": datetime.utcnow()}
+        )) is not None
+
+    def shards(self, job_id):
+        return [{**doc.to_dict(), "shard_id": doc.id} for doc in self._col().where("job_id", "==", job_id).stream()]
+
+def build_lease_store(backend):
+    if backend == "local":
+        return LocalLeaseStore()
+    if backend != "firestore":
+        logger.warning(f"未知的 SHARD_STORE：{backend}，改用 firestore / Unknown shard store, using firestore")
+    return FirestoreLeaseStore()
+
+shard_store = build_lease_store(SHARD_STORE)
+
+class ShardWorker:
+    """領取分片並執行：每次喚醒就一直領到沒有可執行的分片為止，執行期間定期續約"""
+
+    def __init__(self, store, worker_id=None, lease_seconds=SHARD_LEASE_SECONDS):
+        self.store = store
+        self.worker_id = worker_id or f"{os.getenv('K_REVISION', 'local')}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self._task = None
+        self.current = None
+        self.completed = 0
+        self.lost_leases = 0
+        self.errors = 0
+
+    def kick(self):
+        """喚醒 worker（已在執行則不重複啟動）/ Start draining claimable shards"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run_available())
+        return self._task
+
+    async def close(self):
+        # 執行中的分片不回報，租約到期後由其他實例接手
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def run_available(self):
+        ran = 0
+        while True:
+            shard = await run_blocking(self.store.claim, self.worker_id, self.lease_seconds)
+            if not shard:
+                return ran
+            await self._run_shard(shard)
+            ran += 1
+
+    async def _redeem(self, shard, job):
+        rejected = await run_blocking(get_rejected_code_status, shard["code"])
+        if rejected:
+            # 其他分片已判定碼失效：整個分片直接取消
+            summary = empty_redeem_summary()
+            summary.update(pending=len(shard["player_ids"]), cancelled=len(shard["player_ids"]),
+                           code_status=rejected.get("status"), code_reason=rejected.get("reason"))
+            job.count("cancelled", summary["cancelled"])
+            return summary
+        return await redeem_code_for_players(
+            shard["code"], shard["player_ids"], debug=shard.get("debug", False), engine=shard.get("engine"),
+            job=job, scheduler_name="shard"
+        )
+
+    async def _run_shard(self, shard):
+        shard_id = shard["shard_id"]
+        logger.info(f"🧩 [{self.worker_id}] 領取分片 {shard_id}（{len(shard['player_ids'])} 位）/ Claimed shard")
+        job = RedeemJob("shard", shard["code"], len(shard["player_ids"]), job_id=shard_id)
+        self.current = shard_id
+        work = asyncio.create_task(self._redeem(shard, job))
+        try:
+            while True:
+                done, _ = await asyncio.wait({work}, timeout=self.lease_seconds / 3)
+                if done:
+                    break
+                if not await run_blocking(self.store.renew, shard_id, self.worker_id, self.lease_seconds, dict(job.counts)):
+                    # 租約已被他人接手：停止，避免同一批玩家被兩個實例同時兌換
+                    logger.warning(f"🧩 [{self.worker_id}] 分片 {shard_id} 租約遺失，停止執行 / Lease lost")
+                    self.lost_leases += 1
+                    work.cancel()
+                    await asyncio.gather(work, return_exceptions=True)
+                    return
+            summary = work.result()
+            if await run_blocking(self.store.complete, shard_id, self.worker_id, summary, dict(job.counts)):
+                self.completed += 1
+            else:
+                self.lost_leases += 1
+        except Exception as e:
+            # 不回報結果：租約到期後由其他 worker 重新領取
+            logger.exception(f"🧩 [{self.worker_id}] 分片 {shard_id} 執行失敗 / Shard failed: {e}")
+            self.errors += 1
+        finally:
+            if not work.done():
+                work.cancel()
+            self.current = None
+
+    def stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "running": self._task is not None and not self._task.done(),
+            "current": self.current,
+            "completed": self.completed,
+            "lost_leases": self.lost_leases,
+            "errors": self.errors
+        }
+
+shard_worker = ShardWorker(shard_store)
+
+def merge_redeem_summaries(summaries):
+    merged = empty_redeem_summary()
+    for summary in summaries:
+        for key in ("pending", "success", "skipped", "cancelled", "unsaved"):
+            merged[key] += summary.get(key, 0)
+        merged["failed"].extend(summary.get("failed", []))
+        merged["final_failed"].extend(summary.get("final_failed", []))
+        if summary.get("code_status") and not merged["code_status"]:
+            merged["code_status"], merged["code_reason"] = summary["code_status"], summary.get("code_reason")
+    return merged
+
+async def wake_shard_workers(count):
+    """對服務網址發出喚醒請求，讓負載平衡把分片分給其他實例"""
+    if not SHARD_WAKE_URL or count <= 0:
+        return
+    async def wake(session):
+        with contextlib.suppress(Exception):
+            async with session.post(f"{SHARD_WAKE_URL.rstrip('/')}/shards/work", timeout=aiohttp.ClientTimeout(total=5)):
+                pass
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(wake(session) for _ in range(min(count, SHARD_MAX_WAKE))))
+
+async def process_sharded(payload, job=None):
+    """協調者：把名單切成分片交給各實例領取，等全部完成後彙整成一則 webhook"""
+    start_time = time.time()
+    code = payload.get("code")
+    player_ids = list(dict.fromkeys(payload.get("player_ids")))
+    job = job or RedeemJob("redeem_sharded", code, len(player_ids))
+
+    shards = [
+        {"code": code, "player_ids": player_ids[i:i + SHARD_SIZE], "debug": payload.get("debug", False), "engine": payload.get("engine")}
+        for i in range(0, len(player_ids), SHARD_SIZE)
+    ]
+    if await run_blocking(shard_store.create, job.id, shards):
+        logger.info(f"🧩 [job {job.id}] 建立 {len(shards)} 個分片 / Created {len(shards)} shards")
+        await wake_shard_workers(len(shards) - 1)
+    else:
+        logger.info(f"🧩 [job {job.id}] 接手既有分片 / Re-attached to existing shards")
+
+    while True:
+        shard_worker.kick()  # 本實例也一起領取；過期的租約也由此重新領取
+        states = await run_blocking(shard_store.shards, job.id)
+        job.counts = {key: sum((state.get("counts") or {}).get(key, 0) for state in states) for key in job.counts}
+        if states and all(state["status"] == "done" for state in states):
+            break
+        await asyncio.sleep(SHARD_POLL_INTERVAL)
+
+    summary = merge_redeem_summaries(state["result"] for state in states)
+    await post_redeem_webhook(submit_webhook_message(code, summary, time.time() - start_time, shards=len(states)))
+    return {"shards": len(states), "code_status": summary["code_status"], "unsaved": summary["unsaved"]}
+
+def persisted_job_status(job_id, journal):
+    """其他實例執行的工作：讀工作日誌的狀態與計數，分片工作改以各分片的進度彙整；查無資料回傳 None"""
+    run = journal.get(job_id)
+    states = shard_store.shards(job_id) if run is None or run["kind"] == "redeem_sharded" else []
+    if run is None and not states:
+        return None
+    if run is None:
+        # 協調者的日誌尚未寫入（或日誌停用），只剩分片文件
+        run = {
+            "job_id": job_id, "kind": "redeem_sharded", "code": states[0]["code"],
+            "status": "done" if all(state["status"] == "done" for state in states) else "running",
+            "total": sum(len(state["player_ids"]) for state in states), "counts": {}, "owner": None
+        }
+    if states:
+        counts = {}
+        for state in states:
+            for key, n in (state.get("counts") or {}).items():
+                counts[key] = counts.get(key, 0) + n
+        run["counts"] = counts
+        run["shards"] = {"total": len(states), "done": sum(state["status"] == "done" for state in states)}
+    processed = sum(run["counts"].values())
+    return {**run, "processed": processed, "remaining": max(0, run["total"] - processed), "persisted": True}
+
+# 各類工作的執行函式（API 與重啟續跑共用）
+JOB_RUNNERS = {
+    "redeem_submit": lambda payload, job: process_submit(payload, job),
+    "redeem_sharded": lambda payload, job: process_sharded(payload, job),
+    "retry_failed": lambda payload, job: process_redeem(payload, job),
+    "redeem_multi": lambda payload, job: process_multi_redeem(
+        payload["codes"], payload["player_ids"], debug=payload.get("debug", False), engine=payload.get("engine"), job=job
+    )
+}
 
-    if all_fail:
-        webhook_message += "⚠️ 重試仍失敗的 ID：\n"
-        webhook_message += "Failed IDs:\n"
-        for r in all_fail:
-            pid = r["player_id"]
-            doc = db.collection("ids").document("global").collection("players").document(pid).get()
-            name = doc.to_dict().get("name", "未知名稱") if doc.exists else "未知名稱"
-            webhook_message += f"- {pid} ({name})\n"
+REDEEM_TIMEOUT = 90  # 秒；每個禮包碼的兌換時間上限（多碼同一登入時依碼數累加）
 
-    webhook_message += f"\n⌛ 執行時間：約 {duration:.1f} 秒\n"
-    webhook_message += f"Duration: approx. {duration:.1f} seconds"
+async def run_redeem_with_retry(player_id, code, debug=False, engine=None):
+    return (await run_codes_with_retry(player_id, [code], debug=debug, engine=engine))[code]
 
-    if os.getenv("DISCORD_WEBHOOK_URL"):
-        try:
-            resp = requests.post(os.getenv("DISCORD_WEBHOOK_URL"), json={"content": webhook_message})
-            logger.info(f"Webhook 發送結果：{resp.status_code} {resp.text}")
-        except Exception as e:
-            logger.warning(f"Webhook 發送失敗：{e}")
+async def run_codes_with_retry(player_id, codes, debug=False, engine=None):
+    """同一位玩家一次登入依序兌換多個禮包碼，回傳 {code: result}；只有可重試的碼會再試"""
+    if (engine or REDEEM_ENGINE) == "http":
+        return await _retry_codes(player_id, codes, http_engine.redeem_codes, debug)
+    # 瀏覽器引擎：重試沿用同一個已登入頁面，只重做失敗的步驟
+    async with BrowserRedeemSession(player_id) as session:
+        return await _retry_codes(player_id, codes, session.redeem_codes, debug)
 
-async def run_redeem_with_retry(player_id, code, debug=False):
+async def _retry_codes(player_id, codes, redeem_codes, debug=False):
     debug_logs = []
+    pending = list(dict.fromkeys(codes))
+    results = {}
 
     for redeem_retry in range(REDEEM_RETRIES + 1):
+        await rate_controller.acquire()
+        captcha_solver.interrupted(player_id)  # 清掉先前殘留的標記
         try:
-            result = await asyncio.wait_for(
-                _redeem_once(player_id, code, debug_logs, redeem_retry, debug=debug),
-                timeout=90  # 每次單人兌換最多 90 秒
+            batch = await asyncio.wait_for(
+                redeem_codes(player_id, pending, debug_logs, redeem_retry, debug=debug),
+                timeout=REDEEM_TIMEOUT * len(pending)  # 每次單人兌換每個碼最多 90 秒
             )
         except asyncio.TimeoutError:
-            logger.error(f"[{player_id}] 第 {redeem_retry + 1} 次：超過 90 秒 timeout")
-            return {
-                "success": False,
-                "reason": "Timeout：單人兌換超過 90 秒",
-                "player_id": player_id,
-                "debug_logs": debug_logs
-            }
-
-        if result is None or not isinstance(result, dict):
-            logger.error(f"[{player_id}] 第 {redeem_retry + 1} 次：_redeem_once 回傳 None 或格式錯誤 → {result}")
-            return {
-                "success": False,
-                "reason": "無效回傳（None 或錯誤格式）",
-                "player_id": player_id,
-                "debug_logs": debug_logs
-            }
-
-        # ✅ 防止 NoneType 的 reason
-        reason = result.get("reason") or ""
-
-        if reason.startswith("_try"):
-            return result
-
-        if result.get("success"):
-            return result
-
-        if "登入失敗" in reason or "請先登入" in reason:
-            return result
+            logger.error(f"[{player_id}] 第 {redeem_retry + 1} 次：超過 {REDEEM_TIMEOUT * len(pending)} 秒 timeout")
+            # 卡在驗證碼辨識（如 2Captcha 排隊）不代表網站過載，只有網站或頁面慢才視同節流訊號
+            if captcha_solver.interrupted(player_id):
+                logger.warning(f"[{player_id}] 逾時發生在驗證碼辨識中，不降速 / Timed out while solving captcha, not throttling")
+            else:
+                rate_controller.on_throttle(player_id)
+            for code in pending:
+                results[code] = {
+                    "success": False,
+                    "reason": "Timeout：單人兌換超過 90 秒",
+                    "player_id": player_id,
+                    "debug_logs": debug_logs
+                }
+            return results
+        finally:
+            await rate_controller.release()
+
+        retry_codes = []
+        for code in pending:
+            result = batch.get(code) if isinstance(batch, dict) else None
+            if result is None or not isinstance(result, dict):
+                logger.error(f"[{player_id}] 第 {redeem_retry + 1} 次：{code} 回傳 None 或格式錯誤 → {result}")
+                results[code] = {
+                    "success": False,
+                    "reason": "無效回傳（None 或錯誤格式）",
+                    "player_id": player_id,
+                    "debug_logs": debug_logs
+                }
+                continue
+            results[code] = result
 
-        if any(k in reason for k in RETRY_KEYWORDS):
-            debug_logs.append({
-                "retry": redeem_retry + 1,
-                "info": f"Retry due to: {reason}"
-            })
-            await asyncio.sleep(2 + redeem_retry)
-        else:
-            return result
+            # ✅ 防止 NoneType 的 reason
+            reason = result.get("reason") or ""
 
-    return result
+            # 回報速率控制器：節流訊息降速，其餘正常回應逐步加速
+            if any(k in reason for k in THROTTLE_KEYWORDS):
+                rate_controller.on_throttle(player_id)
+            elif reason != "例外錯誤":
+                rate_controller.on_success()
 
-async def _redeem_once(player_id, code, debug_logs, redeem_retry, debug=False):
-    browser = None
+            if reason.startswith("_try") or result.get("success"):
+                continue
 
-    def log_entry(attempt, **kwargs):
-        entry = {"redeem_retry": redeem_retry, "attempt": attempt}
-        entry.update(kwargs)
-        debug_logs.append(entry)
+            if "登入失敗" in reason:
+                continue
 
+            # 例外多半是頁面壞掉，瀏覽器引擎下次重試會換新頁面重來
+            if any(k in reason for k in RETRY_KEYWORDS + RELOGIN_KEYWORDS) or reason == "例外錯誤":
+                debug_logs.append({
+                    "retry": redeem_retry + 1,
+                    "code": code,
+                    "info": f"Retry due to: {reason}"
+                })
+                retry_codes.append(code)
+
+        pending = retry_codes
+        if not pending or redeem_retry == REDEEM_RETRIES:
+            break
+        await asyncio.sleep(2 + redeem_retry)
+
+    return results
+
+# === 條件等待工具（取代固定 sleep 與輪詢）===
+LOGIN_RESPONSE_TIMEOUT = float(os.getenv("LOGIN_RESPONSE_TIMEOUT", "10"))        # 秒
+EXCHANGE_RESPONSE_TIMEOUT = float(os.getenv("EXCHANGE_RESPONSE_TIMEOUT", "6"))   # 秒
+EXCHANGE_API_PATTERN = os.getenv("EXCHANGE_API_PATTERN", "/api/gift_code")
+wait_stats = {}  # label -> {"calls", "timeouts", "seconds", "winners": {條件: 次數}}
+
+def _consume_exception(task):
+    # 落敗的條件多半以逾時或取消結束，先取出例外避免 "never retrieved" 警告
+    if not task.cancelled():
+        task.exception()
+
+def _record_wait(label, winner, elapsed):
+    entry = wait_stats.setdefault(label, {"calls": 0, "timeouts": 0, "seconds": 0.0, "winners": {}})
+    entry["calls"] += 1
+    entry["seconds"] += elapsed
+    if winner is None:
+        entry["timeouts"] += 1
+    else:
+        entry["winners"][winner] = entry["winners"].get(winner, 0) + 1
+
+async def wait_first(conditions, timeout, label="wait"):
+    """同時等待多個條件（{名稱: awaitable}），任一成立立即回傳 (名稱, 值, 耗時秒)；全部失敗或逾時名稱為 None
+
+    同一輪同時成立時以 conditions 的順序為優先。勝出條件與耗時記錄在 wait_stats[label]。
+    """
+    start = time.monotonic()
+    tasks = {asyncio.ensure_future(aw): name for name, aw in conditions.items()}
+    winner, value = None, None
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True, args=["--disable-gpu"])
-            context = await browser.new_context(locale="zh-TW")
-            page = await context.new_page()
-            await page.goto("https://wos-giftcode.centurygame.com/", timeout=PAGE_LOAD_TIMEOUT)
-            await page.fill('input[type="text"]', player_id)
-            await page.click(".login_btn")
+        pending = set(tasks)
+        deadline = start + timeout
+        while pending and winner is None and time.monotonic() < deadline:
+            done, pending = await asyncio.wait(
+                pending, timeout=deadline - time.monotonic(), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in tasks:
+                if task in done and not task.cancelled() and task.exception() is None:
+                    winner, value = tasks[task], task.result()
+                    break
+    finally:
+        for task in tasks:
+            task.add_done_callback(_consume_exception)
+            task.cancel()
+    elapsed = time.monotonic() - start
+    _record_wait(label, winner, elapsed)
+    return winner, value, elapsed
+
+def _expect_response(page, pattern, timeout_ms):
+    """在觸發動作前開始等待符合 pattern 的回應，回傳 Task（未使用時記得 cancel）"""
+    task = asyncio.ensure_future(page.wait_for_event("response", lambda r: pattern in r.url, timeout=timeout_ms))
+    task.add_done_callback(_consume_exception)
+    return task
+
+def wait_stats_report():
+    return {
+        label: {**entry, "seconds": round(entry["seconds"], 2), "avg_ms": round(entry["seconds"] * 1000 / max(entry["calls"], 1))}
+        for label, entry in wait_stats.items()
+    }
 
-            # 嘗試等待錯誤 modal
-            try:
-                await page.wait_for_selector(".message_modal", timeout=5000)
-                modal_text = await page.inner_text(".message_modal .msg")
-                log_entry(0, error_modal=modal_text)
-                if any(k in modal_text for k in FAILURE_KEYWORDS):
-                    logger.info(f"[{player_id}] 登入失敗：{modal_text}")
-                    return await _package_result(page, False, f"登入失敗：{modal_text}", player_id, debug_logs, debug=debug)
-            except TimeoutError:
-                pass  # 無 modal 則繼續檢查登入成功
-
-            # 加強：等待 .name 與兌換欄位都出現才視為成功
-            try:
-                await page.wait_for_selector(".name", timeout=5000)
-                await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
-            except TimeoutError:
-                return await _package_result(page, False, "登入失敗（未成功進入兌換頁） / Login failed (did not reach redeem page)", player_id, debug_logs, debug=debug)
+# === 以網站 JSON 回應判斷兌換結果 ===
+REDEEM_OUTCOME_MODE = os.getenv("REDEEM_OUTCOME_MODE", "json")  # json：先看 API 回應，modal 文字為備援；modal：只看 modal
+LOGIN_API_PATTERN = os.getenv("LOGIN_API_PATTERN", "/api/player")
+# err_code → (結果類型, 與 modal 文字一致的原因，讓下游的關鍵字判斷照舊運作)
+GIFTCODE_ERR_CODES = {
+    20000: ("success", "兌換成功"),
+    40008: ("claimed", "您已領取過該禮物"),          # RECEIVED.
+    40011: ("claimed", "您已領取過該禮物"),          # SAME TYPE EXCHANGE.
+    40007: ("failed", "超出兌換時間"),               # TIME ERROR.
+    40014: ("failed", "兌換碼不存在"),               # CDK NOT FOUND.
+    40005: ("failed", "兌換碼已使用"),               # USED.
+    40103: ("captcha", "驗證碼錯誤"),                # CAPTCHA CHECK ERROR.
+    40102: ("captcha", "驗證碼已過期"),              # CAPTCHA EXPIRED.
+    40101: ("throttle", "驗證碼請求過於頻繁，請稍後再試"),  # CAPTCHA CHECK TOO FREQUENT.
+    40004: ("retry", "伺服器繁忙，請稍後再試")        # TIMEOUT RETRY.
+}
+outcome_stats = {"json": 0, "modal": 0}
+
+def classify_giftcode_payload(payload):
+    """依 API 回應的 code / err_code 分類，回傳 (結果類型, 原因)；不是預期格式回傳 None，改由 modal 文字判斷"""
+    if not isinstance(payload, dict) or "code" not in payload:
+        return None
+    err_code = payload.get("err_code")
+    if err_code in GIFTCODE_ERR_CODES:
+        return GIFTCODE_ERR_CODES[err_code]
+    if payload["code"] == 0:
+        return "success", payload.get("msg") or "成功"
+    return "failed", f"未知錯誤：{payload.get('msg')}（err_code {err_code}）"
+
+async def _response_payload(task):
+    """已完成的回應 Task → JSON dict；尚未完成或無法解析回傳 None"""
+    if not task.done() or task.cancelled() or task.exception() is not None:
+        return None
+    with contextlib.suppress(Exception):
+        return await task.result().json()
+    return None
 
-            await page.fill('input[placeholder="請輸入兌換碼"]', code)
+async def _redeem_once(player_id, code, debug_logs, redeem_retry, debug=False):
+    return (await _redeem_codes_once(player_id, [code], debug_logs, redeem_retry, debug=debug))[code]
+
+async def _redeem_codes_once(player_id, codes, debug_logs, redeem_retry, debug=False):
+    """開一個頁面、登入一次，依序兌換所有禮包碼；回傳 {code: result}"""
+    async with BrowserRedeemSession(player_id) as session:
+        return await session.redeem_codes(player_id, codes, debug_logs, redeem_retry, debug=debug)
+
+# === 瀏覽器兌換工作階段（重試沿用已登入頁面）===
+RELOGIN_KEYWORDS = ["請先登入", "重新登入", "登入已過期"]  # 登入狀態失效：同一頁面重新整理後再登入即可
+session_stats = {"sessions": 0, "in_page_retries": 0, "relogins": 0, "page_restarts": 0}
+
+class BrowserRedeemSession:
+    """一位玩家的瀏覽器兌換階段：頁面與登入狀態跨重試保留
+
+    重試時只重做失敗的步驟：驗證碼錯誤 / 伺服器繁忙 → 換新驗證碼再送出；
+    登入失效 → 同一頁面重新整理後再登入；例外、頁面關閉或瀏覽器斷線 → 才換一個新的預熱頁面
+    """
+
+    def __init__(self, player_id):
+        self.player_id = player_id
+        self.page = None
+        self._stack = None
+        self.fresh = False      # 頁面剛從 PagePool 取出、停在登入表單
+        self.logged_in = False
+        self.submitted = False  # 已送出過兌換，畫面上的驗證碼已用掉
+        self.broken = False     # 上一次發生例外，頁面已關閉
+
+    async def __aenter__(self):
+        session_stats["sessions"] += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._release()
+
+    async def _release(self):
+        stack, self._stack, self.page = self._stack, None, None
+        if stack:
+            await stack.aclose()
+
+    async def _open_page(self):
+        await self._release()
+        self._stack = contextlib.AsyncExitStack()
+        self.page = await self._stack.enter_async_context(page_pool.page())
+        self.fresh, self.logged_in, self.submitted, self.broken = True, False, False, False
+
+    def _page_usable(self):
+        if self.page is None or self.page.is_closed():
+            return False
+        browser = self.page.context.browser
+        return browser is None or browser.is_connected()
+
+    async def _relogin(self, log_entry, debug_logs, debug):
+        """登入（必要時先在同一頁面重新整理回登入表單）；失敗回傳結果 dict"""
+        page = self.page
+        if not self.fresh:
+            session_stats["relogins"] += 1
+            log_entry(0, info="同一頁面重新登入 / Re-login on the same page")
+            await page.reload(timeout=PAGE_LOAD_TIMEOUT)
+            await page.wait_for_selector('input[type="text"]', timeout=PAGE_LOAD_TIMEOUT)
+        self.fresh = False
+        failure = await _browser_login(page, self.player_id, log_entry, debug_logs, debug)
+        self.logged_in = failure is None
+        self.submitted = False
+        return failure
+
+    async def redeem_codes(self, player_id, codes, debug_logs, redeem_retry, debug=False):
+        """與 _redeem_codes_once 相同介面；回傳 {code: result}"""
+        def log_entry(attempt, **kwargs):
+            entry = {"redeem_retry": redeem_retry, "attempt": attempt}
+            entry.update(kwargs)
+            debug_logs.append(entry)
+
+        results = {}
+        page = None
+        try:
+            if not self._page_usable():
+                if self.page is not None or self.broken:
+                    session_stats["page_restarts"] += 1
+                    log_entry(0, info="頁面已失效，改用新頁面 / Page broken, starting over on a new page")
+                await self._open_page()
+            elif redeem_retry:
+                session_stats["in_page_retries"] += 1
+            page = self.page
+
+            if not self.logged_in:
+                login_failure = await self._relogin(log_entry, debug_logs, debug)
+                if login_failure:
+                    return dict.fromkeys(codes, login_failure)
+
+            expired = None
+            for code in codes:
+                if not self.logged_in:
+                    results[code] = expired  # 登入已失效：剩下的碼留待下次重試重新登入後再兌換
+                    continue
+                if self.submitted:
+                    await _refresh_captcha(page, player_id=player_id)  # 上一次送出已用掉這張驗證碼
+                results[code] = await _browser_exchange(
+                    page, player_id, code,
+                    lambda attempt, code=code, **kwargs: log_entry(attempt, code=code, **kwargs),
+                    debug_logs, debug
+                )
+                self.submitted = True
+                if any(k in (results[code].get("reason") or "") for k in RELOGIN_KEYWORDS):
+                    self.logged_in = False
+                    expired = results[code]
+            return results
 
-            for attempt in range(1, OCR_MAX_RETRIES + 1):
+        except Exception as e:
+            logger.exception(f"[{player_id}] 發生例外錯誤：{e}")
+            html, img = None, None
+            if debug and page is not None:
                 try:
-                    captcha_text, method_used = await _solve_captcha(page, attempt, player_id)
-                    log_entry(attempt, captcha_text=captcha_text, method=method_used)
-
-                    await page.fill('input[placeholder="請輸入驗證碼"]', captcha_text or "")
-
-                    try:
-                        await page.click(".exchange_btn", timeout=3000)
-                        await page.wait_for_timeout(1000)
+                    html = await page.content()
+                    img = await page.screenshot()
+                except:
+                    pass
+            # 頁面狀態不明：關閉它，下次重試改用新的預熱頁面
+            await self._release()
+            self.broken = True
+            failure = {
+                "player_id": player_id,
+                "success": False,
+                "reason": "例外錯誤",
+                "debug_logs": debug_logs,
+                "debug_html_base64": base64.b64encode(html.encode("utf-8")).decode() if html else None,
+                "debug_img_base64": base64.b64encode(img).decode() if img else None
+            }
+            # 已完成的碼保留結果，其餘記為例外
+            return {code: results.get(code, failure) for code in codes}
+
+async def _browser_login(page, player_id, log_entry, debug_logs, debug=False):
+    """在頁面上登入；失敗回傳結果 dict，成功回傳 None"""
+    CaptchaWatcher.of(page)  # 登入前開始攔截，第一張驗證碼即可直接取用
+    use_json = REDEEM_OUTCOME_MODE == "json"
+    timeout_ms = LOGIN_RESPONSE_TIMEOUT * 1000
+    login_response = _expect_response(page, LOGIN_API_PATTERN, timeout_ms)
+    try:
+        await page.fill('input[type="text"]', player_id)
+        await page.click(".login_btn")
+    except Exception:
+        login_response.cancel()
+        raise
+
+    # 登入 API 回應、錯誤 modal 與角色名稱取先出現者，登入成功不必再空等 modal 逾時
+    conditions = {"response": login_response} if use_json else {}
+    conditions.update({
+        "modal": page.wait_for_selector(".message_modal .msg", timeout=timeout_ms),
+        "name": page.wait_for_selector(".name", timeout=timeout_ms)
+    })
+    winner, _, elapsed = await wait_first(conditions, LOGIN_RESPONSE_TIMEOUT, label="login")
+    log_entry(0, login_wait=winner, login_ms=round(elapsed * 1000))
+    login_outcome = classify_giftcode_payload(await _response_payload(login_response)) if use_json else None
+    login_response.cancel()
+    if login_outcome and login_outcome[0] != "success":
+        kind, reason = login_outcome
+        log_entry(0, login_outcome=kind, error_modal=reason)
+        logger.info(f"[{player_id}] 登入失敗：{reason}")
+        if kind in ("retry", "throttle"):
+            return await _package_result(page, False, reason, player_id, debug_logs, debug=debug)
+        return await _package_result(page, False, f"登入失敗：{reason}", player_id, debug_logs, debug=debug)
+    if winner == "modal":
+        modal_text = await page.inner_text(".message_modal .msg")
+        log_entry(0, error_modal=modal_text)
+        if any(k in modal_text for k in FAILURE_KEYWORDS):
+            logger.info(f"[{player_id}] 登入失敗：{modal_text}")
+            return await _package_result(page, False, f"登入失敗：{modal_text}", player_id, debug_logs, debug=debug)
+        await _dismiss_modal(page)
+
+    # 加強：等待 .name 與兌換欄位都出現才視為成功
+    try:
+        await page.wait_for_selector(".name", timeout=5000)
+        await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
+    except TimeoutError:
+        return await _package_result(page, False, "登入失敗（未成功進入兌換頁） / Login failed (did not reach redeem page)", player_id, debug_logs, debug=debug)
+    return None
 
-                        for _ in range(10):
-                            modal = await page.query_selector(".message_modal")
-                            if modal:
-                                msg_el = await modal.query_selector("p.msg")
-                                if msg_el:
-                                    message = await msg_el.inner_text()
-                                    log_entry(attempt, server_message=message)
-                                    logger.info(f"[{player_id}] 第 {attempt} 次：伺服器回應：{message}")
+async def _browser_exchange(page, player_id, code, log_entry, debug_logs, debug=False):
+    """已登入的頁面上兌換一個禮包碼（含驗證碼重試），回傳結果 dict"""
+    use_json = REDEEM_OUTCOME_MODE == "json"
+    await page.fill('input[placeholder="請輸入兌換碼"]', code)
 
-                                    confirm_btn = await modal.query_selector(".confirm_btn")
-                                    if confirm_btn and await confirm_btn.is_visible():
-                                        await confirm_btn.click()
-                                        await page.wait_for_timeout(500)
+    for attempt in range(1, OCR_MAX_RETRIES + 1):
+        try:
+            captcha_text, method_used = await _solve_captcha(page, attempt, player_id)
+            log_entry(attempt, captcha_text=captcha_text, method=method_used)
 
-                                    if "驗證碼錯誤" in message or "驗證碼已過期" in message:
-                                        await _refresh_captcha(page, player_id=player_id)
-                                        break
+            await page.fill('input[placeholder="請輸入驗證碼"]', captcha_text or "")
 
-                                    if any(k in message for k in FAILURE_KEYWORDS):
-                                        return await _package_result(page, False, message, player_id, debug_logs, debug=debug)
+            try:
+                # 兌換回應或 modal 取先到；回應先到時再短暫等 modal 文字渲染
+                timeout_ms = EXCHANGE_RESPONSE_TIMEOUT * 1000
+                # 點擊前就開始等回應，避免回應比監聽先到
+                exchange_response = _expect_response(page, EXCHANGE_API_PATTERN, timeout_ms)
+                try:
+                    await page.click(".exchange_btn", timeout=3000)
+                except Exception:
+                    exchange_response.cancel()
+                    raise
+                winner, _, elapsed = await wait_first({
+                    "response": exchange_response,
+                    "modal": page.wait_for_selector(".message_modal p.msg", timeout=timeout_ms)
+                }, EXCHANGE_RESPONSE_TIMEOUT, label="exchange")
+                log_entry(attempt, exchange_wait=winner, exchange_ms=round(elapsed * 1000))
+
+                # JSON 模式：回應一到就依 err_code 判斷，不等 modal 渲染
+                payload = await _response_payload(exchange_response) if use_json else None
+                outcome = classify_giftcode_payload(payload)
+                if outcome:
+                    kind, reason = outcome
+                    outcome_stats["json"] += 1
+                    log_entry(attempt, server_code=payload.get("err_code"), server_message=reason, source="json")
+                    logger.info(f"[{player_id}] 第 {attempt} 次：伺服器回應：{reason}（err_code {payload.get('err_code')}）")
+                    if kind == "success":
+                        return await _package_result(page, True, reason, player_id, debug_logs, debug=debug)
+                    if kind == "captcha":
+                        with contextlib.suppress(TimeoutError):
+                            await page.wait_for_selector(".message_modal p.msg", timeout=2000)
+                        await _dismiss_modal(page)
+                        await _refresh_captcha(page, player_id=player_id)
+                        continue
+                    # claimed / failed / throttle / retry：原因字串與 modal 相同，交給 run_redeem_with_retry 判斷
+                    return await _package_result(page, False, reason, player_id, debug_logs, debug=debug)
 
-                                    if "成功" in message:
-                                        return await _package_result(page, True, message, player_id, debug_logs, debug=debug)
+                if winner == "response":
+                    with contextlib.suppress(TimeoutError):
+                        await page.wait_for_selector(".message_modal p.msg", timeout=3000)
 
-                                    return await _package_result(page, False, f"未知錯誤：{message}", player_id, debug_logs, debug=debug)
+                msg_el = await page.query_selector(".message_modal p.msg")
+                if not msg_el:
+                    log_entry(attempt, server_message="未出現 modal 回應（點擊被遮蔽或失敗）")
+                    await _refresh_captcha(page, player_id=player_id)
+                    continue
 
-                            await page.wait_for_timeout(300)
+                message = await msg_el.inner_text()
+                outcome_stats["modal"] += 1
+                log_entry(attempt, server_message=message)
+                logger.info(f"[{player_id}] 第 {attempt} 次：伺服器回應：{message}")
+                await _dismiss_modal(page)
 
-                        else:
-                            log_entry(attempt, server_message="未出現 modal 回應（點擊被遮蔽或失敗）")
-                            await _refresh_captcha(page, player_id=player_id)
-                            continue
+                if "驗證碼錯誤" in message or "驗證碼已過期" in message:
+                    await _refresh_captcha(page, player_id=player_id)
+                    continue
 
-                    except Exception as e:
-                        log_entry(attempt, error=f"點擊或等待 modal 時失敗: {str(e)}")
-                        await _refresh_captcha(page, player_id=player_id)
-                        await page.wait_for_timeout(1000)
-                        continue
+                if any(k in message for k in FAILURE_KEYWORDS):
+                    return await _package_result(page, False, message, player_id, debug_logs, debug=debug)
 
-                except Exception:
-                    log_entry(attempt, error=traceback.format_exc())
-                    await _refresh_captcha(page, player_id=player_id)
-                    await page.wait_for_timeout(1000)
+                if "成功" in message:
+                    return await _package_result(page, True, message, player_id, debug_logs, debug=debug)
 
-            log_entry(attempt, info="驗證碼三次辨識皆失敗，放棄兌換")
-            logger.info(f"[{player_id}] 最終失敗：驗證碼三次辨識皆失敗 / Final failure: CAPTCHA failed 3 times")
-            return await _package_result(page, False, "驗證碼三次辨識皆失敗，放棄兌換", player_id, debug_logs, debug=debug)
+                return await _package_result(page, False, f"未知錯誤：{message}", player_id, debug_logs, debug=debug)
 
-    except Exception as e:
-        logger.exception(f"[{player_id}] 發生例外錯誤：{e}")
-        html, img = None, None
-        if debug:
-            try:
-                html = await page.content() if 'page' in locals() else "<no page>"
-                img = await page.screenshot() if 'page' in locals() else None
-            except:
-                pass
-        return {
-            "player_id": player_id,
-            "success": False,
-            "reason": "例外錯誤",
-            "debug_logs": debug_logs,
-            "debug_html_base64": base64.b64encode(html.encode("utf-8")).decode() if html else None,
-            "debug_img_base64": base64.b64encode(img).decode() if img else None
-        }
+            except Exception as e:
+                log_entry(attempt, error=f"點擊或等待 modal 時失敗: {str(e)}")
+                await _refresh_captcha(page, player_id=player_id)
+                continue
 
-    finally:
-        if browser:
-            await browser.close()
+        except Exception:
+            log_entry(attempt, error=traceback.format_exc())
+            await _refresh_captcha(page, player_id=player_id)
 
-    return {
-        "player_id": player_id,
-        "success": False,
-        "reason": "未知錯誤（流程未命中任何 return）",
-        "debug_logs": debug_logs
-    }
+    log_entry(attempt, info="驗證碼三次辨識皆失敗，放棄兌換")
+    logger.info(f"[{player_id}] 最終失敗：驗證碼三次辨識皆失敗 / Final failure: CAPTCHA failed 3 times")
+    return await _package_result(page, False, "驗證碼三次辨識皆失敗，放棄兌換", player_id, debug_logs, debug=debug)
 
 async def _solve_captcha(page, attempt, player_id):
     fallback_text = f"_try{attempt}"
@@ -394,11 +2574,11 @@ async def _solve_captcha(page, attempt, player_id):
             logger.info(f"[{player_id}] 第 {attempt} 次：未找到驗證碼圖片")
             return fallback_text, method_used
 
-        await page.wait_for_timeout(500)
         try:
-            captcha_bytes = await asyncio.wait_for(captcha_img.screenshot(), timeout=10)
+            # 直接取攔截到的圖（或 data URL），只有都拿不到時才截圖
+            captcha_bytes = await CaptchaWatcher.of(page).current(captcha_img)
         except Exception as e:
-            logger.warning(f"[{player_id}] 第 {attempt} 次：captcha screenshot timeout 或錯誤 → {e}")
+            logger.warning(f"[{player_id}] 第 {attempt} 次：captcha 取圖 timeout 或錯誤 → {e}")
             return fallback_text, method_used
 
         # ✅ 圖片過小則自動刷新，避免 2Captcha 拒收
@@ -407,51 +2587,45 @@ async def _solve_captcha(page, attempt, player_id):
             await _refresh_captcha(page, player_id=player_id)
             return fallback_text, method_used
 
-        # 強化圖片 → base64 編碼
-        b64_img = preprocess_image_for_2captcha(captcha_bytes)
-
-        logger.info(f"[{player_id}] 第 {attempt} 次：使用 2Captcha 辨識")
-        result = await solve_with_2captcha(b64_img)
-        if result == "UNSOLVABLE":
-            logger.warning(f"[{player_id}] 第 {attempt} 次：2Captcha 回傳無解 → 自動刷新圖")
-            log_entry(attempt, info="2Captcha 回傳 UNSOLVABLE")
-            await _refresh_captcha(page, player_id=player_id)
-            return fallback_text, method_used
+        # 依 CAPTCHA_BACKENDS 對沖辨識，取第一個通過格式檢查的答案
+        answer, backend = await captcha_solver.solve(captcha_bytes, player_id=player_id)
+        if answer:
+            logger.info(f"[{player_id}] 第 {attempt} 次：{backend} 成功辨識 → {answer}")
+            return answer, backend
 
-        if result:
-            result = result.strip()
-            if len(result) == 4 and result.isalnum():
-                method_used = "2captcha"
-                logger.info(f"[{player_id}] 第 {attempt} 次：2Captcha 成功辨識 → {result}")
-                return result, method_used
-            else:
-                logger.warning(f"[{player_id}] 第 {attempt} 次：2Captcha 回傳長度不符（{len(result)}字 → {result}），強制刷新")
-                await _refresh_captcha(page, player_id=player_id)
-                return fallback_text, method_used
+        logger.warning(f"[{player_id}] 第 {attempt} 次：所有辨識後端皆無有效答案 → 自動刷新圖")
+        log_entry(attempt, info="所有辨識後端皆無有效答案")
+        await _refresh_captcha(page, player_id=player_id)
+        return fallback_text, method_used
 
     except Exception as e:
         logger.exception(f"[{player_id}] 第 {attempt} 次：例外錯誤：{e}")
         return fallback_text, method_used
 
+CAPTCHA_THRESHOLD_MODE = os.getenv("CAPTCHA_THRESHOLD_MODE", "fixed")  # fixed / otsu / adaptive
+CAPTCHA_DENOISE = os.getenv("CAPTCHA_DENOISE", "none")                 # none / median / open
+if CAPTCHA_THRESHOLD_MODE not in THRESHOLD_MODES:
+    logger.error(f"❌ 未知的 CAPTCHA_THRESHOLD_MODE：{CAPTCHA_THRESHOLD_MODE}，改用 fixed / Unknown threshold mode")
+    CAPTCHA_THRESHOLD_MODE = "fixed"
+if CAPTCHA_DENOISE not in DENOISE_MODES:
+    logger.error(f"❌ 未知的 CAPTCHA_DENOISE：{CAPTCHA_DENOISE}，改用 none / Unknown denoise mode")
+    CAPTCHA_DENOISE = "none"
+
 def preprocess_image_for_2captcha(img_bytes, scale=2.5):
-    """轉灰階、二值化、放大並轉 base64 編碼"""
-    img = Image.open(BytesIO(img_bytes)).convert("L")  # 灰階
-    img = img.point(lambda x: 0 if x < 140 else 255, '1')  # 二值化
-    new_size = (int(img.width * scale), int(img.height * scale))
-    img = img.resize(new_size, Image.LANCZOS)
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
-
-def _clean_ocr_text(text):
+    """轉灰階、放大、二值化並轉 base64 編碼（cv2 向量化，二值化與去雜訊方式可由環境變數切換）"""
+    img = preprocess_captcha(img_bytes, scale=scale, threshold=CAPTCHA_THRESHOLD_MODE, denoise=CAPTCHA_DENOISE)
+    return encode_png_base64(img)
+
+def _clean_ocr_text(text, fix_confusables=True):
     """替換常見誤判字元並移除非字母數字"""
     corrections = {
         "0": "O", "1": "I", "5": "S", "8": "B", "$": "S", "6": "G",
         "l": "I", "|": "I", "2": "Z", "9": "g", "§": "S", "£": "E",
         "4": "A", "@": "A"
     }
-    for wrong, correct in corrections.items():
-        text = text.replace(wrong, correct)
+    if fix_confusables:
+        for wrong, correct in corrections.items():
+            text = text.replace(wrong, correct)
     return ''.join(filter(str.isalnum, text))
 
 def _save_debug_captcha_image(img_np, label, player_id, attempt):
@@ -468,6 +2642,43 @@ def _save_blank_captcha_image(player_id, attempt):
         os.path.join(date_folder, f"captcha_{player_id}_attempt{attempt}_blank_none.png")
     )
 
+# === 本地 OCR 驗證碼辨識 ===
+LOCAL_OCR_MIN_CONFIDENCE = float(os.getenv("LOCAL_OCR_MIN_CONFIDENCE", "0.85"))  # 高於此信心值直接採用，否則交給 2Captcha
+OCR_ALLOWLIST = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+_ocr_lock = threading.Lock()  # EasyOCR 模型非執行緒安全，辨識一次一張
+
+def _get_easyocr_reader():
+    global reader
+    if reader is None:
+        with suppress_stdout():  # 避免首次下載模型的進度輸出洗版
+            reader = easyocr.Reader(["en"], gpu=False, verbose=False)
+    return reader
+
+def _preprocess_for_ocr(img_bytes):
+    """灰階 → 放大 → 去雜訊 → Otsu 二值化"""
+    return preprocess_captcha(img_bytes, scale=2, threshold="otsu", denoise="median", interpolation="cubic")
+
+def solve_with_local_ocr(img_bytes):
+    """本地 OCR 辨識驗證碼，回傳 (文字, 信心值 0~1, 引擎名稱)；格式不符時信心值為 0"""
+    img = _preprocess_for_ocr(img_bytes)
+    with _ocr_lock:
+        if USE_EASYOCR:
+            engine = "easyocr"
+            results = _get_easyocr_reader().readtext(img, allowlist=OCR_ALLOWLIST, detail=1, paragraph=False)
+            text = "".join(r[1] for r in results)
+            confidence = min((float(r[2]) for r in results), default=0.0)
+        else:
+            engine = "tesseract"
+            data = pytesseract.image_to_data(img, config=OCR_CONFIG, output_type=pytesseract.Output.DICT)
+            words = [(t, float(c)) for t, c in zip(data["text"], data["conf"]) if t.strip() and float(c) >= 0]
+            text = "".join(t for t, _ in words)
+            confidence = min((c for _, c in words), default=0.0) / 100
+
+    text = _clean_ocr_text(text, fix_confusables=False)
+    if not (len(text) == 4 and text.isalnum()):
+        confidence = 0.0
+    return text, confidence, engine
+
 CAPTCHA_API_KEY = os.getenv("CAPTCHA_API_KEY")
 CAPTCHA_DAILY_LIMIT = 30
 CAPTCHA_USAGE_FILE = "captcha_usage.txt"
@@ -494,22 +2705,56 @@ def check_captcha_limit():
             f.write(f"{today},1")
         return True
 
-async def solve_with_2captcha(b64_img):
-    api_key = os.getenv("CAPTCHA_API_KEY")
-    payload = {
-        "key": api_key,
-        "method": "base64",
-        "body": b64_img,
-        "json": 1,
-        "numeric": 0,
-        "min_len": 4,
-        "max_len": 5,
-        "language": 2
-    }
+# === 2Captcha 用戶端 ===
+TWOCAPTCHA_URL = "http://2captcha.com"
+TWOCAPTCHA_DEFAULT_POLL_SCHEDULE = [3, 2, 2, 2, 3, 3, 5]  # 秒；先密後疏，最後一項持續沿用
 
-    async with aiohttp.ClientSession() as session:
+def _parse_poll_schedule(raw):
+    try:
+        schedule = [float(x) for x in (raw or "").split(",") if x.strip()]
+    except ValueError:
+        schedule = []
+    if not schedule or any(x <= 0 for x in schedule):
+        if raw:
+            logger.warning(f"TWOCAPTCHA_POLL_SCHEDULE 格式錯誤，改用預設值 / Invalid poll schedule: {raw}")
+        return list(TWOCAPTCHA_DEFAULT_POLL_SCHEDULE)
+    return schedule
+
+TWOCAPTCHA_POLL_SCHEDULE = _parse_poll_schedule(os.getenv("TWOCAPTCHA_POLL_SCHEDULE"))
+TWOCAPTCHA_TIMEOUT = 100       # 秒；單張驗證碼最長等待
+TWOCAPTCHA_COALESCE_WINDOW = 1  # 秒；快到期的查詢併入同一次 multi-ID 請求
+
+class TwoCaptchaClient:
+    """程序共用的 2Captcha 用戶端：單一連線池、先密後疏輪詢，多張待解時以 action=get&ids= 一次查完"""
+
+    def __init__(self):
+        self._session = None
+        self._waiters = {}  # request_id -> {"future", "polls", "next_poll"}
+        self._poller = None
+        self.submitted = 0
+        self.poll_requests = 0
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=20),
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+        return self._session
+
+    async def submit(self, b64_img):
+        payload = {
+            "key": os.getenv("CAPTCHA_API_KEY", ""),
+            "method": "base64",
+            "body": b64_img,
+            "json": 1,
+            "numeric": 0,
+            "min_len": 4,
+            "max_len": 5,
+            "language": 2
+        }
         try:
-            async with session.post("http://2captcha.com/in.php", data=payload) as resp:
+            async with self._get_session().post(f"{TWOCAPTCHA_URL}/in.php", data=payload) as resp:
                 if resp.content_type != "application/json":
                     text = await resp.text()
                     logger.error(f"2Captcha 提交回傳非 JSON（{resp.status}）：{text}")
@@ -520,104 +2765,363 @@ async def solve_with_2captcha(b64_img):
                     logger.warning(f"2Captcha 提交失敗：{res}")
                     return None
 
-                request_id = res["request"]
+                self.submitted += 1
+                return res["request"]
         except Exception as e:
             logger.exception(f"提交 2Captcha 發生錯誤：{e}")
             return None
 
-        # 等待辨識結果
-        for _ in range(20):
-            await asyncio.sleep(5)
-            try:
-                async with session.get(f"http://2captcha.com/res.php?key={api_key}&action=get&id={request_id}&json=1") as resp:
-                    if resp.content_type != "application/json":
-                        text = await resp.text()
-                        logger.error(f"2Captcha 查詢回傳非 JSON（{resp.status}）：{text}")
-                        return None
-
-                    result = await resp.json()
-                    if result.get("status") == 1:
-                        return result.get("request")
-                    if result.get("request") == "ERROR_CAPTCHA_UNSOLVABLE":
-                        logger.warning(f"2Captcha 回傳無法解碼錯誤 → {result}")
-                        return "UNSOLVABLE"
-                    elif result.get("request") != "CAPCHA_NOT_READY":
-                        logger.warning(f"2Captcha 回傳錯誤結果：{result}")
-                        return None
+    async def solve(self, b64_img):
+        """提交並等待結果；回傳答案、"UNSOLVABLE" 或 None"""
+        request_id = await self.submit(b64_img)
+        if not request_id:
+            return None
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = {"future": future, "polls": 0, "next_poll": time.monotonic() + TWOCAPTCHA_POLL_SCHEDULE[0]}
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll_loop())
+        try:
+            return await asyncio.wait_for(future, timeout=TWOCAPTCHA_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"2Captcha 等待逾時（{request_id}）")
+            return None
+        finally:
+            self._waiters.pop(request_id, None)
+
+    def _reschedule(self, waiter):
+        waiter["polls"] += 1
+        delay = TWOCAPTCHA_POLL_SCHEDULE[min(waiter["polls"], len(TWOCAPTCHA_POLL_SCHEDULE) - 1)]
+        waiter["next_poll"] = time.monotonic() + delay
+
+    async def _poll_loop(self):
+        while True:
+            active = {rid: w for rid, w in self._waiters.items() if not w["future"].done()}
+            if not active:
+                return
+            now = time.monotonic()
+            next_due = min(w["next_poll"] for w in active.values())
+            if next_due > now:
+                await asyncio.sleep(next_due - now)
+                continue
 
+            due = [rid for rid, w in active.items() if w["next_poll"] <= now + TWOCAPTCHA_COALESCE_WINDOW]
+            try:
+                answers = await self._fetch(due)
             except Exception as e:
-                logger.exception(f"查詢 2Captcha 結果發生錯誤：{e}")
-                return None
+                # 網路暫時性錯誤：照排程稍後重查，不讓一次失敗拖垮所有待解驗證碼
+                logger.warning(f"查詢 2Captcha 結果發生錯誤，稍後重試：{e}")
+                answers = {}
+
+            for rid in due:
+                waiter = active[rid]
+                if waiter["future"].done():
+                    continue
+                answer = answers.get(rid)
+                if answer is None or answer == "CAPCHA_NOT_READY":
+                    self._reschedule(waiter)
+                elif answer == "ERROR_CAPTCHA_UNSOLVABLE":
+                    logger.warning(f"2Captcha 回傳無法解碼錯誤 → {rid}")
+                    waiter["future"].set_result("UNSOLVABLE")
+                elif answer.startswith("ERROR"):
+                    logger.warning(f"2Captcha 回傳錯誤結果：{rid} → {answer}")
+                    waiter["future"].set_result(None)
+                else:
+                    waiter["future"].set_result(answer)
+
+    async def _fetch(self, request_ids):
+        """查詢多筆結果，回傳 {request_id: 答案或狀態碼}"""
+        api_key = os.getenv("CAPTCHA_API_KEY", "")
+        self.poll_requests += 1
+        session = self._get_session()
+        if len(request_ids) == 1:
+            rid = request_ids[0]
+            async with session.get(f"{TWOCAPTCHA_URL}/res.php", params={"key": api_key, "action": "get", "id": rid, "json": 1}) as resp:
+                if resp.content_type != "application/json":
+                    text = await resp.text()
+                    logger.error(f"2Captcha 查詢回傳非 JSON（{resp.status}）：{text}")
+                    return {rid: None}
+                result = await resp.json()
+                return {rid: result.get("request")}
+
+        # multi-ID：回傳以 | 分隔、與 ids 同順序的結果
+        async with session.get(f"{TWOCAPTCHA_URL}/res.php", params={"key": api_key, "action": "get", "ids": ",".join(request_ids)}) as resp:
+            text = (await resp.text()).strip()
+        parts = text.split("|")
+        if len(parts) != len(request_ids):
+            logger.error(f"2Captcha multi-ID 查詢回傳格式不符：{text}")
+            return {rid: None for rid in request_ids}
+        return dict(zip(request_ids, parts))
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    def stats(self):
+        return {"outstanding": len(self._waiters), "submitted": self.submitted, "poll_requests": self.poll_requests}
+
+two_captcha = TwoCaptchaClient()
+
+async def solve_with_2captcha(b64_img):
+    return await two_captcha.solve(b64_img)
+
+# === 驗證碼辨識後端（可插拔、對沖）===
+CAPTCHA_BACKENDS = [b.strip() for b in os.getenv("CAPTCHA_BACKENDS", "local,2captcha").split(",") if b.strip()]
+CAPTCHA_HEDGE_DELAY = float(os.getenv("CAPTCHA_HEDGE_DELAY", "3"))  # 秒；前一個後端超過此時間未回就同時啟動下一個
+
+def is_valid_captcha_answer(text):
+    return bool(text) and len(text) == 4 and text.isalnum()
+
+class CaptchaSolver(abc.ABC):
+    """驗證碼辨識後端介面：solve() 回傳答案字串，無解回傳 None"""
+    name = "base"
+
+    @abc.abstractmethod
+    async def solve(self, img_bytes):
+        ...
+
+class LocalOCRSolver(CaptchaSolver):
+    name = "local"
+
+    def __init__(self, min_confidence=LOCAL_OCR_MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+
+    async def solve(self, img_bytes):
+        text, confidence, engine = await asyncio.get_running_loop().run_in_executor(None, solve_with_local_ocr, img_bytes)
+        if confidence >= self.min_confidence:
+            return text
+        logger.info(f"{engine} 信心不足（{confidence:.2f} → {text}） / Low OCR confidence")
+        return None
 
+class TwoCaptchaSolver(CaptchaSolver):
+    name = "2captcha"
+
+    async def solve(self, img_bytes):
+        loop = asyncio.get_running_loop()
+        b64_img = await loop.run_in_executor(None, preprocess_image_for_2captcha, img_bytes)
+        result = await solve_with_2captcha(b64_img)
+        if not result or result == "UNSOLVABLE":
+            return None
+        return result.strip()
+
+CAPTCHA_SOLVER_REGISTRY = {
+    LocalOCRSolver.name: LocalOCRSolver,
+    TwoCaptchaSolver.name: TwoCaptchaSolver,
+}
+
+class HedgedCaptchaSolver:
+    """依序啟動各後端：前一個在延遲預算內沒回應就同時啟動下一個，回傳無效答案則立即啟動下一個，先得有效答案者勝"""
+
+    def __init__(self, backends, hedge_delay=CAPTCHA_HEDGE_DELAY):
+        self.backends = backends
+        self.hedge_delay = hedge_delay
+        self._stats = {b.name: {"started": 0, "valid": 0, "wins": 0, "errors": 0, "seconds": 0.0} for b in backends}
+        self._interrupted = set()  # 辨識途中被取消（多半是外層兌換逾時）的玩家
+
+    async def _run(self, backend, img_bytes, player_id):
+        stats = self._stats[backend.name]
+        stats["started"] += 1
+        t0 = time.time()
+        try:
+            answer = await backend.solve(img_bytes)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats["errors"] += 1
+            logger.warning(f"[{player_id}] {backend.name} 辨識發生錯誤：{e}")
+            return None
+        finally:
+            stats["seconds"] += time.time() - t0
+        answer = answer.strip() if answer else answer
+        if is_valid_captcha_answer(answer):
+            stats["valid"] += 1
+            return answer
+        if answer:
+            logger.warning(f"[{player_id}] {backend.name} 回傳格式不符（{len(answer)}字 → {answer}）")
+        return None
+
+    async def solve(self, img_bytes, player_id=None):
+        """回傳 (答案, 後端名稱)；全部失敗回傳 (None, None)"""
+        waiting = list(self.backends)
+        pending = {}
+
+        def launch_next():
+            backend = waiting.pop(0)
+            pending[asyncio.create_task(self._run(backend, img_bytes, player_id))] = backend
+
+        launch_next()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, timeout=self.hedge_delay if waiting else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    logger.info(f"[{player_id}] 辨識超過 {self.hedge_delay}s，啟動下一個後端 / Hedging to next backend")
+                    launch_next()
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    answer = task.result()
+                    if answer:
+                        self._stats[backend.name]["wins"] += 1
+                        return answer, backend.name
+                    if waiting:
+                        launch_next()
+            return None, None
+        except asyncio.CancelledError:
+            self._interrupted.add(player_id)
+            raise
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def interrupted(self, player_id):
+        """該玩家上次辨識是否被中途取消；讀取後清除"""
+        if player_id in self._interrupted:
+            self._interrupted.discard(player_id)
+            return True
+        return False
+
+    def stats(self):
+        return {
+            name: {**s, "seconds": round(s["seconds"], 1)}
+            for name, s in self._stats.items()
+        }
+
+def build_captcha_solver(names):
+    """依名稱建立對沖辨識器；未知名稱記錄後略過，全部無效時退回預設後端"""
+    unknown = [name for name in names if name not in CAPTCHA_SOLVER_REGISTRY]
+    if unknown:
+        logger.error(f"❌ 未知的 CAPTCHA_BACKENDS：{unknown}，可用：{list(CAPTCHA_SOLVER_REGISTRY)} / Unknown captcha backends skipped")
+    known = [name for name in names if name in CAPTCHA_SOLVER_REGISTRY] or list(CAPTCHA_SOLVER_REGISTRY)
+    return HedgedCaptchaSolver([CAPTCHA_SOLVER_REGISTRY[name]() for name in known])
+
+captcha_solver = build_captcha_solver(CAPTCHA_BACKENDS)
+
+# === 驗證碼圖片攔截（事件驅動刷新）===
+CAPTCHA_API_PATTERN = os.getenv("CAPTCHA_API_PATTERN", "/api/captcha")  # 驗證碼圖片或其 JSON 的網址片段
+CAPTCHA_REFRESH_TIMEOUT = float(os.getenv("CAPTCHA_REFRESH_TIMEOUT", "6"))  # 秒；等新圖的上限
+captcha_refresh_stats = {"screenshots": 0}  # 刷新的勝出條件與耗時見 wait_stats["captcha_refresh"]
+
+def _decode_data_url(src):
+    if src and src.startswith("data:image") and "," in src:
+        with contextlib.suppress(Exception):
+            return base64.b64decode(src.split(",", 1)[1])
     return None
 
+class CaptchaWatcher:
+    """監聽頁面的驗證碼回應：新圖到達時直接保存 bytes 並喚醒等待者，取代截圖 + MD5 輪詢"""
+    _watchers = weakref.WeakKeyDictionary()
+
+    def __init__(self, page):
+        self.page = page
+        self.version = 0
+        self.image = None
+        self._changed = asyncio.Event()
+        page.on("response", self._on_response)
+
+    @classmethod
+    def of(cls, page):
+        """取得（或建立）頁面的監聽器；應在登入前建立，才能攔到第一張驗證碼"""
+        watcher = cls._watchers.get(page)
+        if watcher is None:
+            watcher = cls._watchers[page] = cls(page)
+        return watcher
+
+    async def _on_response(self, response):
+        if CAPTCHA_API_PATTERN not in response.url:
+            return
+        try:
+            if response.request.resource_type == "image":
+                body = await response.body()
+            else:
+                data = (await response.json()).get("data") or {}
+                body = _decode_data_url(data.get("img"))
+        except Exception:
+            return
+        if body:
+            self.image = body
+            self.version += 1
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    async def wait_for_new(self, version, timeout):
+        """等到網路上出現比 version 更新的驗證碼圖"""
+        deadline = time.monotonic() + timeout
+        while self.version <= version:
+            await asyncio.wait_for(self._changed.wait(), max(0.0, deadline - time.monotonic()))
+        return self.image
+
+    async def current(self, captcha_img=None):
+        """目前顯示中的驗證碼 bytes：優先 data URL，其次攔截到的圖，最後才截圖"""
+        captcha_img = captcha_img or await self.page.query_selector(".verify_pic")
+        if not captcha_img:
+            return None
+        image = _decode_data_url(await captcha_img.get_attribute("src"))
+        if image:
+            return image
+        if self.image:
+            return self.image
+        captcha_refresh_stats["screenshots"] += 1
+        return await asyncio.wait_for(captcha_img.screenshot(), timeout=10)
+
+async def _dismiss_modal(page, attempts=3):
+    # 按下確認並等 modal 消失（不再固定等 1 秒）
+    for _ in range(attempts):
+        modal = await page.query_selector('.message_modal')
+        if not modal or not await modal.is_visible():
+            return
+        confirm_btn = await modal.query_selector('.confirm_btn')
+        if confirm_btn and await confirm_btn.is_visible():
+            await confirm_btn.click()
+        with contextlib.suppress(TimeoutError):
+            await page.wait_for_selector('.message_modal', state="hidden", timeout=1000)
+
 async def _refresh_captcha(page, player_id=None):
+    """點擊刷新並等新圖到達（網路回應或 src 變更），回傳新圖 bytes；失敗回傳 None"""
     try:
         refresh_btn = await page.query_selector('.reload_btn')
         captcha_img = await page.query_selector('.verify_pic')
         if not refresh_btn or not captcha_img:
             logger.info(f"[{player_id}] 無法定位驗證碼圖片或刷新按鈕")
-            return
-
-        # 先確保 modal 已經關閉
-        for _ in range(10):
-            modal = await page.query_selector('.message_modal')
-            if not modal:
-                break
-            confirm_btn = await modal.query_selector('.confirm_btn')
-            if confirm_btn and await confirm_btn.is_visible():
-                await confirm_btn.click()
-            await page.wait_for_timeout(1000)
+            return None
 
-        try:
-            original_bytes = await asyncio.wait_for(captcha_img.screenshot(), timeout=10)
-        except Exception as e:
-            logger.warning(f"[{player_id}] captcha 原圖 screenshot timeout 或錯誤 → {e} / original captcha screenshot timeout or error")
-            return
-        original_hash = hashlib.md5(original_bytes).hexdigest() if original_bytes else ""
+        await _dismiss_modal(page)
 
-        # 點擊刷新按鈕
+        watcher = CaptchaWatcher.of(page)
+        version = watcher.version
+        old_src = await captcha_img.get_attribute("src")
         await refresh_btn.click()
-        await page.wait_for_timeout(1500)
-
-        # 處理 modal（如果彈出錯誤訊息）
-        for _ in range(8):
-            modal = await page.query_selector('.message_modal')
-            if modal:
-                msg_el = await modal.query_selector('p.msg')
-                if msg_el:
-                    msg_text = await msg_el.inner_text()
-                    logger.info(f"[{player_id}] Captcha Modal：{msg_text.strip()}")
-                    if any(k in msg_text for k in ["過於頻繁", "伺服器繁忙", "請稍後再試"]):
-                        confirm_btn = await modal.query_selector('.confirm_btn')
-                        if confirm_btn:
-                            await confirm_btn.click()
-                        await page.wait_for_timeout(1500)
-                        return
-            await page.wait_for_timeout(300)
-
-        # 等待圖刷新
-        for i in range(30):
-            await page.wait_for_timeout(150)
-            try:
-                new_bytes = await asyncio.wait_for(captcha_img.screenshot(), timeout=10)
-            except Exception as e:
-                logger.warning(f"[{player_id}] captcha 新圖 screenshot timeout 或錯誤（第 {i+1} 次）→ {e}")
-                continue
 
-            if not new_bytes or len(new_bytes) < 1024:
-                continue
-            new_hash = hashlib.md5(new_bytes).hexdigest()
-            if new_hash != original_hash:
-                box = await captcha_img.bounding_box()
-                if box and box["height"] > 10:
-                    logger.info(f"[{player_id}] 成功刷新驗證碼 (hash 第 {i+1} 次變化)")
-                    return
-        else:
+        # 三者取先到：攔截到新圖、<img> src 變更、跳出錯誤 modal（可能是節流）
+        timeout_ms = CAPTCHA_REFRESH_TIMEOUT * 1000
+        winner, _, _ = await wait_first({
+            "network": watcher.wait_for_new(version, CAPTCHA_REFRESH_TIMEOUT),
+            "src": page.wait_for_function(
+                "old => { const el = document.querySelector('.verify_pic'); return el && el.src && el.src !== old; }",
+                arg=old_src, timeout=timeout_ms
+            ),
+            "modal": page.wait_for_selector(".message_modal p.msg", timeout=timeout_ms)
+        }, CAPTCHA_REFRESH_TIMEOUT, label="captcha_refresh")
+
+        if winner is None:
             logger.info(f"[{player_id}] 刷新失敗：圖片內容未更新 / Refresh failed: Captcha image did not update")
+            return None
+
+        if winner == "modal":
+            msg_text = await page.inner_text(".message_modal p.msg")
+            logger.info(f"[{player_id}] Captcha Modal：{msg_text.strip()}")
+            if any(k in msg_text for k in THROTTLE_KEYWORDS):
+                rate_controller.on_throttle(player_id)
+            await _dismiss_modal(page)
+            return None
+
+        logger.info(f"[{player_id}] 成功刷新驗證碼（{winner}） / Captcha refreshed via {winner}")
+        return await watcher.current(captcha_img)
 
     except Exception as e:
         logger.info(f"[{player_id}] Captcha 刷新例外：{str(e)} / Refresh captcha exception: {str(e)}")
+        return None
 
 async def _package_result(page, success, message, player_id, debug_logs, debug=False):
     result = {
@@ -640,53 +3144,187 @@ async def _package_result(page, success, message, player_id, debug_logs, debug=F
             debug_logs.append({"error": f"[{player_id}] 無法擷取 debug 畫面: {str(e)}"})
     return result
 
-# === Flask API ===
-@app.route("/add_id", methods=["POST"])
-def add_id():
+# === HTTP 兌換引擎（不開瀏覽器）===
+GIFTCODE_API_URL = os.getenv("GIFTCODE_API_URL", "https://wos-giftcode-api.centurygame.com/api")
+GIFTCODE_SIGN_SALT = os.getenv("GIFTCODE_SIGN_SALT", "tB87#kPtkxqOS2")
+HTTP_ENGINE_POOL_SIZE = int(os.getenv("HTTP_ENGINE_POOL_SIZE", "20"))   # 連線池上限
+HTTP_ENGINE_TIMEOUT = float(os.getenv("HTTP_ENGINE_TIMEOUT", "15"))     # 秒；單一 API 呼叫
+REDEEM_ENGINES = ("browser", "http")
+REDEEM_ENGINE = os.getenv("REDEEM_ENGINE", "browser")  # 預設引擎，可由每個請求的 engine 欄位覆寫
+
+def sign_giftcode_params(params, salt=GIFTCODE_SIGN_SALT):
+    """依鍵排序串成 k=v&k=v，加鹽取 MD5 作為 sign（與網站前端相同）"""
+    query = "&".join(f"{key}={params[key]}" for key in sorted(params))
+    return {**params, "sign": hashlib.md5((query + salt).encode("utf-8")).hexdigest()}
+
+class HttpRedeemEngine:
+    """以共用 aiohttp 連線池直接呼叫禮包碼 API（登入 → 取驗證碼 → 兌換），回傳格式與 _redeem_once 相同"""
+
+    def __init__(self, base_url=GIFTCODE_API_URL, pool_size=HTTP_ENGINE_POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = max(1, pool_size)
+        self._session = None
+        self.requests = 0
+        self.redeems = 0
+
+    def _client(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=HTTP_ENGINE_TIMEOUT)
+            )
+        return self._session
+
+    async def call(self, path, **params):
+        params = sign_giftcode_params({**params, "time": int(time.time() * 1000)})
+        self.requests += 1
+        async with self._client().post(f"{self.base_url}{path}", data=params) as resp:
+            return await resp.json(content_type=None)
+
+    async def redeem(self, player_id, code, debug_logs, redeem_retry, debug=False):
+        return (await self.redeem_codes(player_id, [code], debug_logs, redeem_retry, debug=debug))[code]
+
+    async def redeem_codes(self, player_id, codes, debug_logs, redeem_retry, debug=False):
+        """登入一次，依序兌換所有禮包碼；回傳 {code: result}"""
+        def log_entry(attempt, **kwargs):
+            entry = {"redeem_retry": redeem_retry, "attempt": attempt, "engine": "http"}
+            entry.update(kwargs)
+            debug_logs.append(entry)
+
+        self.redeems += 1
+        results = {}
+        try:
+            login = await self.call("/player", fid=player_id)
+            kind, reason = classify_giftcode_payload(login) or ("failed", f"無效回傳：{login}")
+            if kind != "success":
+                message = (login.get("msg") if isinstance(login, dict) else None) or reason
+                log_entry(0, login_outcome=kind, error_modal=message)
+                if kind not in ("retry", "throttle"):
+                    reason = f"登入失敗：{message}"
+                return dict.fromkeys(codes, await _package_result(None, False, reason, player_id, debug_logs))
+            nickname = (login.get("data") or {}).get("nickname")
+            if nickname:
+                name_directory.put(player_id, nickname)
+
+            for code in codes:
+                results[code] = await self._exchange(
+                    player_id, code, lambda attempt, code=code, **kwargs: log_entry(attempt, code=code, **kwargs), debug_logs
+                )
+            return results
+
+        except Exception as e:
+            logger.exception(f"[{player_id}] HTTP 兌換發生例外錯誤：{e}")
+            failure = {"player_id": player_id, "success": False, "reason": "例外錯誤", "debug_logs": debug_logs}
+            return {code: results.get(code, failure) for code in codes}
+
+    async def _exchange(self, player_id, code, log_entry, debug_logs):
+        for attempt in range(1, OCR_MAX_RETRIES + 1):
+            captcha = await self.call("/captcha", fid=player_id, init=0)
+            captcha_bytes = _decode_data_url(((captcha or {}).get("data") or {}).get("img"))
+            if not captcha_bytes:
+                kind, reason = classify_giftcode_payload(captcha) or ("failed", f"無效回傳：{captcha}")
+                log_entry(attempt, captcha_error=reason)
+                if kind in ("retry", "throttle"):
+                    return await _package_result(None, False, reason, player_id, debug_logs)
+                continue
+
+            answer, backend = await captcha_solver.solve(captcha_bytes, player_id=player_id)
+            log_entry(attempt, captcha_text=answer, method=backend)
+            if not answer:
+                continue
+
+            result = await self.call("/gift_code", fid=player_id, cdk=code, captcha_code=answer)
+            kind, reason = classify_giftcode_payload(result) or ("failed", f"無效回傳：{result}")
+            log_entry(attempt, server_code=(result or {}).get("err_code"), server_message=reason, source="json")
+            logger.info(f"[{player_id}] 第 {attempt} 次（HTTP）：伺服器回應：{reason}")
+            if kind == "success":
+                return await _package_result(None, True, reason, player_id, debug_logs)
+            if kind == "captcha":
+                continue
+            return await _package_result(None, False, reason, player_id, debug_logs)
+
+        logger.info(f"[{player_id}] 最終失敗：驗證碼三次辨識皆失敗 / Final failure: CAPTCHA failed 3 times")
+        return await _package_result(None, False, "驗證碼三次辨識皆失敗，放棄兌換", player_id, debug_logs)
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    def stats(self):
+        return {"requests": self.requests, "redeems": self.redeems}
+
+http_engine = HttpRedeemEngine()
+
+# === 名稱批次更新 ===
+NAME_REFRESH_MAX_AGE_HOURS = float(os.getenv("NAME_REFRESH_MAX_AGE_HOURS", "24"))  # 近期更新過的 ID 不重查
+NAME_REFRESH_WRITE_BATCH = int(os.getenv("NAME_REFRESH_WRITE_BATCH", "100"))  # 查到幾筆就先寫入一批
+DISCORD_MESSAGE_LIMIT = 1900  # Discord 單則 2000 字，保留餘裕
+
+def _age_seconds(ts):
+    """Firestore 時間戳距今秒數；無時間戳回傳 None"""
+    if not isinstance(ts, datetime):
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)  # 舊資料以 datetime.utcnow() 寫入
+    return (datetime.now(timezone.utc) - ts).total_seconds()
+
+def post_webhook_lines(webhook_url, header, lines):
+    """把多行內容依 Discord 長度上限切成數則訊息送出"""
+    messages = []
+    current = header
+    for line in lines:
+        if len(current) + len(line) + 1 > DISCORD_MESSAGE_LIMIT:
+            messages.append(current)
+            current = ""
+        current += ("\n" if current else "") + line
+    messages.append(current)
+    for content in messages:
+        try:
+            resp = requests.post(webhook_url, json={"content": content})
+            logger.info(f"Webhook 發送結果：{resp.status_code}")
+        except Exception as e:
+            logger.warning(f"[Webhook] 發送通知失敗：{e}")
+
+# === HTTP API（aiohttp，與兌換工作共用同一個 event loop）===
+def _json_default(value):
+    # 與原 Flask jsonify 相同：datetime 輸出為 HTTP 日期字串（GMT）
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+_json_dumps = functools.partial(json.dumps, default=_json_default)
+
+async def _json_body(request):
+    """解析 JSON body；格式錯誤或不是物件時回傳空 dict"""
+    with contextlib.suppress(Exception):
+        data = await request.json()
+        if isinstance(data, dict):
+            return data
+    return {}
+
+@routes.post("/add_id")
+async def add_id(request):
     try:
-        data = request.json
+        data = await _json_body(request)
         guild_id = data.get("guild_id")
         player_id = data.get("player_id")
 
         if not guild_id or not player_id:
-            return jsonify({"success": False, "reason": "缺少 guild_id 或 player_id / Missing guild_id or player_id"}), 400
+            return web.json_response({"success": False, "reason": "缺少 guild_id 或 player_id / Missing guild_id or player_id"}, status=400)
 
-        async def fetch_name():
-            async with async_playwright() as p:
-                browser = await p.chromium.launch(headless=True)
-                context = await browser.new_context(locale="zh-TW")
-                page = await context.new_page()
-
-                name = "未知名稱"
-                for attempt in range(3):
-                    try:
-                        await page.goto("https://wos-giftcode.centurygame.com/")
-                        await page.fill('input[type="text"]', player_id)
-                        await page.click(".login_btn")
-                        await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
-                        await page.wait_for_selector(".name", timeout=8000)
-                        name_el = await page.query_selector(".name")
-                        name = await name_el.inner_text() if name_el else "未知名稱"
-                        break
-                    except:
-                        await page.wait_for_timeout(1000 + attempt * 500)
-
-                await browser.close()
-                return name
-
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        player_name = loop.run_until_complete(fetch_name())
+        player_name = await player_lookup.lookup(player_id)
 
         # 🔍 若名稱不同才更新 Firestore
         ref = db.collection("ids").document(guild_id).collection("players").document(player_id)
-        existing_doc = ref.get()
+        existing_doc = await run_blocking(ref.get)
         existing_name = existing_doc.to_dict().get("name") if existing_doc.exists else None
 
         name_changed = existing_name != player_name
 
         if name_changed:
-            ref.set({
+            await run_blocking(ref.set, {
                 "name": player_name,
                 "updated_at": datetime.utcnow()
             }, merge=True)
@@ -709,12 +3347,12 @@ def add_id():
                         f"👤 Player ID: `{player_id}`\n"
                         f"📛 New Name: `{player_name}`"
                     )
-                requests.post(webhook_url, json={"content": content})
+                await run_blocking(requests.post, webhook_url, json={"content": content})
                 logger.info(f"[Webhook] 已發送新增或更新通知")
             except Exception as e:
                 logger.warning(f"[Webhook] 發送通知失敗：{e}")
 
-        return jsonify({
+        return web.json_response({
             "success": True,
             "message": f"已新增或更新 {player_id} 至 guild {guild_id} / Added or updated to guild {guild_id}",
             "name": player_name
@@ -722,302 +3360,302 @@ def add_id():
 
     except Exception as e:
         # 發生例外錯誤 / Exception occurred
-        return jsonify({"success": False, "reason": str(e)}), 500
+        return web.json_response({"success": False, "reason": str(e)}, status=500)
 
-@app.route("/list_ids", methods=["GET"])
-def list_ids():
+@routes.get("/list_ids")
+async def list_ids(request):
     try:
-        guild_id = request.args.get("guild_id")
+        guild_id = request.query.get("guild_id")
         if not guild_id:
-            return jsonify({"success": False, "reason": "缺少 guild_id / Missing guild_id"}), 400
+            return web.json_response({"success": False, "reason": "缺少 guild_id / Missing guild_id"}, status=400)
 
-        docs = db.collection("ids").document(guild_id).collection("players").stream()
-        players = [{"id": doc.id, **doc.to_dict()} for doc in docs]
+        def list_players():
+            docs = db.collection("ids").document(guild_id).collection("players").stream()
+            return [{"id": doc.id, **doc.to_dict()} for doc in docs]
 
-        return jsonify({"success": True, "players": players})
+        players = await run_blocking(list_players)
+        name_directory.put_many({p["id"]: p.get("name") for p in players if p.get("name") != "未知名稱"})
+
+        return web.json_response({"success": True, "players": players}, dumps=_json_dumps)
 
     except Exception as e:
         # 發生例外錯誤 / Exception occurred
-        return jsonify({"success": False, "reason": str(e)}), 500
+        return web.json_response({"success": False, "reason": str(e)}, status=500)
 
-@app.route("/redeem_submit", methods=["POST"])
-def redeem_submit():
-    data = request.json
+@routes.post("/redeem_submit")
+async def redeem_submit(request):
+    data = await _json_body(request)
     code = data.get("code")
     player_ids = data.get("player_ids")
     debug = data.get("debug", False)
+    engine = data.get("engine") or REDEEM_ENGINE
 
     if not code:
-        return jsonify({"success": False, "reason": "缺少 code / Missing code"}), 400
-
-    if not isinstance(player_ids, list) or not player_ids:
-        return jsonify({"success": False, "reason": "缺少或無效的 player_ids（空或非 list） / Missing or invalid player_ids (empty or not a list)"}), 400
-
-    MAX_BATCH_SIZE = 5
-    start_time = time.time()
-
-    async def process_all():
-        all_success = []
-        all_fail = []
-        final_failed_ids = []
-
-        async def fetch_and_store_name(pid):
-            async with async_playwright() as p:
-                browser = await p.chromium.launch(headless=True)
-                context = await browser.new_context(locale="zh-TW")
-                page = await context.new_page()
-                name = "未知名稱"
-                for attempt in range(3):
-                    try:
-                        await page.goto("https://wos-giftcode.centurygame.com/")
-                        await page.fill('input[type="text"]', pid)
-                        await page.click(".login_btn")
-                        await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
-                        await page.wait_for_selector(".name", timeout=5000)
-                        name_el = await page.query_selector(".name")
-                        name = await name_el.inner_text() if name_el else "未知名稱"
-                        break
-                    except:
-                        await page.wait_for_timeout(1000 + attempt * 500)
-                await browser.close()
-                return name
-
-        # 先查 Firestore 並補全缺失 ID
-        doc_ref_base = db.collection("ids")
-        loop = asyncio.get_event_loop()
-        for pid in player_ids:
-            doc_ref = doc_ref_base.document("global").collection("players").document(pid)
-            if not doc_ref.get().exists:
-                name = loop.run_until_complete(fetch_and_store_name(pid))
-                doc_ref.set({
-                    "name": name,
-                    "updated_at": datetime.utcnow()
-                }, merge=True)
-                logger.info(f"[{pid}] 📌 已自動新增至資料庫：{name} / Auto-added to database: {name}")
-
-        # ✅ 濾除已兌換成功或已領取過的 ID（避免浪費 2Captcha）
-        success_docs = db.collection("success_redeems").document(code).collection("players").stream()
-        already_redeemed_ids = {doc.id for doc in success_docs}
-
-        filtered_player_ids = [pid for pid in player_ids if pid not in already_redeemed_ids]
-        logger.info(f"⏩ 已跳過 {len(already_redeemed_ids)} 筆已成功或已領取的 ID（共輸入 {len(player_ids)} 筆）")
-
-        # 防呆檢查，確保過濾邏輯正確
-        if debug:
-            for pid in filtered_player_ids:
-                assert pid not in already_redeemed_ids, f"過濾失敗，{pid} 應已在 success_redeems 中"
-
-        if not filtered_player_ids:
-            logger.info("🎉 所有 ID 皆已兌換成功或已領取過，無需再處理")
-
-            if os.getenv("DISCORD_WEBHOOK_URL"):
-                try:
-                    resp = requests.post(os.getenv("DISCORD_WEBHOOK_URL"), json={
-                        "content": f"🎉 所有 ID 皆已兌換成功或已領取過，無需再處理\n禮包碼：{code}"
-                    })
-                    logger.info(f"Webhook 發送結果：{resp.status_code} {resp.text}")
-                except Exception as e:
-                    logger.warning(f"Webhook 發送失敗：{e}")
-            return
+        return web.json_response({"success": False, "reason": "缺少 code / Missing code"}, status=400)
 
-        # 開始兌換處理
-        for i in range(0, len(filtered_player_ids), MAX_BATCH_SIZE):
-            batch = filtered_player_ids[i:i + MAX_BATCH_SIZE]
-            tasks = [run_redeem_with_retry(pid, code, debug=debug) for pid in batch]
-            results = await asyncio.gather(*tasks)
-            await asyncio.sleep(1)
-            for r in results:
-                if r.get("success"):
-                    all_success.append({
-                        "player_id": r["player_id"],
-                        "message": r.get("message")
-                    })
-                    logger.info(f"[{r['player_id']}] ✅ 成功：{r.get('message')}")
-                    # ✅ 寫入成功記錄（避免下次重複送出）
-                    db.collection("success_redeems").document(code).collection("players").document(r["player_id"]).set({
-                        "message": r.get("message"),
-                        "timestamp": datetime.utcnow()
-                    })
-                else:
-                    if any(msg in (r.get("reason") or "") for msg in ["您已領取過該禮物", "超出兌換時間"]):
-                        db.collection("success_redeems").document(code).collection("players").document(r["player_id"]).set({
-                            "message": r.get("reason"),
-                            "timestamp": datetime.utcnow()
-                        })
-                        db.collection("failed_redeems").document(code).collection("players").document(r["player_id"]).delete()
-                        logger.info(f"[{r['player_id']}] {r.get('reason')} → 記錄 success 並移除 failed_redeems / Marked as success and removed from failed_redeems")
-                        continue
+    if engine not in REDEEM_ENGINES:
+        return web.json_response({"success": False, "reason": f"未知的 engine：{engine} / Unknown engine, expected one of {list(REDEEM_ENGINES)}"}, status=400)
 
-                    all_fail.append({
-                        "player_id": r.get("player_id"),
-                        "reason": r.get("reason"),
-                        "debug_logs": r.get("debug_logs", []),
-                        "debug_img_base64": r.get("debug_img_base64", None),
-                        "debug_html_base64": r.get("debug_html_base64", None)
-                    })
-                    logger.warning(f"[{r['player_id']}] ❌ 失敗：{r.get('reason')}")
-
-                    if "驗證碼三次辨識皆失敗" in (r.get("reason") or ""):
-                        doc = doc_ref_base.document("global").collection("players").document(r["player_id"]).get()
-                        name = doc.to_dict().get("name", "未知") if doc.exists else "未知"
-                        final_failed_ids.append(f"{r['player_id']} ({name})")
-
-                if r.get("reason") in ["驗證碼三次辨識皆失敗", "Timeout：單人兌換超過 90 秒"]:
-                    doc = doc_ref_base.document("global").collection("players").document(r["player_id"]).get()
-                    name = doc.to_dict().get("name", "未知") if doc.exists else "未知"
-                    db.collection("failed_redeems").document(code).collection("players").document(r["player_id"]).set({
-                        "name": name,
-                        "reason": r.get("reason"),
-                        "updated_at": datetime.utcnow()
-                    })
-
-        webhook_message = (
-            f"🎁 兌換完成 / Redemption Completed\n"
-            f"🎟️ 禮包碼 / Giftcode：{code}\n"
-            f"📊 統計 Summary：\n"
-            f"✅ 成功筆數 / Success：{len(all_success)}\n"
-            f"❌ 失敗筆數 / Failed：{len(all_fail)}\n"
-            f"⏩ 跳過人數 / Skipped：{len(already_redeemed_ids)}\n\n"
-        )
-        if final_failed_ids:
-            webhook_message += "⚠️ 三次辨識失敗的 ID（請改用/retry_failed）：\n" + "\n".join(final_failed_ids)
-        else:
-            webhook_message += "✅ 無任何 ID 出現三次辨識失敗 / No ID failed 3 times"
+    if not isinstance(player_ids, list) or not player_ids:
+        return web.json_response({"success": False, "reason": "缺少或無效的 player_ids（空或非 list） / Missing or invalid player_ids (empty or not a list)"}, status=400)
+
+    # ⛔ 已判定失效的禮包碼直接拒絕，避免整批玩家都撞同一個錯誤
+    rejected = None if data.get("force") else await run_blocking(get_rejected_code_status, code)
+    if rejected:
+        return rejected_code_response(code, rejected)
+
+    # 🧩 名單大於一個分片時分給多個實例（請求可用 shard 覆寫預設）
+    sharded = data.get("shard", SHARD_FANOUT) and len(set(player_ids)) > SHARD_SIZE
+    job = jobs.submit(
+        "redeem_sharded" if sharded else "redeem_submit", code, len(set(player_ids)) if sharded else len(player_ids),
+        {"code": code, "player_ids": player_ids, "debug": debug, "engine": engine}
+    )
+    logger.info(f"[job {job.id}] 已排入兌換工作：{code}，{len(player_ids)} 位玩家")
+    return job_accepted_response(job, "兌換已排入背景執行，完成後由 Webhook 回報 / Redemption queued, result will be reported via webhook")
 
-        webhook_message += f"\n⌛ 執行時間：約 {time.time() - start_time:.1f} 秒\n"
-        webhook_message += f"Duration: approx. {time.time() - start_time:.1f} seconds"
+@routes.post("/redeem_multi")
+async def redeem_multi(request):
+    data = await _json_body(request)
+    codes = list(dict.fromkeys(c.strip() for c in data.get("codes") or [] if isinstance(c, str) and c.strip()))
+    player_ids = data.get("player_ids")
+    debug = data.get("debug", False)
+    engine = data.get("engine") or REDEEM_ENGINE
 
-        if os.getenv("DISCORD_WEBHOOK_URL"):
-            try:
-                resp = requests.post(os.getenv("DISCORD_WEBHOOK_URL"), json={
-                    "content": webhook_message
-                })
-                logger.info(f"Webhook 發送結果：{resp.status_code} {resp.text}")
-            except Exception as e:
-                logger.warning(f"Webhook 發送失敗：{e}")
-        else:
-            logger.warning("DISCORD_WEBHOOK_URL 未設定，跳過 webhook 發送")
+    if not codes:
+        return web.json_response({"success": False, "reason": "缺少 codes / Missing codes"}, status=400)
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(process_all())
+    if not isinstance(player_ids, list) or not player_ids:
+        return web.json_response({"success": False, "reason": "缺少或無效的 player_ids（空或非 list） / Missing or invalid player_ids (empty or not a list)"}, status=400)
+
+    if engine not in REDEEM_ENGINES:
+        return web.json_response({"success": False, "reason": f"未知的 engine：{engine} / Unknown engine, expected one of {list(REDEEM_ENGINES)}"}, status=400)
+
+    # ⛔ 略過已判定失效的禮包碼；全部失效才拒絕整個請求
+    rejected = {}
+    for code in [] if data.get("force") else codes:
+        info = await run_blocking(get_rejected_code_status, code)
+        if info:
+            rejected[code] = info
+    codes = [code for code in codes if code not in rejected]
+    if not codes:
+        code, info = next(iter(rejected.items()))
+        return rejected_code_response(code, info) if len(rejected) == 1 else web.json_response({
+            "success": False,
+            "rejected": {code: info.get("status") for code, info in rejected.items()},
+            "reason": "所有禮包碼皆已判定失效，如需強制執行請帶 force / All codes rejected"
+        }, status=409)
 
-    return jsonify({"message": "兌換已完成，Webhook 已送出（或已嘗試） / Redemption completed, webhook sent (or attempted)"}), 200
+    job = jobs.submit(
+        "redeem_multi", ",".join(codes), len(codes) * len(set(player_ids)),
+        {"codes": codes, "player_ids": player_ids, "debug": debug, "engine": engine}
+    )
+    logger.info(f"[job {job.id}] 已排入多碼兌換工作：{len(codes)} 個禮包碼，{len(player_ids)} 位玩家")
+    return job_accepted_response(
+        job, "多碼兌換已排入背景執行，完成後由 Webhook 回報 / Multi-code redemption queued, result will be reported via webhook",
+        rejected={code: info.get("status") for code, info in rejected.items()}
+    )
 
-@app.route("/update_names_api", methods=["POST"])
-def update_names_api():
+@routes.post("/update_names_api")
+async def update_names_api(request):
     try:
-        data = request.json
+        data = await _json_body(request)
         guild_id = data.get("guild_id")
         if not guild_id:
-            return jsonify({"success": False, "reason": "缺少 guild_id / Missing guild_id"}), 400
-
-        player_ids = [doc.id for doc in db.collection("ids").document(guild_id).collection("players").stream()]
-        updated = []
+            return web.json_response({"success": False, "reason": "缺少 guild_id / Missing guild_id"}, status=400)
+
+        max_age_hours = float(data.get("max_age_hours", NAME_REFRESH_MAX_AGE_HOURS))
+        players_ref = db.collection("ids").document(guild_id).collection("players")
+        existing = await run_blocking(lambda: {doc.id: doc.to_dict() for doc in players_ref.stream()})
+
+        # ⏩ 跳過近期已確認過名稱的 ID
+        stale_ids = []
+        for pid, info in existing.items():
+            age = _age_seconds(info.get("updated_at"))
+            if age is None or age >= max_age_hours * 3600 or info.get("name") in [None, "未知名稱"]:
+                stale_ids.append(pid)
+        skipped = len(existing) - len(stale_ids)
+        logger.info(f"[update_names] guild {guild_id}：需重查 {len(stale_ids)} 筆，跳過 {skipped} 筆近期已更新")
+
+        updated = []          # 已寫入的名稱變更
+        write_failed = []     # 查到了但寫入失敗的 ID
+        lookup_failed = []    # 查不到名稱、保留原名的 ID
+        error = None
+
+        def commit_writes(writes):
+            batch = db.batch()
+            for pid, fields, _ in writes:
+                batch.update(players_ref.document(pid), fields)
+            batch.commit()
 
         async def fetch_all():
-            async with async_playwright() as p:
-                browser = await p.chromium.launch(headless=True)
-                context = await browser.new_context(locale="zh-TW")
-                page = await context.new_page()
+            # 多個 context 併發查詢，查到一筆就先比對一筆，每滿一批就先寫入
+            loop = asyncio.get_running_loop()
+            pending = []
 
-                for pid in player_ids:
-                    name = "未知名稱"
+            async def write_pending():
+                writes, pending[:] = list(pending), []
+                try:
+                    await loop.run_in_executor(None, commit_writes, writes)
+                except Exception as e:
+                    logger.warning(f"[update_names] {len(writes)} 筆名稱寫入失敗 / Batch of {len(writes)} failed: {e}")
+                    write_failed.extend(pid for pid, _, _ in writes)
+                    return
+                updated.extend(change for _, _, change in writes if change)
 
-                    for attempt in range(3):  # 最多重試 3 次
-                        try:
-                            await page.goto("https://wos-giftcode.centurygame.com/")
-                            await page.fill('input[type="text"]', pid)
-                            await page.click(".login_btn")
-                            await page.wait_for_selector('input[placeholder="請輸入兌換碼"]', timeout=5000)
-                            await page.wait_for_selector(".name", timeout=5000)
-                            name_el = await page.query_selector(".name")
-                            name = await name_el.inner_text() if name_el else "未知名稱"
-                            break
-                        except:
-                            await page.wait_for_timeout(1000 + attempt * 500)
+            async for pid, name in player_lookup.iter_names(stale_ids):
+                existing_name = existing[pid].get("name")
+                if name == "未知名稱":
+                    logger.info(f"[{pid}] 查詢失敗，保留原名稱：{existing_name}")
+                    lookup_failed.append(pid)
+                    continue
+                # 名稱有變更的寫入新名稱，沒變的只刷新 updated_at，下次即可被跳過
+                if existing_name != name:
+                    pending.append((pid, {"name": name, "updated_at": datetime.utcnow()}, {"player_id": pid, "name": name}))
+                else:
+                    pending.append((pid, {"updated_at": datetime.utcnow()}, None))
+                if len(pending) >= min(NAME_REFRESH_WRITE_BATCH, FIRESTORE_BATCH_LIMIT):
+                    await write_pending()
+            if pending:
+                await write_pending()
 
-                    doc_ref = db.collection("ids").document(guild_id).collection("players").document(pid)
-                    existing_doc = doc_ref.get()
-                    existing_name = existing_doc.to_dict().get("name") if existing_doc.exists else None
-
-                    if name != "未知名稱" and (existing_name != name or existing_name in [None, "未知名稱"]):
-                        doc_ref.update({
-                            "name": name,
-                            "updated_at": datetime.utcnow()
-                        })
-                        updated.append({"player_id": pid, "name": name})
-
-                        # ✅ webhook 發送（名稱更新，雙語）
-                        webhook_url = os.getenv("ADD_ID_WEBHOOK_URL")
-                        if webhook_url:
-                            try:
-                                content = (
-                                    f"🔁 名稱更新通知 / Name Updated\n"
-                                    f"🆔 Guild ID: `{guild_id}`\n"
-                                    f"👤 Player ID: `{pid}`\n"
-                                    f"📛 New Name: `{name}`"
-                                )
-                                requests.post(webhook_url, json={"content": content})
-                                logger.info(f"[Webhook] 已發送名稱更新通知")
-                            except Exception as e:
-                                logger.warning(f"[Webhook] 發送通知失敗：{e}")
-
-                    else:
-                        logger.info(f"[{pid}] 保留原名稱（未更新）：{existing_name}")
-
-                await browser.close()
-
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(fetch_all())
-
-        return jsonify({
-            "success": True,
+        try:
+            await fetch_all()
+        except Exception as e:
+            # 已寫入的批次保留，回報目前為止的部分結果
+            logger.exception(f"[update_names] 查詢中斷 / Refresh aborted: {e}")
+            error = str(e)
+
+        # ✅ webhook 發送（名稱更新，雙語），整批合併為一則
+        webhook_url = os.getenv("ADD_ID_WEBHOOK_URL")
+        if webhook_url and updated:
+            await run_blocking(
+                post_webhook_lines,
+                webhook_url,
+                f"🔁 名稱更新通知 / Name Updated\n🆔 Guild ID: `{guild_id}`\n📊 共 {len(updated)} 筆 / {len(updated)} updated",
+                [f"👤 `{u['player_id']}` ➜ 📛 `{u['name']}`" for u in updated]
+            )
+
+        return web.json_response({
+            "success": error is None,
+            "partial": bool(error or write_failed),
             "guild_id": guild_id,
-            "updated": updated
+            "updated": updated,
+            "skipped": skipped,
+            "lookup_failed": lookup_failed,
+            "write_failed": write_failed,
+            "reason": error
         })
 
     except Exception as e:
         # 發生例外錯誤 / Exception occurred
-        return jsonify({"success": False, "reason": str(e)}), 500
+        return web.json_response({"success": False, "reason": str(e)}, status=500)
 
-@app.route("/retry_failed", methods=["POST"])
-def retry_failed():
-    data = request.json
+@routes.post("/retry_failed")
+async def retry_failed(request):
+    data = await _json_body(request)
     code = data.get("code")
     debug = data.get("debug", False)
+    engine = data.get("engine") or REDEEM_ENGINE
 
     if not code:
-        return jsonify({"success": False, "reason": "缺少 code"}), 400
+        return web.json_response({"success": False, "reason": "缺少 code"}, status=400)
+
+    if engine not in REDEEM_ENGINES:
+        return web.json_response({"success": False, "reason": f"未知的 engine：{engine} / Unknown engine, expected one of {list(REDEEM_ENGINES)}"}, status=400)
+
+    rejected = None if data.get("force") else await run_blocking(get_rejected_code_status, code)
+    if rejected:
+        return rejected_code_response(code, rejected)
 
     doc_ref_base = db.collection("failed_redeems").document(code).collection("players")
-    failed_docs = doc_ref_base.stream()
-    player_ids = [doc.id for doc in failed_docs]
+    player_ids = await run_blocking(lambda: [doc.id for doc in doc_ref_base.stream()])
 
     if not player_ids:
-        return jsonify({"success": False, "reason": f"找不到 failed_redeems 清單：{code} / Cannot find failed_redeems list for code: {code}"}), 404
+        return web.json_response({"success": False, "reason": f"找不到 failed_redeems 清單：{code} / Cannot find failed_redeems list for code: {code}"}, status=404)
 
-    # 呼叫現有流程
+    payload = {
+        "code": code,
+        "player_ids": player_ids,
+        "debug": debug,
+        "engine": engine
+    }
+    job = jobs.submit("retry_failed", code, len(player_ids), payload)
+    logger.info(f"[job {job.id}] 已排入重試工作：{code}，{len(player_ids)} 筆失敗紀錄")
+    return job_accepted_response(job, f"已排入 {len(player_ids)} 筆失敗紀錄的重新兌換 / Retry of {len(player_ids)} failed IDs queued")
+
+@routes.post("/shards/work")
+async def shards_work(request):
+    # 其他實例的協調者喚醒本實例領取分片
+    shard_worker.kick()
+    return web.json_response({"success": True, "worker_id": shard_worker.worker_id}, status=202)
+
+@routes.get("/jobs/{job_id}")
+async def job_status(request):
+    job_id = request.match_info["job_id"]
+    job = jobs.get(job_id)
+    if job and not job.lease_lost:
+        return web.json_response({"success": True, **job.to_dict()}, status=200)
+    # 工作在其他實例執行（或已被接手）：改讀持久化的日誌與分片進度
     try:
-        payload = {
-            "code": code,
-            "player_ids": player_ids,
-            "debug": debug
-        }
-        # 假設這段是呼叫本地內部 API（也可直接 call 內部函式）
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(process_redeem(payload))
-        return jsonify({"success": True, "message": f"已針對 {len(player_ids)} 筆失敗紀錄重新兌換"}), 200
+        data = await run_blocking(persisted_job_status, job_id, jobs.journal)
     except Exception as e:
-        # 發生例外錯誤 / Exception occurred
-        return jsonify({"success": False, "reason": str(e)}), 500
-
-@app.route("/")
-def health():
-    return "Worker ready for redeeming!"
+        logger.warning(f"[job {job_id}] 讀取工作日誌失敗 / Failed to read persisted job: {e}")
+        data = None
+    if data:
+        return web.json_response({"success": True, **data}, status=200)
+    if job:
+        return web.json_response({"success": True, **job.to_dict()}, status=200)
+    return web.json_response({"success": False, "reason": f"找不到工作：{job_id} / Job not found"}, status=404)
+
+@routes.get("/stats")
+async def stats(request):
+    return web.json_response({
+        "browser_pool": browser_pool.stats(),
+        "page_pool": page_pool.stats(),
+        "schedulers": scheduler_reports,
+        "rate_controller": rate_controller.stats(),
+        "result_sink": result_sink.stats(),
+        "name_directory": name_directory.stats(),
+        "player_lookup": player_lookup.stats(),
+        "captcha_solver": captcha_solver.stats(),
+        "two_captcha": two_captcha.stats(),
+        "captcha_refresh": captcha_refresh_stats,
+        "resource_filter": resource_filter.stats(),
+        "waits": wait_stats_report(),
+        "browser_sessions": session_stats,
+        "outcomes": outcome_stats,
+        "http_engine": http_engine.stats(),
+        "jobs": jobs.stats(),
+        "shards": shard_worker.stats()
+    })
+
+@routes.get("/")
+async def health(request):
+    return web.Response(text="Worker ready for redeeming!")
+
+async def _on_startup(app):
+    page_pool.refill()  # 啟動即預熱頁面，第一批兌換不必等開頁
+    await jobs.resume()  # 續跑上次實例中斷且租約已過期的工作
+    jobs.watch()  # 之後定期檢查，接手持有者已失聯的工作
+
+async def _on_cleanup(app):
+    # 關機（含 Cloud Run 的 SIGTERM）：中止背景工作、送出緩衝結果，再關閉共用連線與瀏覽器
+    await jobs.close()
+    await shard_worker.close()
+    with contextlib.suppress(Exception):  # 失敗時由 atexit 的 flush_sync 再試
+        await result_sink.flush()
+    await http_engine.close()
+    await two_captcha.close()
+    await page_pool.close()
+    await browser_pool.close()
+
+def create_app():
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))  # Cloud Run 預設 PORT
-    app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    web.run_app(create_app(), host="0.0.0.0", port=port)
@@ -53,6 +53,8 @@ TOKEN = os.getenv("DISCORD_TOKEN")
 REDEEM_API_URL = os.getenv("REDEEM_API_URL")
 redeem_submit_url = f"{REDEEM_API_URL}/redeem_submit"
 retry_failed_url = f"{REDEEM_API_URL}/retry_failed"
+redeem_multi_url = f"{REDEEM_API_URL}/redeem_multi"
+jobs_url = f"{REDEEM_API_URL}/jobs"
 tz = pytz.timezone("Asia/Taipei")
 LANG_CHOICES = [
     app_commands.Choice(name="繁體中文", value="zh"),
@@ -255,18 +257,60 @@ async def trigger_backend_redeem(interaction: discord.Interaction, code: str, pl
 
         async with aiohttp.ClientSession() as session:
             try:
-                async with session.post(redeem_submit_url, json=payload, timeout=5) as resp:
-                    if resp.status == 200:
-                        logger.info(f"[{guild_id}] ✅ 成功觸發後端兌換流程（未等待完成）")
+                async with session.post(redeem_submit_url, json=payload, timeout=10) as resp:
+                    if resp.status == 202:
+                        job_id = (await resp.json()).get("job_id")
+                        logger.info(f"[{guild_id}] ✅ 已排入後端兌換工作 {job_id}")
+                        await interaction.followup.send(f"🆔 工作 ID / Job ID：`{job_id}`（可用 /job_status 查詢進度）", ephemeral=True)
+                    elif resp.status == 409:
+                        # ⛔ 禮包碼已判定失效（不存在 / 已過期），後端未執行
+                        data = await resp.json()
+                        await interaction.followup.send(f"⛔ {data.get('reason')}", ephemeral=True)
                     else:
                         logger.error(f"[{guild_id}] ❌ API 回傳錯誤狀態：{resp.status}")
             except (asyncio.TimeoutError, ClientError) as e:
-                logger.warning(f"[{guild_id}] 發送請求超時 / Request timeout. 將由 webhook 回報：{e}")
-                # ❌ 移除這行，以免 Discord 顯示錯誤訊息：
-                # await interaction.followup.send(f"❌ 發送請求失敗 / Failed to send request. 錯誤信息 / Error:{str(e)}", ephemeral=True)
+                logger.warning(f"[{guild_id}] 發送請求失敗 / Request failed：{e}")
+                await interaction.followup.send(f"❌ 發送請求失敗 / Failed to send request. 錯誤信息 / Error:{str(e)}", ephemeral=True)
     except Exception as e:
         logger.exception(f"[Critical Error] trigger_backend_redeem 發生錯誤（guild_id: {guild_id}）")
 
+@tree.command(name="redeem_multi", description="一次提交多個兌換碼 / Submit multiple redeem codes")
+@app_commands.describe(codes="以逗號(,)分隔的多個禮包碼 / Codes separated by comma(,)", player_id="選填：指定兌換的玩家 ID（單人兌換）")
+async def redeem_multi(interaction: discord.Interaction, codes: str, player_id: str = None):
+    code_list = [c.strip() for c in codes.split(",") if c.strip()]
+    if not code_list:
+        await interaction.response.send_message("⚠️ 請輸入至少一個禮包碼 / Please enter at least one code", ephemeral=True)
+        return
+
+    await interaction.response.send_message(
+        f"🎁 {len(code_list)} 個兌換碼已開始處理 / Redeeming {len(code_list)} codes. 系統稍後會回報結果 / Result will be reported shortly.",
+        ephemeral=True
+    )
+    guild_id = str(interaction.guild_id)
+    player_ids = [player_id] if player_id else await get_player_ids(guild_id)
+    if not player_ids:
+        await interaction.followup.send("⚠️ 沒有找到任何玩家 ID / No player ID found", ephemeral=True)
+        return
+
+    payload = {"codes": code_list, "player_ids": player_ids, "debug": False}
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(redeem_multi_url, json=payload, timeout=10) as resp:
+                if resp.status == 202:
+                    job_id = (await resp.json()).get("job_id")
+                    logger.info(f"[{guild_id}] ✅ 已排入多碼兌換工作 {job_id}")
+                    await interaction.followup.send(f"🆔 工作 ID / Job ID：`{job_id}`（可用 /job_status 查詢進度）", ephemeral=True)
+                elif resp.status == 409:
+                    data = await resp.json()
+                    await interaction.followup.send(f"⛔ {data.get('reason')}", ephemeral=True)
+                else:
+                    logger.error(f"[{guild_id}] ❌ API 回傳錯誤狀態：{resp.status}")
+    except (asyncio.TimeoutError, ClientError) as e:
+        logger.warning(f"[{guild_id}] 發送請求失敗 / Request failed：{e}")
+        await interaction.followup.send(f"❌ 發送請求失敗 / Failed to send request. 錯誤信息 / Error:{str(e)}", ephemeral=True)
+    except Exception:
+        logger.exception(f"[Critical Error] redeem_multi 發生錯誤（guild_id: {guild_id}）")
+
 @tree.command(name="retry_failed", description="重新兌換失敗的 ID / Retry failed ID")
 @app_commands.describe(code="禮包碼 / Redeem code")
 async def retry_failed(interaction: discord.Interaction, code: str):
@@ -289,9 +333,16 @@ async def retry_failed(interaction: discord.Interaction, code: str):
         }
         # 呼叫後端 API（這裡直接進行兌換）
         async with aiohttp.ClientSession() as session:
-            async with session.post(retry_failed_url, json=payload) as resp:
-                if resp.status == 200:
-                    await interaction.followup.send(f"🎁 重新兌換 {len(player_ids)} 個失敗的 ID 已發送到後端進行處理", ephemeral=True)
+            async with session.post(retry_failed_url, json=payload, timeout=10) as resp:
+                if resp.status == 202:
+                    job_id = (await resp.json()).get("job_id")
+                    await interaction.followup.send(
+                        f"🎁 重新兌換 {len(player_ids)} 個失敗的 ID 已發送到後端進行處理\n🆔 工作 ID / Job ID：`{job_id}`",
+                        ephemeral=True
+                    )
+                elif resp.status == 409:
+                    data = await resp.json()
+                    await interaction.followup.send(f"⛔ {data.get('reason')}", ephemeral=True)
                 else:
                     # 處理 API 錯誤回應
                     error_message = await resp.text()
@@ -299,6 +350,35 @@ async def retry_failed(interaction: discord.Interaction, code: str):
     except Exception as e:
         await interaction.followup.send(f"❌ 發生錯誤 / Error:{e}", ephemeral=True)
 
+@tree.command(name="job_status", description="查詢兌換工作進度 / Check redemption job progress")
+@app_commands.describe(job_id="兌換時回傳的工作 ID / Job ID returned when submitting")
+async def job_status(interaction: discord.Interaction, job_id: str):
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{jobs_url}/{job_id.strip()}", timeout=10) as resp:
+                data = await resp.json()
+        if resp.status != 200:
+            await interaction.response.send_message(f"⚠️ {data.get('reason')}", ephemeral=True)
+            return
+
+        counts = data.get("counts", {})
+        content = (
+            f"🆔 `{data['job_id']}`（{data['kind']}）🎟️ {data['code']}\n"
+            f"📌 狀態 / Status：{data['status']}\n"
+            f"📊 進度 / Progress：{data['processed']}/{data['total']}\n"
+            f"✅ {counts.get('success', 0)}　❌ {counts.get('failed', 0)}　"
+            f"⏩ {counts.get('skipped', 0)}　⛔ {counts.get('cancelled', 0)}"
+        )
+        # 其他實例執行中的工作由日誌讀出，沒有耗時
+        if data.get("elapsed") is not None:
+            content += f"\n⌛ {data['elapsed']} 秒 / seconds"
+        if data.get("error"):
+            content += f"\n❌ 錯誤 / Error：{data['error']}"
+        await interaction.response.send_message(content, ephemeral=True)
+    except Exception as e:
+        logger.exception(f"[job_status] 查詢失敗：{job_id}")
+        await interaction.response.send_message(f"❌ 發生錯誤 / Error:{e}", ephemeral=True)
+
 # === 活動提醒 ===
 @tree.command(name="add_notify", description="新增提醒 / Add reminder")
 @app_commands.describe(
@@ -487,7 +567,9 @@ async def help_command(interaction: discord.Interaction, lang: app_commands.Choi
                 "`/remove_id` - Remove a player ID\n"
                 "`/list_ids` - List all saved player IDs\n"
                 "`/redeem_submit` - Submit a redeem code\n"
+                "`/redeem_multi` - Submit several redeem codes at once (comma-separated)\n"
                 "`/retry_failed` - Retry failed ID redemptions\n"
+                "`/job_status` - Check the progress of a redemption job\n"
                 "`/update_names` - Refresh and update all player ID names\n"
                 "`/add_notify` - Add reminders (supports multiple dates and times)\n"
                 "`/list_notify` - View reminder list\n"
@@ -503,7 +585,9 @@ async def help_command(interaction: discord.Interaction, lang: app_commands.Choi
                 "`/remove_id` - 移除玩家 ID\n"
                 "`/list_ids` - 顯示所有已儲存的 ID\n"
                 "`/redeem_submit` - 提交兌換碼\n"
+                "`/redeem_multi` - 一次提交多個兌換碼（用逗號分隔）\n"
                 "`/retry_failed` - 重新兌換失敗的 ID\n"
+                "`/job_status` - 查詢兌換工作進度\n"
                 "`/update_names` - 重新查詢並更新所有 ID 的角色名稱\n"
                 "`/add_notify` - 新增提醒（支援多個日期與時間）\n"
                 "`/list_notify` - 查看提醒列表\n"
@@ -637,18 +721,28 @@ async def update_names(interaction: discord.Interaction, guild_id: str):
 
                 result = await resp.json()
                 updated = result.get("updated", [])
+                skipped = result.get("skipped", 0)
+                skipped_note = f"\n⏩ 略過 {skipped} 筆近期已更新 / Skipped {skipped} recently refreshed" if skipped else ""
+                lookup_failed = result.get("lookup_failed", [])
+                write_failed = result.get("write_failed", [])
+                if lookup_failed:
+                    skipped_note += f"\n❔ {len(lookup_failed)} 筆查不到名稱，保留原名 / {len(lookup_failed)} lookups failed, kept old names"
+                if write_failed:
+                    skipped_note += f"\n⚠️ {len(write_failed)} 筆寫入失敗，請稍後再試 / {len(write_failed)} writes failed, please retry"
+                if result.get("reason"):
+                    skipped_note += f"\n⚠️ 更新中途中斷，以上為部分結果 / Refresh aborted, partial results：{result['reason']}"
 
                 if updated:
                     lines = [f"- {u['player_id']} ➜ {u['name']}" for u in updated]
                     summary = "\n".join(lines)
                     logger.info(f"[update_names] 共更新 {len(updated)} 筆名稱：\n{summary}")
                     await interaction.followup.send(
-                        f"✨ 共更新 {len(updated)} 筆名稱 / Updated {len(updated)} names：\n\n{summary}", ephemeral=True
+                        f"✨ 共更新 {len(updated)} 筆名稱 / Updated {len(updated)} names：\n\n{summary}{skipped_note}", ephemeral=True
                     )
 
                 else:
                     logger.info(f"[update_names] 無任何名稱需要更新 / No names to update")
-                    await interaction.followup.send("✅ 沒有任何名稱需要更新 / No name updates required.", ephemeral=True)
+                    await interaction.followup.send(f"✅ 沒有任何名稱需要更新 / No name updates required.{skipped_note}", ephemeral=True)
 
     except Exception as e:
         await interaction.followup.send(f"❌ 發生錯誤：{e}", ephemeral=True)
@@ -0,0 +1,18 @@
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+
+@pytest.fixture(scope="session")
+def redeem_web():
+    # 測試不連 Firebase：略過憑證與 client 初始化
+    os.environ.setdefault("FIREBASE_KEY_BASE64", "e30=")  # base64("{}")
+    with mock.patch("firebase_admin.initialize_app"), \
+            mock.patch("firebase_admin.credentials.Certificate"), \
+            mock.patch("firebase_admin.firestore.client"):
+        import redeem_web
+    return redeem_web
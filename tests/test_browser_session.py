@@ -0,0 +1,109 @@
+import asyncio
+import contextlib
+
+import pytest
+
+
+class FakePage:
+    def __init__(self):
+        self.reloads = 0
+        self.context = type("Context", (), {"browser": None})()
+
+    def is_closed(self):
+        return False
+
+    async def reload(self, timeout=None):
+        self.reloads += 1
+
+    async def wait_for_selector(self, selector, timeout=None):
+        return True
+
+
+@pytest.fixture
+def fake_browser(redeem_web, monkeypatch):
+    """以假頁面取代 PagePool 與頁面操作，exchange 依序回傳 replies 中的原因（None 為成功）"""
+    state = {"pages": [], "logins": 0, "replies": []}
+
+    @contextlib.asynccontextmanager
+    async def page():
+        state["pages"].append(FakePage())
+        yield state["pages"][-1]
+
+    async def login(page, player_id, log_entry, debug_logs, debug=False):
+        state["logins"] += 1
+
+    async def exchange(page, player_id, code, log_entry, debug_logs, debug=False):
+        reply = state["replies"].pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return {"player_id": player_id, "success": reply is None, "reason": reply, "message": "成功" if reply is None else None}
+
+    async def refresh(page, player_id=None):
+        return b""
+
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(redeem_web.page_pool, "page", page)
+    monkeypatch.setattr(redeem_web, "_browser_login", login)
+    monkeypatch.setattr(redeem_web, "_browser_exchange", exchange)
+    monkeypatch.setattr(redeem_web, "_refresh_captcha", refresh)
+    monkeypatch.setattr(redeem_web.asyncio, "sleep", no_sleep)
+    return state
+
+
+def test_retry_keeps_logged_in_page(redeem_web, fake_browser):
+    fake_browser["replies"] = ["伺服器繁忙", "請稍後再試", None]
+
+    result = asyncio.run(redeem_web.run_redeem_with_retry("123", "CODE", engine="browser"))
+
+    assert result["success"]
+    assert len(fake_browser["pages"]) == 1
+    assert fake_browser["logins"] == 1
+
+
+def test_expired_login_relogs_on_same_page(redeem_web, fake_browser):
+    fake_browser["replies"] = ["請先登入", None]
+
+    result = asyncio.run(redeem_web.run_redeem_with_retry("123", "CODE", engine="browser"))
+
+    assert result["success"]
+    assert len(fake_browser["pages"]) == 1
+    assert fake_browser["pages"][0].reloads == 1
+    assert fake_browser["logins"] == 2
+
+
+def test_broken_page_restarts_on_new_page(redeem_web, fake_browser):
+    fake_browser["replies"] = [RuntimeError("Target closed"), None]
+
+    result = asyncio.run(redeem_web.run_redeem_with_retry("123", "CODE", engine="browser"))
+
+    assert result["success"]
+    assert len(fake_browser["pages"]) == 2
+
+
+def test_timeout_during_captcha_solve_is_not_throttling(redeem_web, monkeypatch):
+    throttled = []
+    monkeypatch.setattr(redeem_web, "REDEEM_TIMEOUT", 0.05)
+    monkeypatch.setattr(redeem_web.rate_controller, "on_throttle", lambda player_id=None: throttled.append(player_id))
+
+    class SlowSolver(redeem_web.CaptchaSolver):
+        name = "slow"
+
+        async def solve(self, img_bytes):
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(redeem_web, "captcha_solver", redeem_web.HedgedCaptchaSolver([SlowSolver()]))
+
+    async def solving(player_id, codes, debug_logs, attempt, debug=False):
+        await redeem_web.captcha_solver.solve(b"", player_id=player_id)
+
+    async def stalled_site(player_id, codes, debug_logs, attempt, debug=False):
+        await asyncio.sleep(10)
+
+    results = asyncio.run(redeem_web._retry_codes("123", ["CODE"], solving))
+    assert results["CODE"]["reason"].startswith("Timeout")
+    assert throttled == []
+
+    asyncio.run(redeem_web._retry_codes("123", ["CODE"], stalled_site))
+    assert throttled == ["123"]
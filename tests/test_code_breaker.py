@@ -0,0 +1,48 @@
+import asyncio
+
+
+def test_breaker_cancels_queue_after_repeated_invalid_code(redeem_web, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(redeem_web.result_sink, "record_code_status", lambda *args: recorded.append(args))
+    scheduler = redeem_web.SlidingWindowScheduler(concurrency=1, name="test_breaker")
+    breaker = redeem_web.GiftcodeCircuitBreaker("BADCODE", 10, threshold=3, on_trip=scheduler.cancel)
+    seen = []
+
+    async def worker(pid):
+        return {"player_id": pid, "success": False, "reason": "兌換碼不存在"}
+
+    def on_result(r):
+        seen.append(r["player_id"])
+        breaker.observe(r)
+
+    asyncio.run(scheduler.run([str(i) for i in range(10)], worker, on_result=on_result))
+
+    assert breaker.status == "invalid"
+    assert seen == ["0", "1", "2"]
+    assert len(scheduler.cancelled) == 7
+    assert recorded == [("BADCODE", "invalid", "兌換碼不存在")]
+
+
+def test_invalid_code_breaker_stays_closed_once_code_proved_valid(redeem_web, monkeypatch):
+    monkeypatch.setattr(redeem_web.result_sink, "record_code_status", lambda *args: None)
+    breaker = redeem_web.GiftcodeCircuitBreaker("CODE", 10, threshold=2)
+
+    breaker.observe({"success": False, "reason": "您已領取過該禮物"})
+    for _ in range(5):
+        assert not breaker.observe({"success": False, "reason": "兌換碼不存在"})
+
+    assert not breaker.tripped
+
+
+def test_expired_code_trips_even_after_successes(redeem_web, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(redeem_web.result_sink, "record_code_status", lambda *args: recorded.append(args))
+    breaker = redeem_web.GiftcodeCircuitBreaker("CODE", 10, threshold=2)
+
+    breaker.observe({"success": True})
+    # 熔斷前的結果仍交由呼叫端逐人寫入
+    assert not breaker.observe({"success": False, "reason": "超出兌換時間"})
+    assert breaker.observe({"success": False, "reason": "超出兌換時間"})
+
+    assert breaker.status == "expired"
+    assert recorded == [("CODE", "expired", "超出兌換時間")]
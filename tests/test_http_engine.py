@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from mock_giftcode_site import MockGiftcodeSite
+
+
+@pytest.fixture
+def run_with_site(redeem_web, monkeypatch):
+    """在本地假網站上執行協程；驗證碼直接回答網站目前發出的答案"""
+    site = MockGiftcodeSite(codes={"VIP888": "active", "OLD": "expired"})
+
+    async def solve(img_bytes, player_id=None):
+        return site.captchas.get(player_id), "mock"
+
+    monkeypatch.setattr(redeem_web.captcha_solver, "solve", solve)
+
+    def run(make_coro):
+        async def main():
+            runner = web.AppRunner(site.app())
+            await runner.setup()
+            server = web.TCPSite(runner, "127.0.0.1", 0)
+            await server.start()
+            port = runner.addresses[0][1]
+            engine = redeem_web.HttpRedeemEngine(base_url=f"http://127.0.0.1:{port}/api")
+            try:
+                return await make_coro(engine)
+            finally:
+                await engine.close()
+                await runner.cleanup()
+        return asyncio.run(main())
+
+    run.site = site
+    return run
+
+
+def test_http_engine_redeems_then_reports_already_claimed(run_with_site):
+    async def scenario(engine):
+        first = await engine.redeem("12345", "VIP888", [], 0)
+        second = await engine.redeem("12345", "VIP888", [], 0)
+        return first, second
+
+    first, second = run_with_site(scenario)
+    assert first["success"] and first["message"] == "兌換成功"
+    assert not second["success"] and second["reason"] == "您已領取過該禮物"
+
+
+def test_http_engine_classifies_expired_code_and_bad_login(run_with_site):
+    async def scenario(engine):
+        return await engine.redeem("12345", "OLD", [], 0), await engine.redeem("abc", "VIP888", [], 0)
+
+    expired, bad_login = run_with_site(scenario)
+    assert expired["reason"] == "超出兌換時間"
+    assert bad_login["reason"].startswith("登入失敗")
+
+
+def test_http_engine_retries_wrong_captcha(run_with_site, redeem_web, monkeypatch):
+    answers = iter(["ZZZZ", None])
+
+    async def solve(img_bytes, player_id=None):
+        return next(answers) or run_with_site.site.captchas[player_id], "mock"
+
+    monkeypatch.setattr(redeem_web.captcha_solver, "solve", solve)
+    result = run_with_site(lambda engine: engine.redeem("777", "VIP888", [], 0))
+    assert result["success"]
+    assert run_with_site.site.calls["captcha"] == 2
+
+
+def test_multiple_codes_share_one_login(run_with_site, redeem_web, monkeypatch):
+    async def scenario(engine):
+        monkeypatch.setattr(redeem_web, "http_engine", engine)
+        return await redeem_web.run_codes_with_retry("4242", ["VIP888", "OLD", "NOPE"], engine="http")
+
+    results = run_with_site(scenario)
+    assert results["VIP888"]["success"]
+    assert results["OLD"]["reason"] == "超出兌換時間"
+    assert results["NOPE"]["reason"] == "兌換碼不存在"
+    assert run_with_site.site.calls["player"] == 1
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+
+@pytest.fixture
+def api(redeem_web, monkeypatch):
+    """在測試 client 上執行協程；不預熱瀏覽器頁面、不查 Firestore 的碼狀態與工作日誌"""
+    monkeypatch.setattr(redeem_web.page_pool, "refill", lambda: None)
+    monkeypatch.setattr(redeem_web, "get_rejected_code_status", lambda code: None)
+    monkeypatch.setattr(redeem_web.jobs, "journal", redeem_web.RunJournal())
+    monkeypatch.setattr(redeem_web, "shard_store", redeem_web.LocalLeaseStore())
+
+    def run(scenario):
+        async def main():
+            async with TestClient(TestServer(redeem_web.create_app())) as client:
+                return await scenario(client)
+        return asyncio.run(main())
+
+    return run
+
+
+async def _wait_finished(client, job_id, timeout=5):
+    for _ in range(int(timeout / 0.02)):
+        data = await (await client.get(f"/jobs/{job_id}")).json()
+        if data["status"] in ("done", "failed"):
+            return data
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_redeem_submit_returns_job_and_reports_progress(redeem_web, api, monkeypatch):
+    async def fake_submit(payload, job):
+        job.count("skipped")
+        job.count("success", len(payload["player_ids"]) - 1)
+        return {"code_status": None, "unsaved": 0}
+
+    monkeypatch.setattr(redeem_web, "process_submit", fake_submit)
+
+    async def scenario(client):
+        resp = await client.post("/redeem_submit", json={"code": "CODE", "player_ids": ["1", "2", "3"]})
+        assert resp.status == 202
+        return await _wait_finished(client, (await resp.json())["job_id"])
+
+    data = api(scenario)
+    assert data["status"] == "done"
+    assert data["processed"] == data["total"] == 3
+    assert data["counts"]["success"] == 2
+
+
+def test_failed_job_exposes_error(redeem_web, api, monkeypatch):
+    async def broken_submit(payload, job):
+        raise RuntimeError("firestore unavailable")
+
+    monkeypatch.setattr(redeem_web, "process_submit", broken_submit)
+
+    async def scenario(client):
+        resp = await client.post("/redeem_submit", json={"code": "CODE", "player_ids": ["1"]})
+        data = await _wait_finished(client, (await resp.json())["job_id"])
+        missing = await client.get("/jobs/unknown")
+        return data, missing.status
+
+    data, missing_status = api(scenario)
+    assert data["status"] == "failed"
+    assert data["error"] == "firestore unavailable"
+    assert missing_status == 404
+
+
+def test_invalid_body_is_rejected(api):
+    async def scenario(client):
+        resp = await client.post("/redeem_submit", data="not json")
+        return resp.status, await resp.json()
+
+    status, data = api(scenario)
+    assert status == 400
+    assert not data["success"]
+
+
+def test_status_of_job_running_on_another_instance(redeem_web, api, tmp_path, monkeypatch):
+    journal = redeem_web.FileRunJournal(str(tmp_path / "journal.jsonl"))
+    monkeypatch.setattr(redeem_web.jobs, "journal", journal)
+    other = redeem_web.RedeemJob("redeem_submit", "CODE", 3, payload={"code": "CODE", "player_ids": ["1", "2", "3"]})
+    other.owner = "other-instance"
+    other.count("success", 2)
+    journal.start(other)
+    redeem_web.shard_store.create("sharded", [
+        {"code": "CODE", "player_ids": ["1", "2"]}, {"code": "CODE", "player_ids": ["3"]}
+    ])
+    shard = redeem_web.shard_store.claim("other-instance", 60)
+    redeem_web.shard_store.complete(shard["shard_id"], "other-instance", {}, {"success": 2})
+
+    async def scenario(client):
+        return [await (await client.get(f"/jobs/{job_id}")).json() for job_id in (other.id, "sharded")]
+
+    run, sharded = api(scenario)
+    assert run["status"] == "running" and run["persisted"]
+    assert run["processed"] == 2 and run["remaining"] == 1
+    assert sharded["status"] == "running"
+    assert sharded["counts"] == {"success": 2}
+    assert sharded["shards"] == {"total": 2, "done": 1}
@@ -0,0 +1,23 @@
+import asyncio
+
+
+def test_lookup_returns_unknown_when_page_cannot_open(redeem_web, monkeypatch):
+    async def broken_open():
+        raise RuntimeError("browser crashed")
+
+    monkeypatch.setattr(redeem_web.page_pool, "_open", broken_open)
+    service = redeem_web.PlayerLookupService(concurrency=2)
+
+    assert asyncio.run(service.lookup("123456")) == "未知名稱"
+    assert service.stats()["page_errors"] == 1
+
+
+def test_iter_names_continues_after_page_open_failure(redeem_web, monkeypatch):
+    async def broken_open():
+        raise RuntimeError("page load timeout")
+
+    monkeypatch.setattr(redeem_web.page_pool, "_open", broken_open)
+    service = redeem_web.PlayerLookupService(concurrency=2)
+
+    names = asyncio.run(service.lookup_many(["1", "2", "3"]))
+    assert names == {"1": "未知名稱", "2": "未知名稱", "3": "未知名稱"}
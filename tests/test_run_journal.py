@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+
+def _crashed_run(redeem_web, journal, attempts_p2=1):
+    """模擬上次實例中斷：p1 已完成，p2 開始後中斷，p3 尚未開始"""
+    job = redeem_web.RedeemJob(
+        "redeem_submit", "CODE", 3,
+        payload={"code": "CODE", "player_ids": ["p1", "p2", "p3"], "debug": False, "engine": "browser"},
+        journal=journal
+    )
+    journal.start(job)
+    job.attempts = {"p1": 1, "p2": attempts_p2}
+    job.count("success")
+    journal.player(job, "p1", "finished")
+    journal.player(job, "p2", "started")
+    return job
+
+
+def _resume(redeem_web, journal, monkeypatch):
+    resumed = []
+
+    async def fake_submit(payload, job):
+        resumed.append(payload["player_ids"])
+        job.count("success", len(payload["player_ids"]))
+
+    monkeypatch.setattr(redeem_web, "process_submit", fake_submit)
+    registry = redeem_web.JobRegistry(journal=journal)
+
+    async def main():
+        await registry.resume()
+        await asyncio.gather(*registry._tasks)
+        return registry
+
+    return asyncio.run(main()), resumed
+
+
+def test_resume_skips_finished_players(redeem_web, tmp_path, monkeypatch):
+    path = str(tmp_path / "journal.jsonl")
+    job = _crashed_run(redeem_web, redeem_web.FileRunJournal(path))
+
+    registry, resumed = _resume(redeem_web, redeem_web.FileRunJournal(path), monkeypatch)
+
+    assert resumed == [["p2", "p3"]]
+    data = registry.get(job.id).to_dict()
+    assert data["resumed"] and data["status"] == "done"
+    assert data["counts"]["success"] == 3
+    # 已完成的工作不會再被續跑
+    assert redeem_web.FileRunJournal(path).load() == []
+
+
+def test_resume_abandons_player_interrupted_too_often(redeem_web, tmp_path, monkeypatch):
+    path = str(tmp_path / "journal.jsonl")
+    job = _crashed_run(redeem_web, redeem_web.FileRunJournal(path), attempts_p2=redeem_web.RUN_RESUME_MAX_ATTEMPTS)
+
+    registry, resumed = _resume(redeem_web, redeem_web.FileRunJournal(path), monkeypatch)
+
+    assert resumed == [["p3"]]
+    assert registry.get(job.id).counts["failed"] == 1
+
+
+def test_concurrent_resume_runs_each_job_once(redeem_web, tmp_path, monkeypatch):
+    journal = redeem_web.FileRunJournal(str(tmp_path / "journal.jsonl"))
+    _crashed_run(redeem_web, journal)
+    resumed = []
+
+    async def fake_submit(payload, job):
+        resumed.append((job.owner, payload["player_ids"]))
+        await asyncio.sleep(0.05)
+
+    monkeypatch.setattr(redeem_web, "process_submit", fake_submit)
+    first, second = redeem_web.JobRegistry(journal=journal), redeem_web.JobRegistry(journal=journal)
+
+    async def main():
+        await asyncio.gather(first.resume(), second.resume())
+        await asyncio.gather(*first._tasks, *second._tasks)
+
+    asyncio.run(main())
+    assert len(resumed) == 1
+
+
+def test_resume_skips_run_with_live_lease(redeem_web, tmp_path, monkeypatch):
+    journal = redeem_web.FileRunJournal(str(tmp_path / "journal.jsonl"))
+    started = []
+
+    async def fake_submit(payload, job):
+        started.append(job.id)
+        await asyncio.sleep(0.2)
+
+    monkeypatch.setattr(redeem_web, "process_submit", fake_submit)
+    owner, other = redeem_web.JobRegistry(journal=journal), redeem_web.JobRegistry(journal=journal)
+
+    async def main():
+        job = owner.submit("redeem_submit", "CODE", 1, {"code": "CODE", "player_ids": ["p1"]})
+        await asyncio.sleep(0)
+        await other.resume()
+        await asyncio.gather(*owner._tasks, *other._tasks)
+        return job
+
+    job = asyncio.run(main())
+    assert started == [job.id]
+    assert other.get(job.id) is None
+
+
+def test_lost_lease_stops_job_without_finishing(redeem_web, tmp_path, monkeypatch):
+    journal = redeem_web.FileRunJournal(str(tmp_path / "journal.jsonl"))
+
+    async def slow_submit(payload, job):
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(redeem_web, "process_submit", slow_submit)
+    registry = redeem_web.JobRegistry(journal=journal, lease_seconds=0.06)
+
+    async def main():
+        job = registry.submit("redeem_submit", "CODE", 1, {"code": "CODE", "player_ids": ["p1"]})
+        # 續約停擺期間租約過期，被其他實例接手
+        journal._write({"event": "lease", "job_id": job.id, "owner": "other-instance", "lease_expires": time.time() + 60})
+        await asyncio.gather(*registry._tasks)
+        return job
+
+    job = asyncio.run(main())
+    assert job.lease_lost and job.status == "failed"
+    assert registry.lost_leases == 1
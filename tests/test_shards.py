@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def local_shards(redeem_web, monkeypatch):
+    """分片改用記憶體內的租約儲存；兌換本身以假結果取代"""
+    store = redeem_web.LocalLeaseStore()
+    monkeypatch.setattr(redeem_web, "shard_store", store)
+    monkeypatch.setattr(redeem_web, "shard_worker", redeem_web.ShardWorker(store, worker_id="coordinator"))
+    monkeypatch.setattr(redeem_web, "SHARD_SIZE", 2)
+    monkeypatch.setattr(redeem_web, "SHARD_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(redeem_web, "get_rejected_code_status", lambda code: None)
+    redeemed = []
+
+    async def fake_redeem(code, player_ids, debug=False, engine=None, job=None, scheduler_name=None):
+        redeemed.extend(player_ids)
+        await asyncio.sleep(0.01)
+        job.count("success", len(player_ids) - 1)
+        job.count("failed")
+        summary = redeem_web.empty_redeem_summary()
+        summary.update(pending=len(player_ids), success=len(player_ids) - 1,
+                       failed=[{"player_id": player_ids[-1], "reason": "伺服器繁忙"}])
+        return summary
+
+    monkeypatch.setattr(redeem_web, "redeem_code_for_players", fake_redeem)
+    store.redeemed = redeemed
+    return store
+
+
+def test_sharded_job_is_split_across_workers_and_merged(redeem_web, local_shards, monkeypatch):
+    messages = []
+
+    async def capture(content):
+        messages.append(content)
+
+    monkeypatch.setattr(redeem_web, "post_redeem_webhook", capture)
+    job = redeem_web.RedeemJob("redeem_sharded", "CODE", 5)
+    other_instance = redeem_web.ShardWorker(local_shards, worker_id="other")
+
+    async def main():
+        coordinator = asyncio.create_task(redeem_web.process_sharded({"code": "CODE", "player_ids": list("abcde")}, job))
+        await asyncio.sleep(0)
+        other_instance.kick()
+        return await coordinator
+
+    result = asyncio.run(main())
+
+    assert result["shards"] == 3
+    assert other_instance.completed >= 1
+    assert sorted(local_shards.redeemed) == list("abcde")
+    assert job.counts["success"] == 2 and job.counts["failed"] == 3
+    assert "🧩 分片 / Shards：3" in messages[0]
+    assert "❌ 失敗筆數 / Failed：3" in messages[0]
+
+
+def test_expired_lease_is_reclaimed_and_stale_worker_is_rejected(redeem_web, local_shards):
+    local_shards.create("job", [{"code": "CODE", "player_ids": ["a"]}])
+    first = local_shards.claim("w1", lease_seconds=-1)  # 租約立即過期，模擬實例當機
+
+    second = local_shards.claim("w2", lease_seconds=60)
+
+    assert second["shard_id"] == first["shard_id"]
+    assert not local_shards.complete(first["shard_id"], "w1", {}, {})
+    assert local_shards.complete(second["shard_id"], "w2", {}, {})
+    assert local_shards.claim("w3", lease_seconds=60) is None